@@ -0,0 +1,153 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+
+# logger สำหรับ log ราย message (ข้อความเข้า/ออก) ซึ่งถูกสุ่มเก็บตาม sample rate
+MESSAGE_LOGGER_NAME = "line_webhook_bot.messages"
+
+# request id ของ event ที่กำลังประมวลผล ใช้เชื่อม log ของ event ขาเข้ากับคำขอขาออก
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+_EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# เบอร์โทรไทย เช่น 0812345678, 081-234-5678, 02 813 8773, +66812345678
+_PHONE_PATTERN = re.compile(r"(?<![\w.])(?:\+66|0)\d{1,2}[- ]?\d{3}[- ]?\d{3,4}(?![\w.])")
+_BEARER_PATTERN = re.compile(r"(Bearer\s+)[\w.\-~+/=]+", re.IGNORECASE)
+
+_listener = None
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def set_request_id(request_id):
+    """ตั้ง request id ให้ context ปัจจุบัน คืน token สำหรับ reset_request_id"""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+class RedactingFilter(logging.Filter):
+    """
+    ปิดบังข้อมูลลับและข้อมูลส่วนบุคคลก่อน log ถูกเขียนออก:
+    token/secret ที่ระบุ, header Bearer, อีเมล และเบอร์โทรศัพท์
+    (format ข้อความเสร็จตรงนี้ ทำให้ค่าใน args ถูกปิดบังด้วย)
+    """
+
+    def __init__(self, secrets=()):
+        super().__init__()
+        self.secrets = [secret for secret in secrets if secret]
+
+    def redact(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, "[REDACTED]")
+        text = _BEARER_PATTERN.sub(r"\1[REDACTED]", text)
+        text = _EMAIL_PATTERN.sub("[EMAIL]", text)
+        return _PHONE_PATTERN.sub("[TEL]", text)
+
+    def filter(self, record):
+        record.msg = self.redact(record.getMessage())
+        record.args = ()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """เก็บ log ระดับต่ำกว่า WARNING ไว้เพียงสัดส่วน rate (0.0-1.0); WARNING ขึ้นไปเก็บทั้งหมด"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if not getattr(record, "request_id", None):
+            record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """log หนึ่งบรรทัดต่อหนึ่ง record ในรูป JSON (Cloud Logging อ่าน field severity/message ได้ตรง ๆ)"""
+
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id"}
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in self.RESERVED and not key.startswith("_") and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+
+def configure_logging(level="INFO", fmt="json", message_sample_rate=1.0, secrets=(), stream=None):
+    """
+    ตั้งค่า logging ของทั้งแอป:
+    - log ทุกตัวถูกใส่ลงคิวในหน่วยความจำ (QueueHandler) แล้วเขียนออก stdout โดย thread แยก
+      ทำให้ thread ที่ประมวลผล request ไม่ต้องรอ I/O ของ log
+    - ปิดบัง token/PII และเติม request id ก่อนเข้าคิว
+    - log ราย message (logger "line_webhook_bot.messages") ถูกสุ่มเก็บตาม message_sample_rate
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(RedactingFilter(secrets))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    message_logger = logging.getLogger(MESSAGE_LOGGER_NAME)
+    for existing in list(message_logger.filters):
+        message_logger.removeFilter(existing)
+    message_logger.addFilter(SamplingFilter(message_sample_rate))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,588 @@
+"""
+load test / benchmark ของ LINE webhook กับ LINE, Google Sheets และ BigQuery จำลองในเครื่อง
+
+สคริปต์นี้:
+  - เปิด service จำลองของ LINE Messaging API, Sheets และ BigQuery (หน่วงเวลาตอบได้ตามต้องการ)
+  - รันแอป (main.py ผ่าน Flask หรือ chatbot_line:app ผ่าน uvicorn) เป็นโปรเซสแยกที่ชี้ไปยัง service จำลอง
+  - ส่ง webhook ที่ลงลายเซ็นแล้วแบบเดียวกับ LINE: กดเมนู, FAQ และแบบสอบถามคำนวณราคาครบ 5 ขั้นตอน
+    จาก user จำลองหลายพันคน แต่ละ user รอข้อความตอบกลับก่อนส่งข้อความถัดไปเหมือนผู้ใช้จริง
+  - รายงานผลเป็น JSON: throughput, p50/p90/p99 ของเวลาตอบ webhook และเวลาจนข้อความตอบกลับถึง LINE,
+    หน่วยความจำ (RSS) ของแอปที่เพิ่มขึ้น และจำนวนคำขอขาออกต่อบทสนทนา เพื่อเปรียบเทียบระหว่างรอบได้
+
+ตัวอย่าง:
+    python benchmark.py --app asgi --conversations 2000 --concurrency 50 --line-latency 0.05 -o result.json
+    python benchmark.py --app wsgi --env EVENT_QUEUE_MODE=thread --mix menu=1,faq=1,quote=2
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+CHANNEL_SECRET = "benchmark-channel-secret"
+ACCESS_TOKEN = "benchmark-access-token"
+
+# ตาราง MATERIAL_COSTS ที่ Sheets จำลองส่งให้แอป (Material, Cost, Density)
+MATERIAL_ROWS = [
+    ["ABS", "250", "1.05"],
+    ["PC", "320", "1.20"],
+    ["Nylon", "300", ""],
+    ["PP", "180", "0.90"],
+    ["POM", "280", ""],
+]
+
+MENU_TEXTS = ["ติดต่อเรา", "สินค้าและบริการ", "บริการของเรา", "สินค้าตัวอย่าง", "กระบวนการผลิตสินค้า"]
+FAQ_TEXTS = ["FAQ 1", "FAQ 2", "FAQ 3", "FAQ 4", "FAQ 5"]
+QUOTE_SIZES = ["10x5x2", "10.5x4.5x3", "100 x 50 x 20 mm", "12×8×4", "3x3x3"]
+QUOTE_MATERIALS = ["ABS", "pc", "PA", "PP", "POM"]
+# ข้อความยืนยันหลังส่งข้อมูลส่วนตัว (ขั้นตอนสุดท้ายของแบบสอบถาม) ใช้ตรวจว่าใบเสนอราคาถูกบันทึกจริง
+QUOTE_CONFIRMATION = "ข้อมูลครบถ้วนแล้ว"
+
+
+# ------------------ service จำลอง ------------------
+
+class MockUpstreams:
+    """นับคำขอที่ service จำลองได้รับ และเวลาที่ข้อความตอบกลับแต่ละ reply token มาถึง"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.rows = {"sheets": 0, "bigquery": 0}
+        self.line_by_conversation = {}
+        self._waiters = {}
+        self.replied_at = {}
+        self.reply_texts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def expect_reply(self, reply_token):
+        event = threading.Event()
+        with self.lock:
+            self._waiters[reply_token] = event
+        return event
+
+    def line_request(self, path, body):
+        self.count(f"line.{path.rsplit('/', 1)[-1]}")
+        reply_token = body.get("replyToken") or ""
+        # reply token ของ benchmark มีรูปแบบ bench-<ลำดับบทสนทนา>-<ลำดับข้อความ>
+        parts = reply_token.split("-")
+        with self.lock:
+            if len(parts) == 3:
+                conversation = int(parts[1])
+                self.line_by_conversation[conversation] = self.line_by_conversation.get(conversation, 0) + 1
+            event = self._waiters.pop(reply_token, None)
+            if event is not None:
+                self.replied_at[reply_token] = time.perf_counter()
+                self.reply_texts[reply_token] = "\n".join(
+                    message.get("text", "") for message in body.get("messages", []) if isinstance(message, dict))
+        if event is not None:
+            event.set()
+
+    def add_rows(self, name, count):
+        with self.lock:
+            self.rows[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": dict(self.counts), "rows": dict(self.rows)}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _respond(self, payload, status=200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_GET(self):
+        self._delay()
+        state = self.server.state
+        if self.server.upstream == "sheets" and "/values/" in self.path:
+            state.count("sheets.get")
+            self._respond({"range": "MATERIAL_COSTS!A2:C", "majorDimension": "ROWS", "values": MATERIAL_ROWS})
+        else:
+            self._respond({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        body = self._body()
+        self._delay()
+        state = self.server.state
+        path = self.path.split("?", 1)[0]
+        if self.server.upstream == "line" and path.startswith("/v2/bot/message/"):
+            state.line_request(path, body)
+            self._respond({})
+        elif self.server.upstream == "sheets" and path.endswith(":append"):
+            values = body.get("values", [])
+            state.count("sheets.append")
+            state.add_rows("sheets", len(values))
+            self._respond({"updates": {"updatedRows": len(values),
+                                       "updatedCells": sum(len(row) for row in values)}})
+        elif self.server.upstream == "bigquery" and path.endswith("/insertAll"):
+            state.count("bigquery.insert_all")
+            state.add_rows("bigquery", len(body.get("rows", [])))
+            self._respond({"kind": "bigquery#tableDataInsertAllResponse"})
+        else:
+            self._respond({"error": "not found"}, status=404)
+
+
+def start_mock(upstream, state, latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    server.upstream = upstream
+    server.state = state
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, name=f"mock-{upstream}", daemon=True).start()
+    return server
+
+
+# ------------------ บทสนทนาจำลอง ------------------
+
+def conversation_texts(scenario, rng):
+    """ข้อความที่ user ส่งตามลำดับในบทสนทนาแต่ละแบบ"""
+    if scenario == "menu":
+        return rng.sample(MENU_TEXTS, 2)
+    if scenario == "faq":
+        return rng.sample(FAQ_TEXTS, 2)
+    return [
+        "คำนวณราคา",
+        rng.choice(QUOTE_MATERIALS),
+        rng.choice(QUOTE_SIZES),
+        str(rng.choice([50, 100, 500, 1000])),
+        "ต้องการ",
+        "สมชาย ทดสอบ, 0812345678, บริษัท ทดสอบ จำกัด, bench@example.com",
+    ]
+
+
+def webhook_body(user_id, text, reply_token, event_id):
+    """payload ของ webhook ในรูปแบบเดียวกับที่ LINE ส่งมา (1 event ต่อคำขอ)"""
+    timestamp = int(time.time() * 1000)
+    return json.dumps({
+        "destination": "Ubenchmarkbot",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": timestamp,
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": event_id,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": reply_token,
+            "message": {"id": event_id, "type": "text", "quoteToken": event_id, "text": text},
+        }],
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def parse_mix(spec):
+    weights = {}
+    for entry in spec.split(","):
+        name, _, weight = entry.partition("=")
+        name = name.strip()
+        if name not in ("menu", "faq", "quote"):
+            raise argparse.ArgumentTypeError(f"ไม่รู้จักบทสนทนา {name!r} (ใช้ได้: menu, faq, quote)")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.webhook_seconds = []
+        self.reply_seconds = []
+        self.http_errors = 0
+        self.missing_replies = 0
+        self.unexpected_replies = 0
+        self.completed = {"menu": 0, "faq": 0, "quote": 0}
+
+    def record(self, webhook_seconds=None, reply_seconds=None, http_error=False, missing_reply=False,
+               unexpected_reply=False):
+        with self.lock:
+            if webhook_seconds is not None:
+                self.webhook_seconds.append(webhook_seconds)
+            if reply_seconds is not None:
+                self.reply_seconds.append(reply_seconds)
+            self.http_errors += http_error
+            self.missing_replies += missing_reply
+            self.unexpected_replies += unexpected_reply
+
+
+def run_conversation(session, url, state, recorder, index, user_id, scenario, rng, args):
+    reply_text = ""
+    for step, text in enumerate(conversation_texts(scenario, rng)):
+        reply_token = f"bench-{index}-{step}"
+        body = webhook_body(user_id, text, reply_token, f"bench{index:08d}{step:02d}")
+        replied = state.expect_reply(reply_token)
+        started = time.perf_counter()
+        try:
+            response = session.post(url, data=body, timeout=args.reply_timeout, headers={
+                "Content-Type": "application/json", "X-Line-Signature": sign(body)})
+            failed = response.status_code != 200
+        except requests.RequestException:
+            failed = True
+        recorder.record(webhook_seconds=time.perf_counter() - started, http_error=failed)
+        if failed:
+            return False
+        # รอข้อความตอบกลับถึง LINE ก่อนส่งข้อความถัดไป (ข้อความของ user เดียวกันจึงไม่ซ้อนกัน)
+        if not replied.wait(args.reply_timeout):
+            recorder.record(missing_reply=True)
+            return False
+        recorder.record(reply_seconds=state.replied_at.pop(reply_token) - started)
+        reply_text = state.reply_texts.pop(reply_token, "")
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+    if scenario == "quote" and QUOTE_CONFIRMATION not in reply_text:
+        # ได้ข้อความตอบกลับแต่ไม่ใช่การยืนยัน (เช่น session ถูกเขียนทับ) ไม่นับว่าสำเร็จ
+        recorder.record(unexpected_reply=True)
+        return False
+    with recorder.lock:
+        recorder.completed[scenario] += 1
+    return True
+
+
+def run_load(url, state, recorder, plan, args, first_index=0):
+    """
+    ส่งบทสนทนาใน plan ด้วย worker args.concurrency ตัว คืนเวลาที่ใช้ (วินาที)
+    บทสนทนาของ user เดียวกันถูกส่งตามลำดับโดย worker เดียว (ไม่ซ้อนกัน เพราะจะเขียนทับ session กันเอง)
+    """
+    by_user = {}
+    for offset, (user_id, scenario) in enumerate(plan):
+        by_user.setdefault(user_id, []).append((first_index + offset, user_id, scenario))
+    jobs = queue.Queue()
+    for conversations in by_user.values():
+        jobs.put(conversations)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        while True:
+            try:
+                conversations = jobs.get_nowait()
+            except queue.Empty:
+                break
+            for index, user_id, scenario in conversations:
+                run_conversation(session, url, state, recorder, index, user_id, scenario, rng, args)
+        session.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(args.seed + n,), daemon=True)
+               for n in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def build_plan(count, users, weights, rng):
+    scenarios = list(weights)
+    chosen = rng.choices(scenarios, weights=[weights[name] for name in scenarios], k=count)
+    return [(f"U{index % users:032x}", scenario) for index, scenario in enumerate(chosen)]
+
+
+# ------------------ แอปที่ทดสอบ ------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_rss_kb(pid):
+    """RSS ของโปรเซส (KB) จาก /proc (Linux เท่านั้น) หรือ None"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = read_rss_kb(pid)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = read_rss_kb(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def start_app(args, mocks, workdir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "LINE_ACCESS_TOKEN": ACCESS_TOKEN,
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_API_URL": f"http://127.0.0.1:{mocks['line'].server_port}",
+        "SHEETS_API_ENDPOINT": f"http://127.0.0.1:{mocks['sheets'].server_port}",
+        "BIGQUERY_API_ENDPOINT": f"http://127.0.0.1:{mocks['bigquery'].server_port}",
+        "GOOGLE_CLOUD_PROJECT": "benchmark",
+        "SPREADSHEET_ID": "benchmark-sheet",
+        "BIGQUERY_DATASET": "benchmark",
+        "BIGQUERY_TABLE": "quotes",
+        "QUOTE_SPOOL_PATH": os.path.join(workdir, "quotes.jsonl"),
+        "PRICE_SNAPSHOT_PATH": os.path.join(workdir, "material_costs.json"),
+        "QUOTE_FLUSH_INTERVAL": "1",
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if args.app == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "chatbot_line:app", "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "main.py"]
+    log_path = os.path.join(workdir, "app.log")
+    log_file = open(log_path, "wb")
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            # พร้อมเมื่อโหลดตารางราคาและสร้าง client ของ Google (กับ service จำลอง) เสร็จแล้ว
+            if requests.get(f"{base_url}/ready", timeout=1).status_code == 200:
+                return process, base_url, log_path
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    log_file.close()
+    with open(log_path, encoding="utf-8", errors="replace") as log:
+        tail = log.read()[-2000:]
+    raise SystemExit(f"แอปไม่พร้อมภายใน {args.startup_timeout} วินาที\n{tail}")
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# ------------------ รายงาน ------------------
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize_ms(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p90": round(percentile(values, 0.90) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def wait_for_quote_rows(state, expected, timeout):
+    """รอให้ QuoteSink ของแอป flush ใบเสนอราคาลง Sheets/BigQuery จำลองครบ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        rows = state.snapshot()["rows"]
+        if rows["sheets"] >= expected and rows["bigquery"] >= expected:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def outbound_report(state, plan, first_index, completed_quotes, before):
+    snapshot = state.snapshot()
+    requests_made = {name: count - before["requests"].get(name, 0) for name, count in snapshot["requests"].items()}
+    rows = {name: count - before["rows"].get(name, 0) for name, count in snapshot["rows"].items()}
+    with state.lock:
+        line_calls = dict(state.line_by_conversation)
+    by_scenario = {}
+    for offset, (_, scenario) in enumerate(plan):
+        entry = by_scenario.setdefault(scenario, {"conversations": 0, "line_calls": 0})
+        entry["conversations"] += 1
+        entry["line_calls"] += line_calls.get(first_index + offset, 0)
+    for entry in by_scenario.values():
+        entry["line_calls_per_conversation"] = round(entry["line_calls"] / entry["conversations"], 3)
+    google_calls = sum(count for name, count in requests_made.items() if not name.startswith("line."))
+    return {
+        "requests": requests_made,
+        "rows": rows,
+        "line_calls_per_conversation": by_scenario,
+        "google_calls_per_quote": round(google_calls / completed_quotes, 3) if completed_quotes else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="load test ของ LINE webhook กับ LINE/Sheets/BigQuery จำลอง")
+    parser.add_argument("--app", choices=("asgi", "wsgi"), default="asgi",
+                        help="asgi = uvicorn chatbot_line:app (เหมือน Dockerfile), wsgi = python main.py")
+    parser.add_argument("--conversations", type=int, default=2000, help="จำนวนบทสนทนาที่วัดผล")
+    parser.add_argument("--users", type=int, default=2000, help="จำนวน user ID จำลอง")
+    parser.add_argument("--concurrency", type=int, default=50, help="จำนวน user ที่คุยพร้อมกัน")
+    parser.add_argument("--warmup", type=int, default=50, help="จำนวนบทสนทนาก่อนเริ่มวัดผล")
+    parser.add_argument("--mix", type=parse_mix, default="menu=3,faq=3,quote=4",
+                        help="สัดส่วนของบทสนทนา menu/faq/quote")
+    parser.add_argument("--think-time", type=float, default=0.0, help="เวลาคิดเฉลี่ยระหว่างข้อความ (วินาที)")
+    parser.add_argument("--line-latency", type=float, default=0.0, help="เวลาตอบของ LINE จำลอง (วินาที)")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="เวลาตอบของ Sheets จำลอง (วินาที)")
+    parser.add_argument("--bigquery-latency", type=float, default=0.0, help="เวลาตอบของ BigQuery จำลอง (วินาที)")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="เวลารอข้อความตอบกลับสูงสุด (วินาที)")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--flush-timeout", type=float, default=30.0,
+                        help="เวลารอใบเสนอราคาถูก flush ลง Sheets/BigQuery หลังจบการทดสอบ (วินาที)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment variable เพิ่มเติมของแอป เช่น EVENT_QUEUE_MODE=thread")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="ไฟล์ผลลัพธ์ JSON (ค่าเริ่มต้น: stdout)")
+    args = parser.parse_args(argv)
+    if args.users < args.concurrency:
+        print(f"คำเตือน: --users ({args.users}) น้อยกว่า --concurrency ({args.concurrency}) "
+              f"คุยพร้อมกันได้จริงเพียง {args.users} user", file=sys.stderr)
+
+    state = MockUpstreams()
+    mocks = {
+        "line": start_mock("line", state, args.line_latency),
+        "sheets": start_mock("sheets", state, args.sheets_latency),
+        "bigquery": start_mock("bigquery", state, args.bigquery_latency),
+    }
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="line-webhook-bench-")
+    process, base_url, log_path = start_app(args, mocks, workdir)
+    url = f"{base_url}/webhook"
+    try:
+        rss_started = read_rss_kb(process.pid)
+        warmup_plan = build_plan(args.warmup, args.users, args.mix, rng)
+        warmup = Recorder()
+        run_load(url, state, warmup, warmup_plan, args)
+        # ให้ใบเสนอราคาของช่วง warm-up ถูก flush ก่อน จะได้ไม่ถูกนับรวมกับรอบที่วัดผล
+        wait_for_quote_rows(state, warmup.completed["quote"], args.flush_timeout)
+
+        before = state.snapshot()
+        rss_before = read_rss_kb(process.pid)
+        sampler = RssSampler(process.pid)
+        sampler.start()
+        recorder = Recorder()
+        plan = build_plan(args.conversations, args.users, args.mix, rng)
+        print(f"benchmark: {args.conversations} บทสนทนา, {args.concurrency} พร้อมกัน -> {url}", file=sys.stderr)
+        duration = run_load(url, state, recorder, plan, args, first_index=len(warmup_plan))
+        expected_rows = before["rows"]["sheets"] + recorder.completed["quote"]
+        flushed = wait_for_quote_rows(state, expected_rows, args.flush_timeout)
+        sampler.stop()
+        rss_after = read_rss_kb(process.pid)
+        app_stats = requests.get(f"{base_url}/stats", timeout=5).json()
+    finally:
+        stop_app(process)
+        for server in mocks.values():
+            server.shutdown()
+
+    messages = len(recorder.webhook_seconds)
+    result = {
+        "config": {
+            "app": args.app,
+            "conversations": args.conversations,
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "effective_concurrency": min(args.concurrency, args.users),
+            "warmup": args.warmup,
+            "mix": args.mix,
+            "think_time": args.think_time,
+            "latency": {"line": args.line_latency, "sheets": args.sheets_latency, "bigquery": args.bigquery_latency},
+            "env": args.env,
+            "seed": args.seed,
+        },
+        "duration_seconds": round(duration, 3),
+        "throughput": {
+            "webhook_requests_per_second": round(messages / duration, 2) if duration else None,
+            "conversations_per_second": round(sum(recorder.completed.values()) / duration, 2) if duration else None,
+        },
+        "completed": recorder.completed,
+        "errors": {"http": recorder.http_errors, "missing_replies": recorder.missing_replies,
+                   "unexpected_replies": recorder.unexpected_replies, "quotes_not_flushed": not flushed},
+        "latency_ms": {
+            "webhook": summarize_ms(recorder.webhook_seconds),
+            "reply": summarize_ms(recorder.reply_seconds),
+        },
+        "memory_kb": {
+            "rss_start": rss_started,
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "rss_peak": sampler.peak,
+            "rss_growth": rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+        },
+        "outbound": outbound_report(state, plan, len(warmup_plan), recorder.completed["quote"], before),
+        "app": {
+            "part_cache": app_stats.get("part_cache"),
+            "sessions": app_stats.get("sessions"),
+            "upstreams": app_stats.get("upstreams"),
+        },
+        "app_log": log_path,
+    }
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return result
+
+
+if __name__ == "__main__":
+    main()
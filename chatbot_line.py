@@ -0,0 +1,217 @@
+"""
+ASGI entry point ของ LINE webhook (รันด้วย uvicorn chatbot_line:app ตาม Dockerfile)
+
+ใช้ route และ handler ชุดเดียวกับ main.py แต่:
+  - /webhook ตอบ 200 ทันที แล้วประมวลผล event เป็น asyncio task
+  - handler เดิม (ที่อาจเรียก Google SDK แบบ blocking) รันใน thread pool ขนาดจำกัด
+  - ข้อความขาออกส่งด้วย AsyncLineClient (httpx + connection pool) โดยไม่กิน thread
+  - event ของ user เดียวกันถูกประมวลผลตามลำดับด้วย lock ราย user
+"""
+import startup_profile  # ต้อง import ก่อน module อื่นเพื่อจับเวลา import ทั้งหมด (ดู /ready)
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import main
+import metrics
+from line_client import AsyncLineClient
+from message_templates import TemplateError
+from outbox import group_events_by_user
+from app_logging import set_request_id
+from resilience import AsyncGuardedClient
+from webhook_parser import InvalidPayload, InvalidSignature
+
+logger = logging.getLogger(__name__)
+
+BLOCKING_WORKERS = int(os.getenv("ASGI_BLOCKING_WORKERS", "16"))
+
+BLOCKING_POOL = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+ASYNC_LINE_CLIENT = None
+# ASYNC_LINE_CLIENT ที่ส่งผ่าน circuit breaker ของ LINE ชุดเดียวกับ main.UPSTREAMS
+GUARDED_ASYNC_LINE_CLIENT = None
+
+# lock ราย user (ลบออกเมื่อไม่มี task ของ user นั้นรออยู่) และ task ที่กำลังทำงาน
+_user_locks = {}
+_background_tasks = set()
+
+
+class _UserLock:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+
+async def process_user_events(user_id, events):
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = _UserLock()
+    entry.waiters += 1
+    # task มี context ของตัวเอง: request id นี้ติดไปกับ log ของ handler (ใน thread pool) และคำขอขาออก
+    set_request_id(main.event_request_id(events))
+    try:
+        async with entry.lock:
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            outbox = await loop.run_in_executor(BLOCKING_POOL, context.run, main.process_events, user_id, events)
+            if len(outbox):
+                # ส่งผ่านคิวกลางของ main (จำกัดอัตราต่อ user/channel) แต่รันการส่งบน event loop นี้
+                main.OUTBOUND.submit(user_id, lambda: flush_outbox(outbox), priority=outbox.priority,
+                                     cost=outbox.request_count(), loop=loop)
+    except Exception as e:
+        logger.exception("ประมวลผล event ของ %s ไม่สำเร็จ: %s", user_id, e)
+    finally:
+        entry.waiters -= 1
+        if entry.waiters == 0:
+            _user_locks.pop(user_id, None)
+
+
+async def flush_outbox(outbox):
+    # exception ถูกส่งต่อให้ OUTBOUND บันทึก log และนับเป็น failed
+    for response in await outbox.flush_async(GUARDED_ASYNC_LINE_CLIENT):
+        main.log_line_response(response)
+
+
+class RequestMetricsMiddleware:
+    """นับจำนวนและจับเวลา HTTP request (ASGI middleware แบบเบา ไม่ครอบ response body)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"] if scope["path"] in ROUTE_PATHS else "unmatched"
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.HTTP_REQUESTS.inc(path=path, status=status["code"])
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path)
+
+
+async def home(request):
+    return PlainTextResponse("LINE Webhook is running", status_code=200)
+
+
+async def webhook(request):
+    body = await request.body()
+    try:
+        events = main.WEBHOOK_PARSER.parse(body, request.headers.get("X-Line-Signature"))
+    except InvalidSignature:
+        return JSONResponse({"error": "Invalid signature"}, status_code=403)
+    except InvalidPayload:
+        return JSONResponse({"error": "Bad Request"}, status_code=400)
+    logger.info("Received %d events", len(events))
+    for user_id, user_events in group_events_by_user(events):
+        task = asyncio.create_task(process_user_events(user_id, user_events))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return JSONResponse({"status": "ok"}, status_code=200)
+
+
+async def stats(request):
+    payload = main.stats_payload()
+    payload["in_flight_tasks"] = len(_background_tasks)
+    payload["blocking_workers"] = BLOCKING_WORKERS
+    return JSONResponse(payload)
+
+
+async def ready(request):
+    status = main.readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+async def refresh_prices(request):
+    denied = main.check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return JSONResponse(denied[0], status_code=denied[1])
+    loop = asyncio.get_running_loop()
+    ok = await loop.run_in_executor(BLOCKING_POOL, main.PRICE_TABLE.refresh)
+    return JSONResponse({"status": "ok" if ok else "failed", "price_table": main.PRICE_TABLE.stats()},
+                        status_code=200 if ok else 502)
+
+
+async def reload_templates(request):
+    denied = main.check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return JSONResponse(denied[0], status_code=denied[1])
+    loop = asyncio.get_running_loop()
+    try:
+        count = await loop.run_in_executor(BLOCKING_POOL, main.TEMPLATES.reload)
+    except TemplateError as e:
+        # ไฟล์ผิดรูปแบบหรือเกินข้อจำกัดของ LINE: ใช้ template ชุดเดิมต่อไป
+        return JSONResponse({"status": "failed", "error": str(e)}, status_code=400)
+    return JSONResponse({"status": "ok", "templates": count}, status_code=200)
+
+
+async def quote_batch(request):
+    denied = main.check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return JSONResponse(denied[0], status_code=denied[1])
+    body = await request.body()
+    loop = asyncio.get_running_loop()
+    payload, status = await loop.run_in_executor(
+        BLOCKING_POOL, main.batch_quote, body, request.headers.get("Content-Type"))
+    return JSONResponse(payload, status_code=status)
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global ASYNC_LINE_CLIENT, GUARDED_ASYNC_LINE_CLIENT
+    ASYNC_LINE_CLIENT = AsyncLineClient(
+        main.LINE_ACCESS_TOKEN,
+        base_url=main.LINE_API_URL,
+        read_timeout=main.LINE_TIMEOUT,
+        retries=main.LINE_RETRIES,
+        pool_size=max(main.LINE_POOL_SIZE, BLOCKING_WORKERS)
+    )
+    GUARDED_ASYNC_LINE_CLIENT = AsyncGuardedClient(ASYNC_LINE_CLIENT, main.UPSTREAMS["line"])
+    try:
+        yield
+    finally:
+        if _background_tasks:
+            await asyncio.wait(list(_background_tasks), timeout=10)
+        # ส่งข้อความที่ยังค้างในคิวก่อนปิด client
+        await asyncio.get_running_loop().run_in_executor(None, main.OUTBOUND.drain, 10)
+        await ASYNC_LINE_CLIENT.close()
+        BLOCKING_POOL.shutdown(wait=True)
+        main.QUOTE_SINK.stop()
+
+
+ROUTES = [
+    Route("/", home, methods=["GET"]),
+    Route("/webhook", webhook, methods=["POST"]),
+    Route("/quote/batch", quote_batch, methods=["POST"]),
+    Route("/admin/prices/refresh", refresh_prices, methods=["POST"]),
+    Route("/admin/templates/reload", reload_templates, methods=["POST"]),
+    Route("/ready", ready, methods=["GET"]),
+    Route("/stats", stats, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+]
+ROUTE_PATHS = {route.path for route in ROUTES}
+
+app = Starlette(
+    routes=ROUTES,
+    middleware=[Middleware(RequestMetricsMiddleware)],
+    lifespan=lifespan
+)
@@ -0,0 +1,199 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from metrics import track_upstream
+
+# library ของ Google (google.auth, googleapiclient, google.cloud.bigquery) ใช้เวลา import รวมราวครึ่งวินาที
+# จึง import เมื่อสร้าง client ครั้งแรกเท่านั้น (ใน warm_up() เบื้องหลัง หรือคำขอแรก) ไม่ใช่ตอน import main.py
+
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/bigquery",
+]
+
+# HTTP status ของ Google API ที่ลองใหม่ได้ (rate limit และ server error ชั่วคราว)
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def is_transient_error(error):
+    """
+    ข้อผิดพลาดชั่วคราวที่ควร retry: network/timeout (OSError รวม socket.timeout)
+    และ HTTP 408/429/5xx ทั้งจาก googleapiclient (HttpError.resp.status) และ google-cloud (exception.code)
+    """
+    if isinstance(error, OSError):
+        return True
+    status = getattr(getattr(error, "resp", None), "status", None) or getattr(error, "code", None)
+    try:
+        return int(status) in TRANSIENT_STATUSES
+    except (TypeError, ValueError):
+        return False
+
+
+class GoogleClients:
+    """
+    registry ของ client Google ที่สร้างครั้งเดียวต่อโปรเซส (lazy, thread-safe)
+    - credentials จาก google.auth.default() ถูกโหลดครั้งเดียวและ refresh เมื่อหมดอายุเท่านั้น
+    - Sheets service ถูก build ครั้งเดียว (ใช้ discovery document ที่มากับ library ไม่ต้องโหลดจากเน็ต)
+      แต่ละ thread ใช้ httplib2 connection ของตัวเอง เพราะ httplib2 ไม่ thread-safe
+    - BigQuery client ถูกสร้างครั้งเดียวและใช้ HTTP session ร่วมกัน
+
+    sheets_endpoint/bigquery_endpoint ใช้ชี้ไปยัง service จำลองในเครื่อง (เช่น benchmark.py)
+    เมื่อกำหนดค่าใดค่าหนึ่งจะใช้ AnonymousCredentials แทน google.auth.default()
+
+    stats() แยกเวลาในการสร้าง client ออกจากเวลาของคำขอแต่ละประเภท
+    """
+
+    def __init__(self, scopes=None, timeout=30, sheets_endpoint=None, bigquery_endpoint=None, project=None):
+        self.scopes = scopes or GOOGLE_SCOPES
+        self.timeout = timeout
+        self.sheets_endpoint = sheets_endpoint
+        self.bigquery_endpoint = bigquery_endpoint
+        self.anonymous = bool(sheets_endpoint or bigquery_endpoint)
+        self.project = project
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+        self._credentials = None
+        self._project = None
+        self._sheets = None
+        self._bigquery = None
+        self._auth_request = None
+        self.warm_up_error = None
+
+        self._stats_lock = threading.Lock()
+        self.build_seconds = {}
+        self.request_stats = {}
+        self.refresh_count = 0
+
+    def _record_build(self, name, seconds):
+        with self._stats_lock:
+            self.build_seconds[name] = seconds
+
+    def _load_credentials(self):
+        if self._credentials is None:
+            import google.auth
+            from google.auth.credentials import AnonymousCredentials
+            from google.auth.transport.requests import Request
+
+            started = time.perf_counter()
+            if self.anonymous:
+                self._credentials, self._project = AnonymousCredentials(), self.project or "local"
+            else:
+                self._credentials, self._project = google.auth.default(scopes=self.scopes)
+                self._project = self.project or self._project
+            self._auth_request = Request(requests.Session())
+            self._record_build("credentials", time.perf_counter() - started)
+        return self._credentials
+
+    def credentials(self):
+        """คืน credentials ที่ยังใช้ได้ โดย refresh เฉพาะเมื่อหมดอายุหรือยังไม่เคยได้ token"""
+        with self._lock:
+            credentials = self._load_credentials()
+        if not credentials.valid:
+            with self._refresh_lock:
+                if not credentials.valid:
+                    started = time.perf_counter()
+                    with track_upstream("google_auth", "refresh"):
+                        credentials.refresh(self._auth_request)
+                    with self._stats_lock:
+                        self.refresh_count += 1
+                        self.build_seconds["last_refresh"] = time.perf_counter() - started
+        return credentials
+
+    def sheets(self):
+        with self._lock:
+            if self._sheets is None:
+                from googleapiclient.discovery import build
+
+                credentials = self._load_credentials()
+                started = time.perf_counter()
+                client_options = {"api_endpoint": self.sheets_endpoint} if self.sheets_endpoint else None
+                self._sheets = build("sheets", "v4", credentials=credentials, cache_discovery=False,
+                                     client_options=client_options)
+                self._record_build("sheets", time.perf_counter() - started)
+            return self._sheets
+
+    def _sheets_http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials(), http=httplib2.Http(timeout=self.timeout))
+            self._local.http = http
+        return http
+
+    def execute_sheets(self, request, name="sheets"):
+        """
+        execute คำขอ Sheets ด้วย connection ของ thread ปัจจุบัน และจับเวลาไว้ใน stats
+        ตัวอย่าง: clients.execute_sheets(clients.sheets().spreadsheets().values().get(...), "sheets.get")
+        """
+        self.credentials()
+        http = self._sheets_http()
+        with self.timed(name):
+            return request.execute(http=http)
+
+    def bigquery(self):
+        with self._lock:
+            if self._bigquery is None:
+                from google.cloud import bigquery
+
+                credentials = self._load_credentials()
+                started = time.perf_counter()
+                client_options = {"api_endpoint": self.bigquery_endpoint} if self.bigquery_endpoint else None
+                self._bigquery = bigquery.Client(credentials=credentials, project=self._project,
+                                                 client_options=client_options)
+                self._record_build("bigquery", time.perf_counter() - started)
+            return self._bigquery
+
+    def warm_up(self):
+        """import library และสร้าง credentials/Sheets/BigQuery client ล่วงหน้า (เรียกจาก thread เบื้องหลัง)"""
+        started = time.perf_counter()
+        try:
+            self.credentials()
+            self.sheets()
+            self.bigquery()
+        except Exception as e:
+            self.warm_up_error = repr(e)
+            raise
+        self.warm_up_error = None
+        self._record_build("warm_up", time.perf_counter() - started)
+
+    def ready(self):
+        """client ใดสร้างเสร็จแล้วบ้าง (ใช้กับ /ready)"""
+        return {
+            "credentials": self._credentials is not None,
+            "sheets": self._sheets is not None,
+            "bigquery": self._bigquery is not None,
+            "last_error": self.warm_up_error,
+        }
+
+    @contextmanager
+    def timed(self, name):
+        """จับเวลาคำขอชื่อ name (เช่น "sheets.get") ลง stats() และ histogram ของ upstream ตามคำหน้าจุด"""
+        started = time.perf_counter()
+        try:
+            with track_upstream(name.split(".", 1)[0], name):
+                yield
+        finally:
+            spent = time.perf_counter() - started
+            with self._stats_lock:
+                entry = self.request_stats.setdefault(name, {"count": 0, "seconds_total": 0.0, "seconds_max": 0.0})
+                entry["count"] += 1
+                entry["seconds_total"] += spent
+                if spent > entry["seconds_max"]:
+                    entry["seconds_max"] = spent
+
+    def stats(self):
+        with self._stats_lock:
+            requests_stats = {}
+            for name, entry in self.request_stats.items():
+                requests_stats[name] = dict(entry, seconds_avg=entry["seconds_total"] / entry["count"])
+            return {
+                "build_seconds": dict(self.build_seconds),
+                "credential_refreshes": self.refresh_count,
+                "requests": requests_stats,
+            }
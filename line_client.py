@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import random
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import UPSTREAM_ERRORS, UPSTREAM_RETRIES, track_upstream
+
+LINE_API_BASE = "https://api.line.me"
+
+logger = logging.getLogger(__name__)
+
+
+class RawJSON(bytes):
+    """ข้อความ LINE ที่ serialise เป็น JSON (UTF-8) ไว้แล้ว จะถูกต่อเข้า request body โดยไม่ encode ซ้ำ"""
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_body(fields, messages):
+    """
+    สร้าง request body เป็น bytes จาก fields (เช่น {"to": ...}) และ list ของข้อความ
+    ข้อความที่เป็น RawJSON ถูกต่อเข้าไปตรง ๆ ส่วน dict จะถูก serialise ตามปกติ
+    """
+    parts = [message if isinstance(message, RawJSON) else _dumps(message) for message in messages]
+    head = _dumps(fields)[:-1]
+    separator = b"," if fields else b""
+    return head + separator + b'"messages":[' + b",".join(parts) + b"]}"
+
+
+class LineClient:
+    """
+    client สำหรับ LINE Messaging API ที่ใช้ requests.Session ร่วมกันทั้งโปรเซส
+    - connection pool แบบ keep-alive ไม่ต้องเปิด TLS ใหม่ทุกข้อความ
+    - timeout ที่กำหนดได้ และ retry พร้อม backoff เมื่อเจอ 429/5xx
+    - ส่งผ่าน /v2/bot/message/reply ก่อนเมื่อมี reply token (ไม่กินโควต้า push)
+      และถอยไปใช้ /v2/bot/message/push เมื่อ reply ไม่สำเร็จ
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, access_token, base_url=LINE_API_BASE, connect_timeout=3.05, read_timeout=10,
+                 retries=3, backoff=0.5, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        })
+        retry_options = dict(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        try:
+            # jitter กระจายเวลา retry ของหลาย worker ไม่ให้ยิงซ้ำพร้อมกัน
+            retry = Retry(backoff_jitter=backoff, **retry_options)
+        except TypeError:  # urllib3 < 2.0 ไม่มี backoff_jitter
+            retry = Retry(**retry_options)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, path, body, headers=None):
+        operation = path.rsplit("/", 1)[-1]
+        with track_upstream("line", operation):
+            response = self.session.post(f"{self.base_url}{path}", data=body, headers=headers, timeout=self.timeout)
+        # urllib3 เก็บประวัติการ retry ไว้ใน response.raw.retries
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        if retries is not None and retries.history:
+            UPSTREAM_RETRIES.inc(len(retries.history), upstream="line", operation=operation)
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(upstream="line", operation=operation)
+        return response
+
+    def reply(self, reply_token, messages):
+        return self._post("/v2/bot/message/reply", encode_body({"replyToken": reply_token}, messages))
+
+    def push(self, user_id, messages):
+        # X-Line-Retry-Key ทำให้ LINE ไม่ส่งข้อความซ้ำเมื่อ retry หลัง timeout/5xx
+        headers = {"X-Line-Retry-Key": str(uuid.uuid4())}
+        return self._post("/v2/bot/message/push", encode_body({"to": user_id}, messages), headers=headers)
+
+    def send(self, user_id, messages, reply_token=None):
+        """
+        ส่งข้อความไปหา user โดยใช้ reply token ถ้ามี
+        ถ้า reply ไม่สำเร็จ (เช่น token หมดอายุหรือถูกใช้ไปแล้ว) จะส่งซ้ำด้วย push
+        คืนค่า requests.Response ของคำขอสุดท้าย
+        """
+        if reply_token:
+            try:
+                response = self.reply(reply_token, messages)
+                if response.ok:
+                    return response
+                logger.warning("reply ไม่สำเร็จ (%s) ส่งด้วย push แทน", response.status_code)
+            except requests.ConnectionError as e:
+                # ถ้า read timeout อาจส่งถึงแล้ว จึงถอยไป push เฉพาะกรณีเชื่อมต่อไม่ได้
+                logger.warning("reply ไม่สำเร็จ (%s) ส่งด้วย push แทน", e)
+        return self.push(user_id, messages)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncLineClient:
+    """
+    LINE client แบบ async สำหรับ ASGI app (httpx.AsyncClient พร้อม connection pool)
+    พฤติกรรมเหมือน LineClient: retry พร้อม backoff เมื่อเจอ 429/5xx และส่งแบบ reply ก่อน push
+    """
+
+    RETRY_STATUSES = LineClient.RETRY_STATUSES
+
+    def __init__(self, access_token, base_url=LINE_API_BASE, connect_timeout=3.05, read_timeout=10,
+                 retries=3, backoff=0.5, pool_size=100):
+        import httpx
+
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._transport_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+
+    async def _post(self, path, body, headers=None):
+        operation = path.rsplit("/", 1)[-1]
+        attempt = 0
+        while True:
+            if attempt:
+                UPSTREAM_RETRIES.inc(upstream="line", operation=operation)
+            try:
+                with track_upstream("line", operation):
+                    response = await self.client.post(f"{self.base_url}{path}", content=body, headers=headers)
+            except self._transport_errors:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    if response.status_code >= 400:
+                        UPSTREAM_ERRORS.inc(upstream="line", operation=operation)
+                    return response
+                UPSTREAM_ERRORS.inc(upstream="line", operation=operation)
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    await asyncio.sleep(int(retry_after))
+                    attempt += 1
+                    continue
+            await asyncio.sleep(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff))
+            attempt += 1
+
+    async def reply(self, reply_token, messages):
+        return await self._post("/v2/bot/message/reply", encode_body({"replyToken": reply_token}, messages))
+
+    async def push(self, user_id, messages):
+        headers = {"X-Line-Retry-Key": str(uuid.uuid4())}
+        return await self._post("/v2/bot/message/push", encode_body({"to": user_id}, messages), headers=headers)
+
+    async def send(self, user_id, messages, reply_token=None):
+        if reply_token:
+            try:
+                response = await self.reply(reply_token, messages)
+                if response.is_success:
+                    return response
+                logger.warning("reply ไม่สำเร็จ (%s) ส่งด้วย push แทน", response.status_code)
+            except self._transport_errors as e:
+                logger.warning("reply ไม่สำเร็จ (%s) ส่งด้วย push แทน", e)
+        return await self.push(user_id, messages)
+
+    async def close(self):
+        await self.client.aclose()
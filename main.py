@@ -1,10 +1,34 @@
-from flask import Flask, request, jsonify
-import requests
+import startup_profile  # ต้อง import ก่อน module อื่นเพื่อจับเวลา import ทั้งหมด (ดู /ready)
+from flask import Flask, Response, g, request, jsonify
 import os
-import google.auth
-from googleapiclient.discovery import build
-from google.cloud import bigquery  # สำหรับ BigQuery
 from dotenv import load_dotenv
+import atexit
+import hmac
+import logging
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import namedtuple
+from app_logging import MESSAGE_LOGGER_NAME, configure_logging, new_request_id, reset_request_id, set_request_id
+from google_clients import GoogleClients, is_transient_error
+from line_client import LineClient, LINE_API_BASE
+from material_catalog import FALLBACK_DENSITY, MaterialCatalog
+import metrics
+from metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS, timed
+from outbox import Outbox, group_events_by_user
+from price_table import PriceTable
+from pricing import (DEFAULT_COST_PER_KG, DimensionError, PartCache, format_dimensions, material_terms,
+                     parse_dimensions, quote, quote_batch, read_batch_rows, tier_prices)
+from quote_sink import QuoteSink
+from rate_limit import PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_QUOTE, OutboundScheduler
+from resilience import FAULTS, GuardedClient, Upstream
+from message_templates import TemplateError, TemplateRegistry
+from router import Router
+from session_store import create_session_store
+from webhook_parser import InvalidPayload, InvalidSignature, WebhookParser
+from worker_queue import create_event_queue
 
 # โหลด Environment Variables
 load_dotenv()
@@ -13,6 +37,7 @@ app = Flask(__name__)
 
 # Environment Variables
 LINE_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN")
+LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")  # ใช้ตรวจ X-Line-Signature
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")  # ID ของ Google Sheets
 SHEET_NAME = os.getenv("SHEET_NAME", "Data")   # ชื่อ sheet สำหรับข้อมูลทั่วไป
 MATERIAL_COSTS_SHEET = "MATERIAL_COSTS"         # ชื่อ sheet สำหรับ MATERIAL_COSTS
@@ -21,31 +46,181 @@ MATERIAL_COSTS_SHEET = "MATERIAL_COSTS"         # ชื่อ sheet สำห
 BIGQUERY_DATASET = os.getenv("BIGQUERY_DATASET")
 BIGQUERY_TABLE = os.getenv("BIGQUERY_TABLE")
 
-print("LINE_ACCESS_TOKEN:", LINE_ACCESS_TOKEN)
+# สำหรับตารางราคาวัสดุ: อายุ cache (วินาที) และไฟล์ snapshot สำหรับเริ่มระบบเร็ว
+PRICE_TABLE_TTL = float(os.getenv("PRICE_TABLE_TTL", "300"))
+PRICE_SNAPSHOT_PATH = os.getenv("PRICE_SNAPSHOT_PATH", "/tmp/line-webhook-bot/material_costs.json")
+# โฟลเดอร์ของ template ข้อความ (flex/carousel/location) ที่แก้ไขได้โดยไม่ต้อง deploy code ใหม่
+TEMPLATES_DIR = os.getenv("TEMPLATES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "line_templates"))
+# token สำหรับ endpoint /admin/* และ /quote/batch (ถ้าไม่ตั้งค่า endpoint จะถูกปิด)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# จำนวนรายการสูงสุดต่อคำขอ /quote/batch
+QUOTE_BATCH_MAX_ROWS = int(os.getenv("QUOTE_BATCH_MAX_ROWS", "5000"))
+# จำนวนสั่งผลิตในตารางราคาตามจำนวน และขนาดของ cache ผลคำนวณต่อชิ้นงาน
+QUOTE_TIERS = tuple(int(q) for q in os.getenv("QUOTE_TIERS", "100,500,1000,5000").split(",") if q.strip())
+PART_CACHE_SIZE = int(os.getenv("PART_CACHE_SIZE", "1024"))
 
-# เก็บข้อมูล session ของผู้ใช้
-USER_SESSIONS = {}
+# สำหรับการเขียนข้อมูลใบเสนอราคาแบบ batch (spool file ต้องอยู่บนดิสก์ที่เขียนได้ เช่น /tmp บน Cloud Run)
+QUOTE_SPOOL_PATH = os.getenv("QUOTE_SPOOL_PATH", "/tmp/line-webhook-bot/quotes.jsonl")
+QUOTE_BATCH_SIZE = int(os.getenv("QUOTE_BATCH_SIZE", "50"))
+QUOTE_FLUSH_INTERVAL = float(os.getenv("QUOTE_FLUSH_INTERVAL", "5"))
 
-# ตารางราคาวัสดุ (จะถูกโหลดจาก Google Sheets)
-MATERIAL_COSTS = {}
+# สำหรับ LINE Messaging API
+LINE_API_URL = os.getenv("LINE_API_URL", LINE_API_BASE)
+LINE_TIMEOUT = float(os.getenv("LINE_TIMEOUT", "10"))
+LINE_RETRIES = int(os.getenv("LINE_RETRIES", "3"))
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", "10"))
 
+# สำหรับ session แบบสอบถาม: "memory" หรือ URL ของ Redis เช่น redis://10.0.0.3:6379/0
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL", "memory")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))  # วินาทีที่ session ไม่มีความเคลื่อนไหวก่อนหมดอายุ
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+
+# จำ webhookEventId ไว้กี่วินาที/กี่รายการ เพื่อข้าม event ที่ LINE ส่งซ้ำ
+WEBHOOK_DEDUPE_TTL = float(os.getenv("WEBHOOK_DEDUPE_TTL", "600"))
+WEBHOOK_DEDUPE_SIZE = int(os.getenv("WEBHOOK_DEDUPE_SIZE", "10000"))
+
+# สำหรับคิวประมวลผล event: "inline" = ประมวลผลก่อนตอบ 200 (เดิม), "thread" = ตอบทันทีแล้วประมวลผลเบื้องหลัง
+# หรือ "module:callable" ของคิวแบบอื่น (ดู worker_queue.create_event_queue)
+EVENT_QUEUE_MODE = os.getenv("EVENT_QUEUE_MODE", "inline")
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+
+# สำหรับการป้องกันเมื่อ LINE/Sheets/BigQuery ขัดข้อง: ล้มเหลวติดต่อกันกี่ครั้งจึงตัดวงจร และตัดนานกี่วินาที
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "5"))
+UPSTREAM_RESET_TIMEOUT = float(os.getenv("UPSTREAM_RESET_TIMEOUT", "30"))
+# timeout (วินาที) ต่อคำขอ, จำนวนครั้งที่ลองสูงสุด และจำนวนคำขอพร้อมกันสูงสุดของ Google API
+GOOGLE_TIMEOUT = float(os.getenv("GOOGLE_TIMEOUT", "20"))
+GOOGLE_ATTEMPTS = int(os.getenv("GOOGLE_ATTEMPTS", "3"))
+GOOGLE_MAX_CONCURRENCY = int(os.getenv("GOOGLE_MAX_CONCURRENCY", "4"))
+LINE_MAX_CONCURRENCY = int(os.getenv("LINE_MAX_CONCURRENCY", str(LINE_POOL_SIZE)))
+# endpoint ของ Sheets/BigQuery สำหรับทดสอบกับ service จำลอง (เช่น http://127.0.0.1:9001) ใช้ credentials แบบ anonymous
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")
+BIGQUERY_API_ENDPOINT = os.getenv("BIGQUERY_API_ENDPOINT")
+GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
+# จำกัดอัตราการส่งข้อความขาออก (คำขอ/วินาที และจำนวนที่ส่งติดกันได้) ต่อ channel และต่อ user (rate 0 = ไม่จำกัด)
+OUTBOUND_CHANNEL_RATE = float(os.getenv("OUTBOUND_CHANNEL_RATE", "100"))
+OUTBOUND_CHANNEL_BURST = int(os.getenv("OUTBOUND_CHANNEL_BURST", "200"))
+OUTBOUND_USER_RATE = float(os.getenv("OUTBOUND_USER_RATE", "1"))
+OUTBOUND_USER_BURST = int(os.getenv("OUTBOUND_USER_BURST", "10"))
+# จำนวนการส่งที่รอในคิวได้ และเวลารอสูงสุด (วินาที) ก่อนทิ้งข้อความ priority ต่ำ (เมนู/FAQ) และข้อความทั่วไป
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "5000"))
+OUTBOUND_LOW_MAX_DELAY = float(os.getenv("OUTBOUND_LOW_MAX_DELAY", "10"))
+# จำลองความขัดข้องสำหรับทดสอบ เช่น "sheets:error=1;line:latency=0.5" (ห้ามตั้งบน production)
+FAULT_INJECTION = os.getenv("FAULT_INJECTION", "")
+
+# สำหรับ logging: ระดับ log, รูปแบบ ("json" สำหรับ Cloud Logging หรือ "text") และสัดส่วนที่เก็บ log ราย message
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_MESSAGE_SAMPLE_RATE = float(os.getenv("LOG_MESSAGE_SAMPLE_RATE", "0.1"))
+
+# log ถูกเขียนออกโดย thread แยก และ token/secret/PII ถูกปิดบังก่อนเขียน
+configure_logging(
+    level=LOG_LEVEL,
+    fmt=LOG_FORMAT,
+    message_sample_rate=LOG_MESSAGE_SAMPLE_RATE,
+    secrets=(LINE_ACCESS_TOKEN, LINE_CHANNEL_SECRET, ADMIN_TOKEN)
+)
+logger = logging.getLogger("line_webhook_bot")
+# log ข้อความเข้า/ออกราย message (ถูกสุ่มเก็บตาม LOG_MESSAGE_SAMPLE_RATE)
+message_log = logging.getLogger(MESSAGE_LOGGER_NAME)
+
+# client เดียวใช้ร่วมกันทั้งโปรเซส (connection pool แบบ keep-alive)
+LINE_CLIENT = LineClient(
+    LINE_ACCESS_TOKEN,
+    base_url=LINE_API_URL,
+    read_timeout=LINE_TIMEOUT,
+    retries=LINE_RETRIES,
+    pool_size=LINE_POOL_SIZE
+)
+
+# client ของ Google Sheets/BigQuery สร้างครั้งเดียวเมื่อใช้งานครั้งแรก
+GOOGLE_CLIENTS = GoogleClients(
+    timeout=GOOGLE_TIMEOUT,
+    sheets_endpoint=SHEETS_API_ENDPOINT,
+    bigquery_endpoint=BIGQUERY_API_ENDPOINT,
+    project=GOOGLE_CLOUD_PROJECT
+)
+
+# circuit breaker + bulkhead + retry แยกของแต่ละ dependency: ตัวหนึ่งล่มแล้วตัวอื่นยังทำงานต่อได้
+# (LINE retry อยู่ใน LineClient แล้ว จึงไม่ retry ซ้ำที่ชั้นนี้)
+UPSTREAMS = {
+    "line": Upstream(
+        "line",
+        max_concurrent=LINE_MAX_CONCURRENCY,
+        failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+        reset_timeout=UPSTREAM_RESET_TIMEOUT,
+        is_failure_result=lambda response: response.status_code == 429 or response.status_code >= 500
+    ),
+    "sheets": Upstream(
+        "sheets",
+        max_concurrent=GOOGLE_MAX_CONCURRENCY,
+        failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+        reset_timeout=UPSTREAM_RESET_TIMEOUT,
+        attempts=GOOGLE_ATTEMPTS,
+        retry_on=is_transient_error
+    ),
+    "bigquery": Upstream(
+        "bigquery",
+        max_concurrent=GOOGLE_MAX_CONCURRENCY,
+        failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+        reset_timeout=UPSTREAM_RESET_TIMEOUT,
+        attempts=GOOGLE_ATTEMPTS,
+        retry_on=is_transient_error
+    ),
+}
+GUARDED_LINE_CLIENT = GuardedClient(LINE_CLIENT, UPSTREAMS["line"])
+# ทุกการส่งข้อความ (ทั้ง Flask และ ASGI) ผ่านคิวนี้: จำกัดอัตราต่อ user/channel และส่งข้อความใบเสนอราคาก่อนเมนู/FAQ
+OUTBOUND = OutboundScheduler(
+    channel_rate=OUTBOUND_CHANNEL_RATE,
+    channel_burst=OUTBOUND_CHANNEL_BURST,
+    user_rate=OUTBOUND_USER_RATE,
+    user_burst=OUTBOUND_USER_BURST,
+    max_queue=OUTBOUND_QUEUE_SIZE,
+    max_delay={PRIORITY_LOW: OUTBOUND_LOW_MAX_DELAY},
+    workers=LINE_MAX_CONCURRENCY
+)
+FAULTS.configure(FAULT_INJECTION)
+if FAULT_INJECTION:
+    logger.warning("เปิด FAULT_INJECTION: %s", FAULTS.stats())
+
+# ตรวจลายเซ็นและแปลง request ของ webhook
+WEBHOOK_PARSER = WebhookParser(
+    LINE_CHANNEL_SECRET,
+    dedupe_ttl=WEBHOOK_DEDUPE_TTL,
+    dedupe_size=WEBHOOK_DEDUPE_SIZE
+)
+if not LINE_CHANNEL_SECRET:
+    logger.warning("ไม่ได้ตั้งค่า LINE_CHANNEL_SECRET: จะไม่ตรวจ X-Line-Signature ของ webhook")
+
+# Outbox ของ user ที่กำลังประมวลผลใน thread นี้ (ข้อความจะถูกรวมส่งตอนจบ)
+_event_context = threading.local()
+
+# template ข้อความ โหลดและ serialise ครั้งเดียวตอนเริ่มโปรเซส
+TEMPLATES = TemplateRegistry(TEMPLATES_DIR)
+TEMPLATES.load()
+
+# ตาราง route ของคำสั่ง (handler ลงทะเบียนด้วย decorator ด้านล่าง)
+ROUTER = Router()
+
+# เก็บข้อมูล session ของผู้ใช้ (ในหน่วยความจำ หรือ Redis เมื่อรันหลาย instance)
+SESSION_STORE = create_session_store(SESSION_STORE_URL, ttl=SESSION_TTL, max_sessions=SESSION_MAX)
+
+@timed("load_material_costs")
 def load_material_costs():
     """
     ดึงข้อมูลวัสดุและราคาจาก Google Sheets จาก sheet MATERIAL_COSTS
     โดยคาดว่าข้อมูลเริ่มที่แถวที่ 2 โดย:
       - คอลัมน์ A: Material (ชื่อวัสดุ)
       - คอลัมน์ B: Cost (ราคา)
+      - คอลัมน์ C: Density (g/cm³, ไม่บังคับ ถ้าไม่ระบุจะใช้ค่ามาตรฐานของวัสดุนั้น)
     """
-    print("Start loading MATERIAL_COSTS...")
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-    credentials, _ = google.auth.default(scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=credentials)
-    range_name = f"{MATERIAL_COSTS_SHEET}!A2:B"
-    result = service.spreadsheets().values().get(
+    logger.info("Start loading MATERIAL_COSTS...")
+    service = GOOGLE_CLIENTS.sheets()
+    range_name = f"{MATERIAL_COSTS_SHEET}!A2:C"
+    result = UPSTREAMS["sheets"].call(GOOGLE_CLIENTS.execute_sheets, service.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
         range=range_name
-    ).execute()
-    print("Result from Sheets API:", result)
+    ), "sheets.get")
     values = result.get("values", [])
     costs = {}
     for row in values:
@@ -55,10 +230,57 @@ def load_material_costs():
                 cost = float(row[1].strip())
             except ValueError:
                 cost = 0
-            costs[material] = cost
-    print("Loaded MATERIAL_COSTS:", costs)
+            density = None
+            if len(row) >= 3 and row[2].strip():
+                try:
+                    density = float(row[2].strip())
+                except ValueError:
+                    density = None
+            costs[material] = {"cost": cost, "density": density} if density else cost
+    logger.info("Loaded MATERIAL_COSTS: %d materials", len(costs))
+    logger.debug("MATERIAL_COSTS: %s", costs)
     return costs
 
+# ตารางราคาวัสดุ (โหลดจาก Google Sheets ในเบื้องหลัง และ refresh ทุก PRICE_TABLE_TTL วินาที)
+PRICE_TABLE = PriceTable(
+    load_material_costs,
+    ttl=PRICE_TABLE_TTL,
+    snapshot_path=PRICE_SNAPSHOT_PATH
+)
+
+# แคตตาล็อกวัสดุ (index สำหรับค้นหา + ราคา + ความหนาแน่น) สร้างใหม่ทุกครั้งที่ตารางราคาเปลี่ยน
+MATERIAL_CATALOG = MaterialCatalog([])
+
+# ผลคำนวณต่อชิ้นงาน (ปริมาตร/น้ำหนัก/ตารางราคาตามจำนวน) ตาม (วัสดุ, ขนาด, version ของตารางราคา)
+PART_CACHE = PartCache(max_size=PART_CACHE_SIZE)
+
+def rebuild_material_catalog(table, version):
+    global MATERIAL_CATALOG
+    MATERIAL_CATALOG = MaterialCatalog.from_table(table, version=version)
+    PART_CACHE.clear()
+    if table:
+        startup_profile.mark("price_table_ready")
+
+PRICE_TABLE.add_listener(rebuild_material_catalog)
+
+def get_material_catalog():
+    PRICE_TABLE.get()  # สั่ง refresh เบื้องหลังเมื่อราคาเก่าเกิน TTL
+    return MATERIAL_CATALOG
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # ใช้ rule ของ route (ไม่ใช่ path จริง) เพื่อไม่ให้จำนวน label โตตาม URL ที่ถูกยิงเข้ามา
+    path = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUESTS.inc(path=path, status=response.status_code)
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path)
+    return response
+
 @app.route("/", methods=["GET"])
 def home():
     return "LINE Webhook is running", 200
@@ -66,40 +288,246 @@ def home():
 @app.route("/webhook", methods=["POST"])
 def webhook():
     if request.method == "POST":
-        data = request.json
-        print("📩 Received:", data)
-        for event in data.get("events", []):
-            user_id = event["source"]["userId"]
-            if "message" in event:
-                message_text = event["message"]["text"].strip()
-                print(f"📩 ข้อความจาก {user_id}: {message_text}")
-
-                # คำสั่งสำหรับ Contact และ FAQ
-                if message_text.lower() == "ติดต่อเรา":
-                    send_contact_menu(user_id)
-                    continue
-                if message_text.upper().startswith("FAQ"):
-                    process_faq(user_id, message_text)
-                    continue
-                # คำสั่งสำหรับ สินค้าและบริการ
-                if message_text.lower() == "สินค้าและบริการ":
-                    send_services_menu(user_id)
-                    continue
-                if message_text in ["บริการของเรา", "สินค้าตัวอย่าง", "กระบวนการผลิตสินค้า"]:
-                    process_services(user_id, message_text)
-                    continue
-                # คำสั่งเริ่มต้นการคำนวณ
-                if message_text.lower() == "คำนวณราคา":
-                    start_questionnaire(user_id)
-                else:
-                    process_response(user_id, message_text)
+        try:
+            # ตรวจลายเซ็นจาก body ดิบก่อน parse JSON และตัด event ที่ LINE ส่งซ้ำ
+            events = WEBHOOK_PARSER.parse(request.get_data(), request.headers.get("X-Line-Signature"))
+        except InvalidSignature:
+            return jsonify({"error": "Invalid signature"}), 403
+        except InvalidPayload:
+            return jsonify({"error": "Bad Request"}), 400
+        logger.info("Received %d events", len(events))
+        groups = group_events_by_user(events)
+        try:
+            # event ของ user เดียวกันใน payload นี้จะถูกประมวลผลรวมกันและตอบกลับในคำขอเดียว
+            while groups:
+                user_id, user_events = groups[0]
+                EVENT_QUEUE.submit(user_id, (user_id, user_events))
+                groups.pop(0)
+        except queue.Full:
+            # คิวเต็ม: ให้ LINE ส่งซ้ำภายหลังแทนการรอจน timeout (event ที่ยังไม่เข้าคิวต้องไม่ถูกนับว่าซ้ำ)
+            WEBHOOK_PARSER.forget([event for _, user_events in groups for event in user_events])
+            return jsonify({"error": "Busy"}), 503
         return jsonify({"status": "ok"}), 200
     else:
         return jsonify({"error": "Method Not Allowed"}), 405
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """readiness probe: 200 เมื่อพร้อมคำนวณราคาและบันทึกใบเสนอราคา, 503 ระหว่าง warm-up"""
+    status = readiness()
+    return jsonify(status), 200 if status["ready"] else 503
+
+def readiness():
+    """ความพร้อมของตารางราคา (จาก snapshot หรือ Sheets) และ client ของ Google พร้อมเวลาเริ่มระบบ"""
+    price_table = PRICE_TABLE.stats()
+    clients = GOOGLE_CLIENTS.ready()
+    price_table_ready = price_table["materials"] > 0
+    clients_ready = all(clients[name] for name in ("credentials", "sheets", "bigquery"))
+    return {
+        "ready": price_table_ready and clients_ready,
+        "price_table": {
+            "ready": price_table_ready,
+            "source": price_table["source"],
+            "version": price_table["version"],
+            "last_error": price_table["last_error"],
+        },
+        "google_clients": dict(clients, ready=clients_ready),
+        "startup": startup_profile.report(top=10),
+    }
+
+def warm_up_google_clients(max_delay=60):
+    """import library และสร้าง client ของ Google ในเบื้องหลัง (ลองใหม่แบบ backoff จนสำเร็จ)"""
+    delay = 1
+    while True:
+        try:
+            GOOGLE_CLIENTS.warm_up()
+        except Exception as e:
+            logger.warning("เตรียม client ของ Google ไม่สำเร็จ ลองใหม่ใน %d วินาที: %s", delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+        else:
+            startup_profile.mark("google_clients_ready")
+            logger.info("client ของ Google พร้อมใช้งาน (%.2f วินาที)", GOOGLE_CLIENTS.build_seconds["warm_up"])
+            return
+
+def check_admin_token(authorization):
+    """คืน (payload, status) ของ error เมื่อ header Authorization ไม่ตรงกับ ADMIN_TOKEN หรือ None เมื่อผ่าน"""
+    if not ADMIN_TOKEN:
+        return {"error": "Not Found"}, 404
+    if not hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+        return {"error": "Unauthorized"}, 401
+    return None
+
+@app.route("/admin/prices/refresh", methods=["POST"])
+def refresh_prices():
+    """บังคับโหลดตารางราคาใหม่จาก Google Sheets (ต้องส่ง Authorization: Bearer <ADMIN_TOKEN>)"""
+    denied = check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    ok = PRICE_TABLE.refresh()
+    return jsonify({"status": "ok" if ok else "failed", "price_table": PRICE_TABLE.stats()}), 200 if ok else 502
+
+@app.route("/admin/templates/reload", methods=["POST"])
+def reload_templates():
+    """โหลด template ข้อความใหม่จาก TEMPLATES_DIR (ต้องส่ง Authorization: Bearer <ADMIN_TOKEN>)"""
+    denied = check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    try:
+        count = TEMPLATES.reload()
+    except TemplateError as e:
+        # ไฟล์ผิดรูปแบบหรือเกินข้อจำกัดของ LINE: ใช้ template ชุดเดิมต่อไป
+        return jsonify({"status": "failed", "error": str(e)}), 400
+    return jsonify({"status": "ok", "templates": count}), 200
+
+@app.route("/quote/batch", methods=["POST"])
+def quote_batch_endpoint():
+    """
+    คำนวณราคาหลายรายการ (เช่น BOM ทั้งชุด) จาก CSV หรือ JSON ด้วยสูตรเดียวกับแชท
+    (ต้องส่ง Authorization: Bearer <ADMIN_TOKEN>)
+    """
+    denied = check_admin_token(request.headers.get("Authorization"))
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    payload, status = batch_quote(request.get_data(), request.content_type)
+    return jsonify(payload), status
+
+@timed("batch_quote")
+def batch_quote(body, content_type):
+    """คืน (payload, status) ของ /quote/batch (ใช้ร่วมกับ ASGI app ใน chatbot_line.py)"""
+    try:
+        rows = read_batch_rows(body, content_type)
+    except ValueError as e:
+        return {"error": f"Bad Request: {e}"}, 400
+    if len(rows) > QUOTE_BATCH_MAX_ROWS:
+        return {"error": f"รายการเกิน {QUOTE_BATCH_MAX_ROWS} รายการต่อคำขอ"}, 413
+    catalog = get_material_catalog()
+    if not len(catalog):
+        return {"error": "ตารางราคายังโหลดไม่เสร็จ"}, 503
+    items = quote_batch(rows, catalog)
+    quoted = [item for item in items if "error" not in item]
+    return {
+        "price_table_version": catalog.version,
+        "count": len(items),
+        "errors": len(items) - len(quoted),
+        "total_cost": sum(item["total_cost"] for item in quoted),
+        "items": items
+    }, 200
+
+def stats_payload():
+    """ข้อมูลของ GET /stats (ใช้ร่วมกับ chatbot_line.py ทั้งสองแอปจึงรายงานข้อมูลชุดเดียวกัน)"""
+    return {
+        "webhook": WEBHOOK_PARSER.stats(),
+        "event_queue": EVENT_QUEUE.stats(),
+        "google_clients": GOOGLE_CLIENTS.stats(),
+        "quote_sink": QUOTE_SINK.stats(),
+        "price_table": PRICE_TABLE.stats(),
+        "sessions": SESSION_STORE.stats(),
+        "part_cache": PART_CACHE.stats(),
+        "upstreams": {name: upstream.stats() for name, upstream in UPSTREAMS.items()},
+        "faults": FAULTS.stats(),
+        "outbound": OUTBOUND.stats(),
+        "routes": ROUTER.stats()
+    }
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(stats_payload()), 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@timed("handle_events")
+def handle_events(item):
+    """
+    ประมวลผล event ทั้งหมดของ user หนึ่งคนจาก webhook payload เดียวกันตามลำดับ
+    ถูกเรียกจาก EVENT_QUEUE (ใน request เดิมหรือใน worker เบื้องหลัง ขึ้นกับ EVENT_QUEUE_MODE)
+    ข้อความที่ handler สร้างจะถูกเก็บใน Outbox แล้วส่งรวมครั้งเดียว (ครั้งละไม่เกิน 5 ข้อความ)
+    """
+    user_id, events = item
+    token = set_request_id(event_request_id(events))
+    try:
+        outbox = process_events(user_id, events)
+        flush_outbox(outbox)
+    finally:
+        reset_request_id(token)
+
+def event_request_id(events):
+    """
+    request id ของ event ชุดหนึ่ง (ใช้ webhookEventId ของ event แรก) ติดไปกับทุก log ระหว่างประมวลผล
+    รวมถึงคำขอขาออกไปยัง LINE/Sheets/BigQuery ทำให้ไล่ log ของ event เดียวกันได้
+    """
+    for event in events:
+        if event.get("webhookEventId"):
+            return event["webhookEventId"]
+    return new_request_id()
+
+def process_events(user_id, events):
+    """
+    เรียก handler ของทุก event แล้วคืน Outbox ที่ยังไม่ได้ส่ง
+    (แยกจาก handle_events เพื่อให้ ASGI app ใน chatbot_line.py ส่งต่อด้วย async client ได้)
+    """
+    outbox = Outbox(user_id)
+    _event_context.outbox = outbox
+    try:
+        for event in events:
+            outbox.add_reply_token(event.get("replyToken"))
+            try:
+                handle_event(event)
+            except Exception as e:
+                # event ที่ผิดพลาดไม่ควรทำให้ event ถัดไปของ user เดียวกันหายไป
+                logger.exception("ประมวลผล event ของ %s ไม่สำเร็จ: %s", user_id, e,
+                                 extra={"event_id": event.get("webhookEventId")})
+    finally:
+        _event_context.outbox = None
+    return outbox
+
+def handle_event(event):
+    """
+    ประมวลผล event เดียวจาก LINE webhook ผ่าน ROUTER
+    คำสั่งข้อความถูกลงทะเบียนด้วย @ROUTER.exact/prefix/regex ที่ handler แต่ละตัว
+    ข้อความที่ไม่ตรงคำสั่งใดจะไปที่ process_response (คำตอบของแบบสอบถาม)
+    """
+    user_id = event.get("source", {}).get("userId")
+    message = event.get("message", {})
+    if message.get("type") == "text":
+        message_log.info("📩 ข้อความจาก %s: %s", user_id, message.get("text", "").strip(),
+                         extra={"event_id": event.get("webhookEventId")})
+    if not ROUTER.dispatch(event):
+        logger.info("ไม่มี handler สำหรับ event ชนิด %s จาก %s", event.get("type"), user_id)
+
+# event ของ user เดียวกันจะถูกประมวลผลตามลำดับเสมอ (ดู worker_queue.EventQueue)
+EVENT_QUEUE = create_event_queue(
+    handle_events,
+    mode=EVENT_QUEUE_MODE,
+    workers=EVENT_WORKERS,
+    maxsize=EVENT_QUEUE_SIZE
+)
+
+# ------------------ ฟังก์ชันสำหรับ event ที่ไม่ใช่ข้อความ ------------------
+
+@ROUTER.event("follow")
+def send_welcome(user_id, event=None):
+    send_message(
+        user_id,
+        "👋 ขอบคุณที่เพิ่มเราเป็นเพื่อน\n\n"
+        "พิมพ์คำสั่งที่ต้องการ:\n"
+        "คำนวณราคา\n"
+        "สินค้าและบริการ\n"
+        "ติดต่อเรา",
+        priority=PRIORITY_LOW
+    )
+
+@ROUTER.event("message:image", "message:video", "message:audio", "message:file", "message:sticker", "message:location")
+def reply_unsupported_message(user_id, event=None):
+    send_message(user_id, "ขออภัย ระบบตอบกลับได้เฉพาะข้อความ\nกรุณาพิมพ์ 'คำนวณราคา', 'สินค้าและบริการ' หรือ 'ติดต่อเรา'",
+                 priority=PRIORITY_LOW)
+
 # ------------------ ฟังก์ชันสำหรับ Contact & FAQ ------------------
 
-def send_contact_menu(user_id):
+@ROUTER.exact("ติดต่อเรา")
+def send_contact_menu(user_id, message_text=None):
     text = (
         "📞 ติดต่อเรา\n\n"
         "โปรดพิมพ์ FAQ ที่ต้องการ:\n"
@@ -109,261 +537,135 @@ def send_contact_menu(user_id):
         "FAQ 4: ที่อยู่\n"
         "FAQ 5: พิกัด"
     )
-    send_message(user_id, text)
-
-def process_faq(user_id, message_text):
-    faq = message_text.strip().upper()
-    if faq == "FAQ 1":
-        send_message(user_id, "📧 Email: bestwellplastic@gmail.com")
-    elif faq == "FAQ 2":
-        send_message(user_id, "📞 โทรศัพท์: 02 813 8773")
-    elif faq == "FAQ 3":
-        send_message(user_id, "⏰ เวลาทำการ:\nวันจันทร์ – วันเสาร์\nเวลา 8.00 - 17.00 น.\n(ปิดทำการทุกวันอาทิตย์)")
-    elif faq == "FAQ 4":
-        send_message(user_id, "🏠 ที่อยู่:\n135/3 หมู่ 13 ซอยเพชรเกษม 91 แยก12\nต.อ้อมน้อย, อ.กระทุ่มแบน, จ.สมุทรสาคร 74130")
-    elif faq == "FAQ 5":
-        send_location(user_id)
-    else:
-        send_message(user_id, "❌ ไม่พบ FAQ ที่ต้องการ กรุณาพิมพ์ใหม่ เช่น 'FAQ 1'")
-
-def send_location(user_id):
-    location_msg = {
-        "type": "location",
-        "title": "บริษัท เบสท์ เวลล์ พลาสติก จำกัด",
-        "address": "135/3-4 หมู่ 13 ถ.เพชรเกษม 91 ต.อ้อมน้อย อ.กระทุ่มแบน จ.สมุทรสาคร",
-        "latitude": 13.697285427411833,
-        "longitude": 100.31582319730443
-    }
-    headers = {"Authorization": f"Bearer {LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    message = {"to": user_id, "messages": [location_msg]}
-    response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, json=message)
-    print(f"📤 ส่ง location ไปที่ {user_id}: {location_msg}")
-    print(f"📡 LINE Response: {response.status_code} {response.text}")
+    send_message(user_id, text, priority=PRIORITY_LOW)
+
+@ROUTER.exact("FAQ 1")
+def faq_email(user_id, message_text=None):
+    send_message(user_id, "📧 Email: bestwellplastic@gmail.com", priority=PRIORITY_LOW)
+
+@ROUTER.exact("FAQ 2")
+def faq_phone(user_id, message_text=None):
+    send_message(user_id, "📞 โทรศัพท์: 02 813 8773", priority=PRIORITY_LOW)
+
+@ROUTER.exact("FAQ 3")
+def faq_hours(user_id, message_text=None):
+    send_message(user_id, "⏰ เวลาทำการ:\nวันจันทร์ – วันเสาร์\nเวลา 8.00 - 17.00 น.\n(ปิดทำการทุกวันอาทิตย์)", priority=PRIORITY_LOW)
+
+@ROUTER.exact("FAQ 4")
+def faq_address(user_id, message_text=None):
+    send_message(user_id, "🏠 ที่อยู่:\n135/3 หมู่ 13 ซอยเพชรเกษม 91 แยก12\nต.อ้อมน้อย, อ.กระทุ่มแบน, จ.สมุทรสาคร 74130", priority=PRIORITY_LOW)
+
+@ROUTER.prefix("FAQ")
+def faq_not_found(user_id, message_text=None):
+    send_message(user_id, "❌ ไม่พบ FAQ ที่ต้องการ กรุณาพิมพ์ใหม่ เช่น 'FAQ 1'", priority=PRIORITY_LOW)
+
+@ROUTER.exact("FAQ 5")
+def send_location(user_id, message_text=None):
+    location_msg = TEMPLATES.render("location")
+    send_line_messages(user_id, [location_msg], priority=PRIORITY_LOW)
+    message_log.info("📤 ส่ง location ไปที่ %s", user_id)
 
 # ------------------ ฟังก์ชันสำหรับ สินค้าและบริการ ------------------
 
-def send_services_menu(user_id):
-    flex_message = {
-        "type": "flex",
-        "altText": "สินค้าและบริการ",
-        "contents": {
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": "สินค้าและบริการ", "weight": "bold", "size": "lg", "align": "center"},
-                    {"type": "text", "text": "โปรดเลือกหนึ่งในตัวเลือกด้านล่าง:", "size": "sm", "margin": "md", "align": "center"},
-                    {"type": "button", "style": "primary", "action": {"type": "message", "label": "บริการของเรา", "text": "บริการของเรา"}, "margin": "lg"},
-                    {"type": "button", "style": "primary", "action": {"type": "message", "label": "สินค้าตัวอย่าง", "text": "สินค้าตัวอย่าง"}, "margin": "md"},
-                    {"type": "button", "style": "primary", "action": {"type": "message", "label": "กระบวนการผลิตสินค้า", "text": "กระบวนการผลิตสินค้า"}, "margin": "md"}
-                ]
-            }
-        }
-    }
+@ROUTER.exact("สินค้าและบริการ")
+def send_services_menu(user_id, message_text=None):
+    flex_message = TEMPLATES.render("services_menu")
     send_flex_message(user_id, flex_message)
 
-def process_services(user_id, message_text):
-    if message_text == "บริการของเรา":
-        flex_message = {
-            "type": "flex",
-            "altText": "บริการของเรา",
-            "contents": {
-                "type": "bubble",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {"type": "text", "size": "md", "text": "บริการของเรา", "align": "center", "weight": "bold"},
-                        {"margin": "md", "type": "text", "text": "1. ออกแบบและผลิตแม่พิมพ์"},
-                        {"margin": "md", "type": "text", "text": "2. รับผลิตชิ้นส่วนพลาสติก"},
-                        {"margin": "md", "type": "text", "text": "3. บริการให้คำปรึกษา"},
-                        {"margin": "lg", "type": "separator"},
-                        {"type": "box", "layout": "vertical", "margin": "xl", "contents": [
-                            {"type": "text", "align": "center", "weight": "bold", "size": "md", "text": "เปลี่ยนไอเดียของคุณให้เป็นจริง", "color": "#1DB446"},
-                            {"type": "text", "margin": "md", "align": "center", "weight": "bold", "size": "md", "text": "ออกแบบและผลิตไปกับเรา", "color": "#1DB446"}
-                        ]}
-                    ]
-                }
-            }
-        }
-        send_flex_message(user_id, flex_message)
-    elif message_text == "สินค้าตัวอย่าง":
-        flex_message = {
-            "template": {
-                "columns": [
-                    {
-                        "defaultAction": {"label": "View detail", "type": "uri", "uri": "https://bestwellplastic.com/product-category/best-seller/"},
-                        "imageBackgroundColor": "#000000",
-                        "actions": [{"type": "uri", "uri": "https://bestwellplastic.com/product-category/best-seller/", "label": "View detail"}],
-                        "text": "เปลี่ยนแนวคิดให้เป็นบรรจุภัณฑ์ที่จับต้องได้",
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2025/03/1678569-247x296.jpg",
-                        "title": "BEST SELLER"
-                    },
-                    {
-                        "text": "สร้างสรรค์ดีไซน์ พัฒนาแบรนด์ ผ่าน Packaging ที่ใช่",
-                        "defaultAction": {"uri": "https://bestwellplastic.com/product-category/packaging/", "label": "View detail", "type": "uri"},
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/packing-247x296.png",
-                        "actions": [{"uri": "https://bestwellplastic.com/product-category/packaging/", "label": "View detail", "type": "uri"}],
-                        "title": "Packaging",
-                        "imageBackgroundColor": "#FFFFFF"
-                    },
-                    {
-                        "imageBackgroundColor": "#000000",
-                        "actions": [{"type": "uri", "uri": "https://bestwellplastic.com/product-category/fanpart/", "label": "View detail"}],
-                        "title": "FAN PART",
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2022/08/fan-cat-copy.jpg",
-                        "defaultAction": {"uri": "https://bestwellplastic.com/product-category/fanpart/", "label": "View detail", "type": "uri"},
-                        "text": "ออกแบบเพื่อการใช้งานยาวนาน เย็นได้เต็มประสิทธิภาพ"
-                    },
-                    {
-                        "defaultAction": {"uri": "https://bestwellplastic.com/product-category/car-accessory/", "label": "View detail", "type": "uri"},
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/Car-Accessory-247x296.png",
-                        "title": "Car Accessory",
-                        "actions": [{"type": "uri", "uri": "https://bestwellplastic.com/product-category/car-accessory/", "label": "View detail"}],
-                        "imageBackgroundColor": "#000000",
-                        "text": "ออกแบบเพื่อความแกร่ง ผลิตเพื่อความมั่นใจ"
-                    },
-                    {
-                        "actions": [{"type": "uri", "uri": "https://bestwellplastic.com/product-category/pump-motor-parts/", "label": "View detail"}],
-                        "defaultAction": {"uri": "https://bestwellplastic.com/product-category/pump-motor-parts/", "label": "View detail", "type": "uri"},
-                        "text": "นวัตกรรมที่พัฒนาเพื่อการทำงานที่เสถียรและทรงพลัง",
-                        "title": "Pump motor parts",
-                        "imageBackgroundColor": "#000000",
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/pum-247x296.png"
-                    },
-                    {
-                        "title": "a Christmas tree",
-                        "imageBackgroundColor": "#000000",
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/crismas-247x296.png",
-                        "defaultAction": {"type": "uri", "label": "View detail", "uri": "https://bestwellplastic.com/product-category/spare-a-christmas-tree/"},
-                        "text": "ส่งต่อความสุขผ่านต้นคริสต์มาสที่สมบูรณ์แบบ",
-                        "actions": [{"uri": "https://bestwellplastic.com/product-category/spare-a-christmas-tree/", "type": "uri", "label": "View detail"}]
-                    },
-                    {
-                        "actions": [{"label": "View detail", "type": "uri", "uri": "https://bestwellplastic.com/product-category/agricultural/"}],
-                        "defaultAction": {"type": "uri", "uri": "https://bestwellplastic.com/product-category/agricultural/", "label": "View detail"},
-                        "title": "Agricultural",
-                        "imageBackgroundColor": "#000000",
-                        "text": "ขับเคลื่อนการเกษตรด้วยนวัตกรรมและดีไซน์ล้ำสมัย",
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/Agricultural-equipment-1-247x296.png"
-                    },
-                    {
-                        "title": "Auto Parts",
-                        "text": "ทนทานทุกการใช้งาน ยาวนานทุกการขับเคลื่อน",
-                        "actions": [{"type": "uri", "label": "View detail", "uri": "https://bestwellplastic.com/product-category/auto-parts/"}],
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/Auto-Parts-247x296.png",
-                        "imageBackgroundColor": "#000000",
-                        "defaultAction": {"uri": "https://bestwellplastic.com/product-category/auto-parts/", "label": "View detail", "type": "uri"}
-                    },
-                    {
-                        "title": "Packing media",
-                        "text": "แข็งแกร่งทุกชิ้นงาน รองรับทุกสภาวะการใช้งาน",
-                        "defaultAction": {"type": "uri", "label": "View detail", "uri": "https://bestwellplastic.com/product-category/packing-media/"},
-                        "actions": [{"uri": "https://bestwellplastic.com/product-category/packing-media/", "label": "View detail", "type": "uri"}],
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2021/08/sddsfd-247x296.png",
-                        "imageBackgroundColor": "#000000"
-                    },
-                    {
-                        "thumbnailImageUrl": "https://bestwellplastic.com/wp-content/uploads/2018/09/Sanitary-product-247x296.png",
-                        "actions": [{"type": "uri", "uri": "https://bestwellplastic.com/product-category/sanitary-product/", "label": "View detail"}],
-                        "defaultAction": {"type": "uri", "uri": "https://bestwellplastic.com/product-category/sanitary-product/", "label": "View detail"},
-                        "imageBackgroundColor": "#000000",
-                        "title": "Sanitary product",
-                        "text": "ก้าวล้ำด้วยเทคโนโลยี สะอาดทุกสัมผัส"
-                    }
-                ],
-                "imageSize": "cover",
-                "type": "carousel",
-                "imageAspectRatio": "rectangle"
-            },
-            "altText": "this is a carousel template",
-            "type": "template"
-        }
-        send_flex_message(user_id, flex_message)
-    elif message_text == "กระบวนการผลิตสินค้า":
-        flex_message = {
-            "type": "flex",
-            "altText": "Steps to order and design a mold",
-            "contents": {
-                "type": "bubble",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {"type": "text", "align": "center", "text": "ขั้นตอนการสั่งผลิตและออกแบบแม่พิมพ์", "size": "sm", "weight": "bold"},
-                        {"type": "text", "margin": "sm", "text": "1. เปิด PO (Purchase Order)"},
-                        {"type": "text", "margin": "sm", "text": "2. ชำระเงิน"},
-                        {"type": "text", "margin": "sm", "text": "3. เริ่มการผลิต"},
-                        {"type": "text", "margin": "sm", "text": "4. ใช้ระยะเวลาการผลิต 15-30 วัน"},
-                        {"type": "text", "margin": "sm", "text": "5. บรรจุและจัดส่ง"},
-                        {"margin": "lg", "type": "separator"},
-                        {"layout": "vertical", "contents": [
-                            {"type": "text", "align": "center", "weight": "bold", "size": "sm", "text": "เปลี่ยนไอเดียของคุณให้เป็นจริง", "color": "#1DB446"},
-                            {"type": "text", "margin": "md", "align": "center", "color": "#1DB446", "weight": "bold", "size": "sm", "text": "ออกแบบและผลิตไปกับเรา"}
-                        ], "margin": "xl", "type": "box"}
-                    ]
-                }
-            }
-        }
-        send_flex_message(user_id, flex_message)
-    else:
-        send_message(user_id, "❌ ไม่พบตัวเลือก กรุณาพิมพ์ใหม่ เช่น 'บริการของเรา', 'สินค้าตัวอย่าง' หรือ 'กระบวนการผลิตสินค้า'")
+@ROUTER.exact("บริการของเรา")
+def send_our_services(user_id, message_text=None):
+    flex_message = TEMPLATES.render("our_services")
+    send_flex_message(user_id, flex_message)
+
+@ROUTER.exact("สินค้าตัวอย่าง")
+def send_sample_products(user_id, message_text=None):
+    flex_message = TEMPLATES.render("sample_products")
+    send_flex_message(user_id, flex_message)
+
+@ROUTER.exact("กระบวนการผลิตสินค้า")
+def send_production_process(user_id, message_text=None):
+    flex_message = TEMPLATES.render("production_process")
+    send_flex_message(user_id, flex_message)
 
 def send_flex_message(user_id, flex_message):
-    headers = {"Authorization": f"Bearer {LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    message = {"to": user_id, "messages": [flex_message]}
-    response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, json=message)
-    print(f"📤 ส่ง Flex Message ไปที่ {user_id}: {flex_message}")
-    print(f"📡 LINE Response: {response.status_code} {response.text}")
+    # flex message ทั้งหมดเป็นเมนู/ข้อมูลสินค้า จึงส่งเป็น priority ต่ำ
+    send_line_messages(user_id, [flex_message], priority=PRIORITY_LOW)
+    message_log.info("📤 ส่ง Flex Message ไปที่ %s", user_id)
 
 # ------------------ ฟังก์ชันสำหรับการคำนวณต้นทุนและข้อมูลส่วนตัว ------------------
 
-def start_questionnaire(user_id):
-    USER_SESSIONS[user_id] = {"step": 1}
+DEFAULT_MATERIAL_NAMES = "ABS, PC, Nylon, PP, PE, PVC, PET, PMMA, POM, PU"
+INVALID_SIZE_MESSAGE = "❌ ขนาดชิ้นงานไม่ถูกต้อง\nโปรดใช้รูปแบบ เช่น 10.5x4.5x3 (cm) หรือ 105x45x30 mm"
+
+def material_names():
+    catalog = get_material_catalog()
+    return catalog.display_names() if len(catalog) else DEFAULT_MATERIAL_NAMES
+
+@ROUTER.exact("คำนวณราคา")
+def start_questionnaire(user_id, message_text=None):
+    SESSION_STORE.set(user_id, {"step": 1})
     send_message(
         user_id,
         "✨ เริ่มต้นการคำนวณต้นทุน ✨\n\n"
         "กรุณาเลือกวัสดุที่ต้องการผลิต:\n"
-        "ABS, PC, Nylon, PP, PE, PVC, PET, PMMA, POM, PU"
+        f"{material_names()}"
     )
 
+@ROUTER.default
 def process_response(user_id, message_text):
-    if user_id not in USER_SESSIONS:
+    session = SESSION_STORE.get(user_id)
+    if session is None:
         send_message(user_id, "⚠️ กรุณาเริ่มคำนวณโดยพิมพ์ 'คำนวณราคา'")
         return
-    step = USER_SESSIONS[user_id]["step"]
+    step = session["step"]
     if step == 1:
-        # ใช้การเปรียบเทียบแบบไม่คำนึง case
-        material_input = message_text.strip().upper()
-        valid_materials = {mat.upper(): mat for mat in MATERIAL_COSTS.keys()}
-        if material_input not in valid_materials:
+        # ค้นหาแบบไม่คำนึง case/ช่องว่าง/ตัวอักษร full-width และรองรับชื่อเรียกอื่น เช่น PA = Nylon
+        catalog = get_material_catalog()
+        if not len(catalog):
+            send_message(user_id, "⚠️ ระบบกำลังโหลดราคาวัสดุ กรุณาพิมพ์ชื่อวัสดุอีกครั้งในอีกสักครู่")
+            return
+        material = catalog.lookup(message_text)
+        if material is None:
+            suggestions = catalog.suggest(message_text)
+            hint = f"หมายถึง {' หรือ '.join(suggestions)} หรือไม่?\n" if suggestions else ""
             send_message(user_id,
-                "❌ วัสดุไม่ถูกต้อง กรุณาเลือกจาก:\nABS, PC, Nylon, PP, PE, PVC, PET, PMMA, POM, PU")
+                f"❌ วัสดุไม่ถูกต้อง {hint}กรุณาเลือกจาก:\n{catalog.display_names()}")
             return
-        USER_SESSIONS[user_id]["material"] = valid_materials[material_input]
-        USER_SESSIONS[user_id]["step"] = 2
+        session["material"] = material.name
+        session["step"] = 2
+        SESSION_STORE.set(user_id, session)
         send_message(user_id, "กรุณากรอกขนาดชิ้นงาน (กว้างxยาวxสูง) cm\nตัวอย่าง: 10.5x4.5x3")
     elif step == 2:
-        USER_SESSIONS[user_id]["size"] = message_text
-        USER_SESSIONS[user_id]["step"] = 3
+        try:
+            dimensions = parse_dimensions(message_text)
+        except DimensionError:
+            send_message(user_id, INVALID_SIZE_MESSAGE)
+            return
+        # เก็บขนาดเป็น cm ในรูปแบบมาตรฐาน (เช่น "100 × 50 × 20 mm" -> "10x5x2")
+        session["size"] = format_dimensions(dimensions)
+        session["step"] = 3
+        SESSION_STORE.set(user_id, session)
         send_message(user_id, "กรุณากรอกจำนวนที่ต้องการผลิต (ตัวเลข)")
     elif step == 3:
         try:
-            USER_SESSIONS[user_id]["quantity"] = int(message_text)
-            USER_SESSIONS[user_id]["step"] = 4
-            calculate_cost(user_id)
+            session["quantity"] = int(message_text)
         except ValueError:
             send_message(user_id, "❌ กรุณากรอกจำนวนที่ถูกต้อง เช่น 100")
+            return
+        if not calculate_cost(user_id, session):
+            # ขนาดที่เก็บไว้ใช้คำนวณไม่ได้: กลับไปถามขนาดใหม่ แทนการไปขั้นที่ 4 โดยไม่มีผลคำนวณ
+            session["step"] = 2
+        SESSION_STORE.set(user_id, session)
     elif step == 4:
         if message_text.strip() == "ต้องการ":
             send_message(user_id,
                 "กรุณากรอกข้อมูลส่วนตัวของคุณ\nรูปแบบ: ชื่อ-สกุล, เบอร์โทร, ชื่อบริษัท, อีเมล")
-            USER_SESSIONS[user_id]["step"] = 5
+            session["step"] = 5
+            SESSION_STORE.set(user_id, session)
         else:
             send_message(user_id,
                 "ไม่ได้เลือกใบเสนอราคา\nหากต้องการใบเสนอราคา 'กรุณาทำรายการ' ใหม่")
-            del USER_SESSIONS[user_id]
+            SESSION_STORE.delete(user_id)
     elif step == 5:
         info_parts = [part.strip() for part in message_text.split(",")]
         if len(info_parts) != 4:
@@ -371,129 +673,252 @@ def process_response(user_id, message_text):
                 "❌ กรุณากรอกข้อมูลส่วนตัวให้ครบถ้วนในรูปแบบ:\nชื่อ-สกุล, เบอร์โทร, ชื่อบริษัท, อีเมล")
             return
         full_name, tel, company, email = info_parts
-        USER_SESSIONS[user_id]["user_info"] = {
-            "full_name": full_name,
-            "tel": tel,
-            "company": company,
-            "email": email
-        }
         try:
-            write_to_sheet(
-                user_id,
-                USER_SESSIONS[user_id]["material"],
-                USER_SESSIONS[user_id]["size"],
-                USER_SESSIONS[user_id]["quantity"],
-                USER_SESSIONS[user_id]["volume"],
-                USER_SESSIONS[user_id]["weight_kg"],
-                USER_SESSIONS[user_id]["total_cost"],
-                full_name, tel, company, email
-            )
-            write_to_bigquery(
-                user_id,
-                USER_SESSIONS[user_id]["material"],
-                USER_SESSIONS[user_id]["size"],
-                USER_SESSIONS[user_id]["quantity"],
-                USER_SESSIONS[user_id]["volume"],
-                USER_SESSIONS[user_id]["weight_kg"],
-                USER_SESSIONS[user_id]["total_cost"],
-                full_name, tel, company, email
-            )
-            send_message(user_id,
-                "🎉 ข้อมูลครบถ้วนแล้ว\nใบเสนอราคาจะส่งให้ทางอีเมลที่ระบุ\n(ภายใน 2-3 วันทำการ)")
+            # บันทึกลง spool ทันที แล้วส่งเข้า Google Sheets/BigQuery เป็น batch เบื้องหลัง
+            QUOTE_SINK.submit({
+                "user_id": user_id,
+                "material": session["material"],
+                "size": session["size"],
+                "quantity": session["quantity"],
+                "volume": session["volume"],
+                "weight_kg": session["weight_kg"],
+                "total_cost": session["total_cost"],
+                "full_name": full_name,
+                "tel": tel,
+                "company": company,
+                "email": email
+            })
         except Exception as e:
+            # ไม่แสดงรายละเอียดข้อผิดพลาดให้ลูกค้า และคง session ไว้ที่ขั้นตอนนี้เพื่อให้ส่งข้อมูลซ้ำได้
+            logger.exception("บันทึกใบเสนอราคาของ %s ลง spool ไม่สำเร็จ: %s", user_id, e)
             send_message(user_id,
-                f"⚠️ เกิดข้อผิดพลาดในการบันทึกข้อมูลลง Google Sheets/BigQuery: {e}")
-        del USER_SESSIONS[user_id]
+                "⚠️ ขออภัย ระบบบันทึกข้อมูลขัดข้องชั่วคราว\nกรุณาส่งข้อมูลส่วนตัวอีกครั้งในอีกสักครู่", priority=PRIORITY_QUOTE)
+            return
+        send_message(user_id,
+            "🎉 ข้อมูลครบถ้วนแล้ว\nใบเสนอราคาจะส่งให้ทางอีเมลที่ระบุ\n(ภายใน 2-3 วันทำการ)", priority=PRIORITY_QUOTE)
+        SESSION_STORE.delete(user_id)
 
-def calculate_cost(user_id):
-    material = USER_SESSIONS[user_id]["material"]
-    size = USER_SESSIONS[user_id]["size"]
-    quantity = USER_SESSIONS[user_id]["quantity"]
+@timed("calculate_cost")
+def calculate_cost(user_id, session):
+    """
+    คำนวณต้นทุนจากข้อมูลใน session แล้วเก็บผลลัพธ์กลับลง session และไปขั้นที่ 4 (ผู้เรียกต้องบันทึก session เอง)
+    คืน False ถ้าขนาดใน session ใช้คำนวณไม่ได้ (session ไม่ถูกเปลี่ยน)
+    """
+    material = session["material"]
+    size = session["size"]
+    quantity = session["quantity"]
     try:
-        dimensions = list(map(float, size.split("x")))
-        if len(dimensions) != 3:
-            raise ValueError("Invalid dimensions")
-        volume = dimensions[0] * dimensions[1] * dimensions[2]
-        USER_SESSIONS[user_id]["volume"] = volume
-    except Exception as e:
-        send_message(user_id,
-            "❌ ขนาดชิ้นงานไม่ถูกต้อง\nโปรดใช้รูปแบบ เช่น 10.5x4.5x3")
-        return
-    material_cost_per_kg = MATERIAL_COSTS.get(material, 150)
-    density = 1.05  # g/cm³
-    weight_kg = (volume * density) / 1000
-    total_cost = weight_kg * quantity * material_cost_per_kg
-    USER_SESSIONS[user_id]["weight_kg"] = weight_kg
-    USER_SESSIONS[user_id]["total_cost"] = total_cost
-    result_text = (
-        "✨ คำนวณต้นทุนสำเร็จ ✨\n\n"
-        f"วัสดุ: {material}\n"
-        f"ขนาด: {size} cm³\n"
-        f"ปริมาตร: {volume:.2f} cm³\n"
-        f"น้ำหนัก: {weight_kg:.2f} kg\n"
-        f"จำนวน: {quantity} ชิ้น\n"
-        f"ต้นทุนรวม: {total_cost:,.2f} บาท\n\n"
-        "✅ ข้อมูลครบถ้วนแล้ว\n"
-        "ต้องการใบเสนอราคาหรือไม่?\n"
-        "หากต้องการให้พิมพ์ 'ต้องการ'"
+        dimensions = parse_dimensions(size)
+    except DimensionError:
+        send_message(user_id, INVALID_SIZE_MESSAGE)
+        return False
+    # สูตรเดียวกับ /quote/batch (pricing.py); ปริมาตร/น้ำหนักมาจาก cache เมื่อเคยคำนวณขนาดนี้แล้ว
+    part = measure_part(material, dimensions)
+    volume, weight_kg = part.volume, part.weight_kg
+    total_cost = weight_kg * quantity * part.cost_per_kg
+    session["volume"] = volume
+    session["weight_kg"] = weight_kg
+    session["total_cost"] = total_cost
+    # ข้อความสรุปมาจาก line_templates/cost_summary.json (แทนค่า {{...}} ใน JSON ที่ serialise ไว้แล้ว)
+    summary = TEMPLATES.render(
+        "cost_summary",
+        material=material,
+        size=size,
+        volume=f"{volume:.2f}",
+        weight_kg=f"{weight_kg:.2f}",
+        quantity=quantity,
+        total_cost=f"{total_cost:,.2f}"
     )
-    send_message(user_id, result_text)
-    USER_SESSIONS[user_id]["step"] = 4
+    # ส่งตารางราคาตามจำนวนไปในคำขอเดียวกัน ลูกค้าไม่ต้องทำแบบสอบถามใหม่เพื่อเปลี่ยนจำนวน
+    send_line_messages(user_id, [summary, part.tiers_message], priority=PRIORITY_QUOTE)
+    session["step"] = 4
+    return True
+
+Part = namedtuple("Part", ["material", "cost_per_kg", "volume", "weight_kg", "tiers_message"])
+
+def measure_part(material, dimensions):
+    """
+    ข้อมูลของชิ้นงานที่ไม่ขึ้นกับจำนวน: ราคาต่อ kg, ปริมาตร, น้ำหนักต่อชิ้น และข้อความตารางราคาตามจำนวน
+    (render แล้ว) เก็บใน PART_CACHE ตาม (วัสดุ, ขนาดเป็น cm, version ของตารางราคา)
+    """
+    catalog = get_material_catalog()
+    terms = material_terms(catalog, material)
+    name, cost_per_kg, density = terms or (material, DEFAULT_COST_PER_KG, FALLBACK_DENSITY)
+
+    def compute():
+        volume, weight_kg, _ = quote(dimensions, 1, cost_per_kg, density)
+        tiers = "\n".join(
+            f"• {tier.quantity:,} ชิ้น: {tier.total_cost:,.2f} บาท ({tier.unit_cost:,.2f} บาท/ชิ้น)"
+            for tier in tier_prices(weight_kg, cost_per_kg, QUOTE_TIERS)
+        )
+        tiers_message = TEMPLATES.render(
+            "quantity_tiers",
+            material=name,
+            size=format_dimensions(dimensions),
+            weight_kg=f"{weight_kg:.2f}",
+            tiers=tiers
+        )
+        return Part(name, cost_per_kg, volume, weight_kg, tiers_message)
+
+    return PART_CACHE.get((name, dimensions, catalog.version), compute)
+
+@ROUTER.prefix("ราคาตามจำนวน")
+def send_quantity_tiers(user_id, message_text):
+    """
+    ตารางราคาตามจำนวนโดยไม่ต้องทำแบบสอบถาม: "ราคาตามจำนวน <วัสดุ> <ขนาด>"
+    ถ้าไม่ระบุ จะใช้วัสดุและขนาดจากแบบสอบถามที่กำลังทำอยู่
+    """
+    args = message_text.strip().split(None, 2)[1:]
+    if len(args) == 2:
+        material_text, size = args
+    else:
+        session = SESSION_STORE.get(user_id) or {}
+        material_text, size = session.get("material"), session.get("size")
+        if not material_text or not size:
+            send_message(user_id, "กรุณาพิมพ์ 'ราคาตามจำนวน วัสดุ ขนาด'\nตัวอย่าง: ราคาตามจำนวน ABS 10x5x2")
+            return
+    catalog = get_material_catalog()
+    if material_terms(catalog, material_text) is None:
+        send_message(user_id, f"❌ ไม่พบวัสดุ '{material_text}' กรุณาเลือกจาก:\n{material_names()}")
+        return
+    try:
+        dimensions = parse_dimensions(size)
+    except DimensionError:
+        send_message(user_id, INVALID_SIZE_MESSAGE)
+        return
+    send_line_messages(user_id, [measure_part(material_text, dimensions).tiers_message], priority=PRIORITY_QUOTE)
+
+QUOTE_FIELDS = ["user_id", "material", "size", "quantity", "volume", "weight_kg", "total_cost",
+                "full_name", "tel", "company", "email"]
 
-def write_to_sheet(user_id, material, size, quantity, volume, weight_kg, total_cost, full_name, tel, company, email):
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-    credentials, project_id = google.auth.default(scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=credentials)
+@timed("write_to_sheet")
+def write_to_sheet(records):
+    """ต่อท้าย record ใบเสนอราคาทั้งหมดลง Google Sheets ด้วยคำขอ append เดียว"""
+    service = GOOGLE_CLIENTS.sheets()
     values = [
-        [user_id, material, size, quantity, volume, f"{weight_kg:.2f}", f"{total_cost:,.2f}", full_name, tel, company, email]
+        [r["user_id"], r["material"], r["size"], r["quantity"], r["volume"], f"{r['weight_kg']:.2f}",
+         f"{r['total_cost']:,.2f}", r["full_name"], r["tel"], r["company"], r["email"]]
+        for r in records
     ]
     body = {'values': values}
     range_name = f"{SHEET_NAME}!A1"
-    result = service.spreadsheets().values().append(
+    # append ไม่ idempotent จึงไม่ retry ทันที (QuoteSink จะส่ง batch นี้ใหม่ภายหลังเมื่อไม่สำเร็จ)
+    result = UPSTREAMS["sheets"].call_once(GOOGLE_CLIENTS.execute_sheets, service.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID,
         range=range_name,
         valueInputOption="RAW",
         body=body
-    ).execute()
+    ), "sheets.append")
     updated_cells = result.get('updates', {}).get('updatedCells', 0)
-    print(f"{updated_cells} cells appended to Google Sheets.")
+    logger.info("%d cells appended to Google Sheets.", updated_cells)
 
-def write_to_bigquery(user_id, material, size, quantity, volume, weight_kg, total_cost, full_name, tel, company, email):
-    client = bigquery.Client()
+@timed("write_to_bigquery")
+def write_to_bigquery(records):
+    """stream record ใบเสนอราคาทั้งหมดเข้า BigQuery ด้วย insert_rows_json ครั้งเดียว"""
+    client = GOOGLE_CLIENTS.bigquery()
     project = client.project
     table_id = f"{project}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
-    rows_to_insert = [{
-        "user_id": user_id,
-        "material": material,
-        "size": size,
-        "quantity": quantity,
-        "volume": volume,
-        "weight_kg": weight_kg,
-        "total_cost": total_cost,
-        "full_name": full_name,
-        "tel": tel,
-        "company": company,
-        "email": email
-    }]
-    errors = client.insert_rows_json(table_id, rows_to_insert)
+    rows_to_insert = [{field: r[field] for field in QUOTE_FIELDS} for r in records]
+    # row_id เป็น insertId ทำให้ BigQuery ตัดแถวซ้ำเมื่อ batch เดิมถูกส่งซ้ำ
+    row_ids = [r["row_id"] for r in records]
+
+    def insert_rows():
+        # จับเวลาแต่ละครั้งที่ส่ง (ไม่รวมเวลารอ backoff ระหว่าง retry) เหมือน execute_sheets
+        with GOOGLE_CLIENTS.timed("bigquery.insert_rows_json"):
+            return client.insert_rows_json(table_id, rows_to_insert, row_ids=row_ids, retry=None,
+                                           timeout=GOOGLE_TIMEOUT)
+
+    # retry ที่ชั้น UPSTREAMS (จำกัดจำนวนครั้ง) แทน retry ของ SDK ที่รอได้นานถึง 10 นาที
+    errors = UPSTREAMS["bigquery"].call(insert_rows)
     if errors:
         raise Exception(f"BigQuery insert errors: {errors}")
     else:
-        print("Data inserted into BigQuery successfully.")
+        logger.info("%d rows inserted into BigQuery successfully.", len(rows_to_insert))
+
+QUOTE_SINK = QuoteSink(
+    QUOTE_SPOOL_PATH,
+    {"sheets": write_to_sheet, "bigquery": write_to_bigquery},
+    batch_size=QUOTE_BATCH_SIZE,
+    flush_interval=QUOTE_FLUSH_INTERVAL
+)
+
+# gauge ที่อ่านค่าจาก stats() ของแต่ละส่วนตอน Prometheus scrape
+metrics.REGISTRY.gauge("linebot_sessions", "Active questionnaire sessions (in-memory store only).",
+                       lambda: SESSION_STORE.stats().get("sessions"))
+metrics.REGISTRY.gauge("linebot_event_queue_depth", "Events waiting in the processing queue.",
+                       lambda: EVENT_QUEUE.stats()["depth"])
+metrics.REGISTRY.gauge("linebot_price_table_age_seconds", "Seconds since the material price table was loaded.",
+                       lambda: PRICE_TABLE.age())
+metrics.REGISTRY.gauge("linebot_price_table_version", "Version of the material price table in use.",
+                       lambda: PRICE_TABLE.version)
+metrics.REGISTRY.gauge("linebot_circuit_open", "1 when calls to the upstream are being rejected by its circuit breaker.",
+                       lambda: {(name,): int(upstream.breaker.state != "closed") for name, upstream in UPSTREAMS.items()},
+                       labelnames=("upstream",))
+metrics.REGISTRY.gauge("linebot_outbound_queue_depth", "Outbound LINE sends waiting for the rate limiter.",
+                       lambda: OUTBOUND.stats()["queued"])
+metrics.REGISTRY.gauge("linebot_quote_spool_pending", "Quote records written to the spool but not yet flushed.",
+                       lambda: QUOTE_SINK.stats()["pending"])
+
+def send_message(user_id, text, priority=PRIORITY_NORMAL):
+    send_line_messages(user_id, [{"type": "text", "text": text}], priority=priority)
+    message_log.info("📤 ส่งข้อความไปที่ %s: %s", user_id, text)
+
+def send_line_messages(user_id, messages, priority=PRIORITY_NORMAL):
+    """
+    เพิ่มข้อความเข้า Outbox ของ event ที่กำลังประมวลผล (ถ้าเป็นของ user เดียวกัน)
+    ถ้าเรียกนอก webhook จะส่งด้วย push ผ่าน OUTBOUND
+    priority: PRIORITY_QUOTE (ผลคำนวณ/ยืนยันใบเสนอราคา), PRIORITY_NORMAL หรือ PRIORITY_LOW (เมนู/FAQ)
+    """
+    outbox = getattr(_event_context, "outbox", None)
+    if outbox is None or outbox.user_id != user_id:
+        outbox = Outbox(user_id)
+        for message in messages:
+            outbox.add(message, priority)
+        flush_outbox(outbox)
+        return
+    for message in messages:
+        outbox.add(message, priority)
+
+def flush_outbox(outbox):
+    """เข้าคิวส่งข้อความใน outbox ผ่าน OUTBOUND (ส่งจริงเมื่อไม่เกินอัตราที่กำหนดของ user และ channel)"""
+    if not len(outbox):
+        return
+
+    def send():
+        # LINE ขัดข้องหรือถูกตัดวงจร: OUTBOUND บันทึก log และนับเป็น failed
+        for response in outbox.flush(GUARDED_LINE_CLIENT):
+            log_line_response(response)
+
+    OUTBOUND.submit(outbox.user_id, send, priority=outbox.priority, cost=outbox.request_count())
+
+def log_line_response(response):
+    # เก็บ body ของ response เฉพาะเมื่อ LINE ตอบว่าผิดพลาด
+    if response.status_code >= 400:
+        logger.warning("LINE Response: %s %s", response.status_code, response.text)
+    else:
+        logger.debug("LINE Response: %s", response.status_code)
 
-def send_message(user_id, text):
-    headers = {"Authorization": f"Bearer {LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    message = {"to": user_id, "messages": [{"type": "text", "text": text}]}
-    response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, json=message)
-    print(f"📤 ส่งข้อความไปที่ {user_id}: {text}")
-    print(f"📡 LINE Response: {response.status_code} {response.text}")
+# ไม่บล็อกการเริ่มเซิร์ฟเวอร์: ใช้ snapshot ล่าสุดทันที แล้วโหลด MATERIAL_COSTS จาก Sheets
+# และเตรียม client ของ Google ในเบื้องหลัง (ดูความพร้อมได้ที่ GET /ready)
+PRICE_TABLE.start()
+threading.Thread(target=warm_up_google_clients, name="google-warm-up", daemon=True).start()
+# ส่งข้อมูลที่ค้างอยู่ใน spool จากรอบก่อน และ flush รอบสุดท้ายเมื่อโปรเซสปิด
+QUOTE_SINK.start()
+atexit.register(QUOTE_SINK.stop)
+# ส่งข้อความที่ยังค้างในคิวให้เสร็จก่อนโปรเซสปิด
+OUTBOUND.start()
+atexit.register(OUTBOUND.stop)
+# event ที่ตอบ 200 ไปแล้วแต่ยังค้างในคิว (EVENT_QUEUE_MODE=thread) ต้องประมวลผลก่อน
+# atexit เรียกแบบย้อนลำดับ: ข้อความที่เกิดขึ้นจึงยังส่งผ่าน OUTBOUND และบันทึกผ่าน QUOTE_SINK ได้
+atexit.register(EVENT_QUEUE.stop)
 
-if __name__ != "__main__":
-    # เมื่อถูก import (เช่นโดย WSGI server บน Cloud Run) ให้โหลด MATERIAL_COSTS ทันที
-    MATERIAL_COSTS = load_material_costs()
+startup_profile.finish()
+_startup = startup_profile.report(top=5)
+logger.info("import module เสร็จใน %.3f วินาที", _startup["phases"]["imports"],
+            extra={"import_seconds_by_package": _startup["imports"]["packages"]})
 
 if __name__ == "__main__":
-    # สำหรับ local ให้โหลด MATERIAL_COSTS ก่อนเริ่มแอป
-    MATERIAL_COSTS = load_material_costs()
+    # Cloud Run ส่ง SIGTERM ก่อนปิด container: ออกแบบปกติเพื่อให้ handler ของ atexit ข้างบนทำงาน
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.getenv("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,122 @@
+import difflib
+import re
+import unicodedata
+from collections import namedtuple
+
+Material = namedtuple("Material", ["name", "cost", "density"])
+
+# ความหนาแน่นทั่วไป (g/cm³) ใช้เมื่อชีต MATERIAL_COSTS ไม่ได้ระบุคอลัมน์ density
+DEFAULT_DENSITIES = {
+    "ABS": 1.05,
+    "PC": 1.20,
+    "NYLON": 1.14,
+    "PP": 0.90,
+    "PE": 0.95,
+    "PVC": 1.38,
+    "PET": 1.38,
+    "PMMA": 1.18,
+    "POM": 1.41,
+    "PU": 1.20,
+}
+FALLBACK_DENSITY = 1.05
+
+# ชื่อเรียกอื่น -> ชื่อวัสดุหลัก (ใช้เฉพาะเมื่อชื่อหลักมีอยู่ในชีต และชื่อเรียกอื่นไม่ได้เป็นวัสดุในชีตเอง)
+ALIASES = {
+    "PA": "NYLON",
+    "PA6": "NYLON",
+    "PA66": "NYLON",
+    "POLYAMIDE": "NYLON",
+    "ไนลอน": "NYLON",
+    "POLYCARBONATE": "PC",
+    "โพลีคาร์บอเนต": "PC",
+    "POLYPROPYLENE": "PP",
+    "โพลีโพรพิลีน": "PP",
+    "POLYETHYLENE": "PE",
+    "โพลีเอทิลีน": "PE",
+    "HDPE": "PE",
+    "LDPE": "PE",
+    "ACRYLIC": "PMMA",
+    "อะคริลิค": "PMMA",
+    "อะครีลิค": "PMMA",
+    "ACETAL": "POM",
+    "DELRIN": "POM",
+    "POLYURETHANE": "PU",
+    "โพลียูรีเทน": "PU",
+    "PETE": "PET",
+}
+
+_STRIP_PATTERN = re.compile(r"[\s\-_./]+")
+
+
+def normalize_material(text):
+    """
+    ทำให้ชื่อวัสดุอยู่ในรูปเดียวกันก่อนค้นหา:
+    แปลงตัวอักษร full-width เป็นปกติ (NFKC), ตัวพิมพ์ใหญ่, ตัดช่องว่างและเครื่องหมาย - _ . /
+    เช่น "ｎｙｌｏｎ", " Nylon ", "pa-6" -> "NYLON", "NYLON", "PA6"
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return _STRIP_PATTERN.sub("", text).upper()
+
+
+def _parse_entry(value):
+    """รองรับทั้งรูปแบบเก่า (ราคาอย่างเดียว) และรูปแบบ {"cost": ..., "density": ...}"""
+    if isinstance(value, dict):
+        return value.get("cost", 0), value.get("density")
+    return value, None
+
+
+class MaterialCatalog:
+    """
+    แคตตาล็อกวัสดุที่สร้างครั้งเดียวทุกครั้งที่ตารางราคาโหลดใหม่
+    - index ที่ normalize แล้ว (ชื่อหลัก + ชื่อเรียกอื่น) ทำให้ lookup เป็น O(1)
+    - suggest() หาชื่อที่ใกล้เคียงเมื่อพิมพ์ผิด
+    - แต่ละวัสดุมีราคา (บาท/kg) และความหนาแน่น (g/cm³)
+    """
+
+    def __init__(self, materials, version=0):
+        self.version = version
+        self._materials = list(materials)
+        self._index = {}
+        for material in self._materials:
+            self._index[normalize_material(material.name)] = material
+        for alias, target in ALIASES.items():
+            key = normalize_material(alias)
+            material = self._index.get(normalize_material(target))
+            if material is not None and key not in self._index:
+                self._index[key] = material
+
+    @classmethod
+    def from_table(cls, table, version=0):
+        materials = []
+        for name, value in table.items():
+            cost, density = _parse_entry(value)
+            if not density:
+                density = DEFAULT_DENSITIES.get(normalize_material(name), FALLBACK_DENSITY)
+            materials.append(Material(name, float(cost or 0), float(density)))
+        return cls(materials, version=version)
+
+    def lookup(self, text):
+        """คืน Material ที่ตรงกับข้อความที่ผู้ใช้พิมพ์ หรือ None ถ้าไม่พบ"""
+        return self._index.get(normalize_material(text))
+
+    def suggest(self, text, limit=3):
+        """คืนชื่อวัสดุที่ใกล้เคียงกับข้อความ (เรียงจากใกล้ที่สุด) สำหรับแนะนำเมื่อพิมพ์ผิด"""
+        matches = difflib.get_close_matches(normalize_material(text), list(self._index), n=limit * 2, cutoff=0.5)
+        names = []
+        for key in matches:
+            name = self._index[key].name
+            if name not in names:
+                names.append(name)
+        return names[:limit]
+
+    def names(self):
+        return [material.name for material in self._materials]
+
+    def display_names(self):
+        return ", ".join(self.names())
+
+    def __len__(self):
+        return len(self._materials)
+
+    def __contains__(self, text):
+        return self.lookup(text) is not None
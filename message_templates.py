@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import re
+import threading
+
+from line_client import RawJSON
+
+try:
+    import yaml
+except ImportError:  # รองรับ YAML เฉพาะเมื่อติดตั้ง PyYAML
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+# ข้อจำกัดของ LINE Messaging API ที่ตรวจตอนโหลด template
+MAX_TEXT_LENGTH = 5000
+MAX_ALT_TEXT_LENGTH = 1500
+MAX_TEMPLATE_ALT_TEXT_LENGTH = 400
+MAX_BUBBLE_BYTES = 30 * 1024
+MAX_CAROUSEL_BYTES = 50 * 1024
+MAX_CAROUSEL_BUBBLES = 12
+MAX_TEMPLATE_COLUMNS = 10
+MAX_COLUMN_TITLE_LENGTH = 40
+MAX_COLUMN_TEXT_LENGTH = 120
+MAX_COLUMN_TEXT_WITH_IMAGE_LENGTH = 60
+MAX_LOCATION_TITLE_LENGTH = 100
+MAX_LOCATION_ADDRESS_LENGTH = 100
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _check_length(name, label, value, limit):
+    # ไม่นับความยาวของ placeholder เพราะค่าจริงถูกแทนที่ตอน render
+    length = len(PLACEHOLDER_PATTERN.sub("", value or ""))
+    if length > limit:
+        raise TemplateError(f"{name}: {label} ยาว {length} ตัวอักษร เกินข้อจำกัดของ LINE ({limit})")
+
+
+def validate_message(name, message):
+    """ตรวจข้อความตามข้อจำกัดหลักของ LINE (ความยาวข้อความ, ขนาด flex, จำนวน column ฯลฯ)"""
+    if not isinstance(message, dict) or "type" not in message:
+        raise TemplateError(f"{name}: ต้องเป็น object ที่มี field 'type'")
+    message_type = message["type"]
+    if message_type == "text":
+        _check_length(name, "text", message.get("text"), MAX_TEXT_LENGTH)
+    elif message_type == "flex":
+        _check_length(name, "altText", message.get("altText"), MAX_ALT_TEXT_LENGTH)
+        contents = message.get("contents") or {}
+        size = len(_dumps(contents))
+        if contents.get("type") == "carousel":
+            bubbles = contents.get("contents", [])
+            if len(bubbles) > MAX_CAROUSEL_BUBBLES:
+                raise TemplateError(f"{name}: carousel มี {len(bubbles)} bubble เกิน {MAX_CAROUSEL_BUBBLES}")
+            if size > MAX_CAROUSEL_BYTES:
+                raise TemplateError(f"{name}: carousel ขนาด {size} bytes เกิน {MAX_CAROUSEL_BYTES}")
+            for bubble in bubbles:
+                if len(_dumps(bubble)) > MAX_BUBBLE_BYTES:
+                    raise TemplateError(f"{name}: bubble ขนาดเกิน {MAX_BUBBLE_BYTES} bytes")
+        elif size > MAX_BUBBLE_BYTES:
+            raise TemplateError(f"{name}: bubble ขนาด {size} bytes เกิน {MAX_BUBBLE_BYTES}")
+    elif message_type == "template":
+        _check_length(name, "altText", message.get("altText"), MAX_TEMPLATE_ALT_TEXT_LENGTH)
+        template = message.get("template") or {}
+        columns = template.get("columns", [])
+        if len(columns) > MAX_TEMPLATE_COLUMNS:
+            raise TemplateError(f"{name}: carousel มี {len(columns)} column เกิน {MAX_TEMPLATE_COLUMNS}")
+        for column in columns:
+            _check_length(name, "title", column.get("title"), MAX_COLUMN_TITLE_LENGTH)
+            limit = MAX_COLUMN_TEXT_WITH_IMAGE_LENGTH if (column.get("thumbnailImageUrl") or column.get("title")) \
+                else MAX_COLUMN_TEXT_LENGTH
+            _check_length(name, "column text", column.get("text"), limit)
+    elif message_type == "location":
+        _check_length(name, "title", message.get("title"), MAX_LOCATION_TITLE_LENGTH)
+        _check_length(name, "address", message.get("address"), MAX_LOCATION_ADDRESS_LENGTH)
+
+
+class MessageTemplate:
+    """
+    template ของข้อความ LINE หนึ่งข้อความ ที่ serialise เป็น JSON ไว้ตั้งแต่โหลด
+    - template ที่ไม่มี placeholder: render() คืน bytes ชุดเดิมทุกครั้ง (ไม่สร้าง dict/ไม่ encode ใหม่)
+    - template ที่มี {{ชื่อ}}: แทนค่าลงใน JSON ที่ serialise แล้วโดยตรง (escape ค่าแบบ JSON)
+    """
+
+    def __init__(self, name, message):
+        validate_message(name, message)
+        self.name = name
+        self.message = message
+        self._serialized = _dumps(message).decode("utf-8")
+        self.placeholders = set(PLACEHOLDER_PATTERN.findall(self._serialized))
+        self._static = RawJSON(self._serialized.encode("utf-8")) if not self.placeholders else None
+
+    def render(self, **values):
+        if self._static is not None:
+            return self._static
+        missing = self.placeholders - set(values)
+        if missing:
+            raise KeyError(f"{self.name}: ไม่มีค่าสำหรับ {', '.join(sorted(missing))}")
+
+        def substitute(match):
+            # json.dumps ให้ string ที่ escape แล้ว ตัดเครื่องหมายคำพูดหัวท้ายออก
+            return json.dumps(str(values[match.group(1)]), ensure_ascii=False)[1:-1]
+
+        return RawJSON(PLACEHOLDER_PATTERN.sub(substitute, self._serialized).encode("utf-8"))
+
+
+class TemplateRegistry:
+    """
+    โหลด template ข้อความจากไฟล์ .json (และ .yaml/.yml เมื่อมี PyYAML) ในโฟลเดอร์เดียว
+    ชื่อ template คือชื่อไฟล์ไม่รวมนามสกุล เช่น line_templates/services_menu.json -> "services_menu"
+    reload() ตรวจทุกไฟล์ก่อน แล้วสลับชุด template ทีเดียว ถ้ามีไฟล์ผิดจะคงชุดเดิมไว้
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        with open(path, encoding="utf-8") as f:
+            if path.endswith(".json"):
+                return json.load(f)
+            return yaml.safe_load(f)
+
+    def load(self):
+        extensions = (".json", ".yaml", ".yml") if yaml is not None else (".json",)
+        templates = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(extensions):
+                continue
+            name = os.path.splitext(filename)[0]
+            path = os.path.join(self.directory, filename)
+            try:
+                message = self._read(path)
+            except Exception as e:
+                raise TemplateError(f"{name}: อ่านไฟล์ {path} ไม่สำเร็จ: {e}")
+            templates[name] = MessageTemplate(name, message)
+        with self._lock:
+            self._templates = templates
+        logger.info("Loaded %d message templates from %s", len(templates), self.directory)
+        return len(templates)
+
+    reload = load
+
+    def get(self, name):
+        return self._templates[name]
+
+    def render(self, name, **values):
+        return self._templates[name].render(**values)
+
+    def names(self):
+        return sorted(self._templates)
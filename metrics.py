@@ -0,0 +1,259 @@
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# bucket (วินาที) ของ histogram เวลา ครอบคลุมตั้งแต่ handler ในหน่วยความจำจนถึงคำขอ Google API ที่ช้า
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ต้องระบุ label {self.labelnames} ได้ {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ต่อ label set: [จำนวนใน bucket แต่ละช่อง (ไม่สะสม) + ช่อง +Inf, sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        with self._lock:
+            items = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """
+    gauge ที่อ่านค่าจาก callback ตอน scrape (เช่น ความลึกคิว, อายุ cache) ค่า None จะไม่ถูกแสดง
+    ถ้ามี labelnames callback ต้องคืน dict ของ {tuple ของค่า label: ค่า}
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def collect(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if not self.labelnames:
+            return [f"{self.name} {_format_value(value)}"]
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(item)}"
+                for key, item in sorted(value.items()) if item is not None]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"metric {metric.name} ถูกลงทะเบียนไว้แล้วด้วยชนิด/label ต่างกัน")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=()):
+        """ลงทะเบียน gauge แบบ callback (ลงทะเบียนซ้ำด้วยชื่อเดิมจะแทนที่ callback เดิม)"""
+        with self._lock:
+            metric = self._metrics[name] = GaugeFunc(name, documentation, callback, labelnames)
+            return metric
+
+    def render(self):
+        """ข้อมูลทั้งหมดในรูปแบบ Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+# registry ของทั้งโปรเซส และ metric ที่ module อื่นใช้ร่วมกัน
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "linebot_http_requests_total", "HTTP requests received, by path and status code.", ("path", "status"))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "linebot_http_request_duration_seconds", "Time spent answering inbound HTTP requests.", ("path",))
+HANDLER_SECONDS = REGISTRY.histogram(
+    "linebot_handler_duration_seconds", "Time spent in bot handlers, by route or function.", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter(
+    "linebot_handler_errors_total", "Handlers that raised an exception.", ("handler",))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "linebot_upstream_request_duration_seconds", "Latency of calls to LINE, Google Sheets and BigQuery.",
+    ("upstream", "operation"))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "linebot_upstream_errors_total", "Failed upstream calls (exceptions or non-2xx responses).",
+    ("upstream", "operation"))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "linebot_upstream_retries_total", "Retries performed by upstream clients.", ("upstream", "operation"))
+UPSTREAM_REJECTIONS = REGISTRY.counter(
+    "linebot_upstream_rejections_total", "Calls rejected without reaching the upstream (open circuit or full bulkhead).",
+    ("upstream", "reason"))
+OUTBOUND_THROTTLED = REGISTRY.counter(
+    "linebot_outbound_throttled_total", "Outbound LINE sends delayed by the per-user or per-channel rate limit.",
+    ("scope",))
+OUTBOUND_DROPPED = REGISTRY.counter(
+    "linebot_outbound_dropped_total", "Outbound LINE sends dropped before sending, by priority and reason.",
+    ("priority", "reason"))
+
+
+@contextmanager
+def track_upstream(upstream, operation):
+    """จับเวลาคำขอไปยัง upstream หนึ่งครั้ง และนับเป็น error เมื่อเกิด exception"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream, operation=operation)
+
+
+def timed(name):
+    """
+    decorator/context manager จับเวลา handler ลง linebot_handler_duration_seconds{handler=name}
+    และนับ exception ลง linebot_handler_errors_total
+
+        @timed("calculate_cost")
+        def calculate_cost(...): ...
+
+        with timed("load_material_costs"): ...
+    """
+    return _Timed(name)
+
+
+class _Timed:
+    def __init__(self, name):
+        self.name = name
+        self._started = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._started, "stack", None)
+        if stack is None:
+            stack = self._started.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        started = self._started.stack.pop()
+        HANDLER_SECONDS.observe(time.perf_counter() - started, handler=self.name)
+        if exc_type is not None:
+            HANDLER_ERRORS.inc(handler=self.name)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,79 @@
+from rate_limit import PRIORITY_NORMAL
+
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+
+
+class Outbox:
+    """
+    buffer ข้อความขาออกของ user หนึ่งคนระหว่างประมวลผล event ใน webhook payload เดียวกัน
+    handler แต่ละตัวเพียงแค่ add() ข้อความ (text/flex/location/template)
+    แล้ว flush() จะรวมส่งเป็นคำขอเดียวต่อ 5 ข้อความ (ข้อจำกัดของ LINE)
+
+    reply token ของทุก event ที่รวมเข้ามาจะถูกเก็บไว้ตามลำดับ
+    แต่ละชุด (chunk) จะใช้ reply token ที่เหลืออยู่ก่อน แล้วจึงใช้ push เมื่อ token หมด
+
+    priority ของ outbox คือ priority ที่สำคัญที่สุดของข้อความที่ add() เข้ามา (ดู rate_limit.py)
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.messages = []
+        self.reply_tokens = []
+        self.priority = None
+
+    def add(self, message, priority=PRIORITY_NORMAL):
+        self.messages.append(message)
+        if self.priority is None or priority < self.priority:
+            self.priority = priority
+
+    def add_reply_token(self, reply_token):
+        if reply_token:
+            self.reply_tokens.append(reply_token)
+
+    def request_count(self):
+        """จำนวนคำขอที่ flush() จะส่งไปยัง LINE"""
+        return -(-len(self.messages) // LINE_MAX_MESSAGES_PER_REQUEST)
+
+    def chunks(self):
+        for start in range(0, len(self.messages), LINE_MAX_MESSAGES_PER_REQUEST):
+            yield self.messages[start:start + LINE_MAX_MESSAGES_PER_REQUEST]
+
+    def flush(self, client):
+        """
+        ส่งข้อความทั้งหมดที่สะสมไว้ผ่าน client (LineClient) แล้วล้าง buffer
+        คืนค่า list ของ response ของแต่ละคำขอ
+        """
+        responses = []
+        tokens = list(self.reply_tokens)
+        for chunk in self.chunks():
+            reply_token = tokens.pop(0) if tokens else None
+            responses.append(client.send(self.user_id, chunk, reply_token=reply_token))
+        self.messages = []
+        self.reply_tokens = tokens
+        return responses
+
+    async def flush_async(self, client):
+        """เหมือน flush() แต่ใช้ client แบบ async (AsyncLineClient)"""
+        responses = []
+        tokens = list(self.reply_tokens)
+        for chunk in self.chunks():
+            reply_token = tokens.pop(0) if tokens else None
+            responses.append(await client.send(self.user_id, chunk, reply_token=reply_token))
+        self.messages = []
+        self.reply_tokens = tokens
+        return responses
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def group_events_by_user(events):
+    """
+    จัดกลุ่ม event ใน payload เดียวกันตาม userId โดยคงลำดับเดิมของแต่ละ user
+    คืนค่า list ของ (user_id, [events]) เรียงตามลำดับที่พบ user ครั้งแรก
+    """
+    grouped = {}
+    for event in events:
+        user_id = event.get("source", {}).get("userId")
+        grouped.setdefault(user_id, []).append(event)
+    return list(grouped.items())
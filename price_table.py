@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PriceTable:
+    """
+    cache ของตารางราคาวัสดุที่โหลดจาก Google Sheets (stale-while-revalidate)
+    - get() คืนตารางปัจจุบันทันทีเสมอ ไม่รอ Sheets
+      ถ้าตารางเก่ากว่า ttl วินาที จะสั่ง refresh ใน thread เบื้องหลัง (ครั้งละหนึ่ง thread)
+    - การ refresh สร้าง dict ใหม่แล้วสลับ reference ทีเดียว (atomic swap)
+      ผู้ที่ถือ dict เดิมอยู่จะไม่เห็นข้อมูลที่ครึ่ง ๆ กลาง ๆ
+    - ตารางที่โหลดสำเร็จล่าสุดถูกบันทึกเป็น snapshot บนดิสก์
+      เพื่อให้ start() มีราคาใช้ได้ทันทีแม้ Sheets จะช้าหรือติดต่อไม่ได้
+    - version เพิ่มขึ้นทุกครั้งที่ข้อมูลราคาเปลี่ยน ใช้ตรวจว่า cache ที่อิงราคาต้องล้างหรือไม่
+
+    loader คือฟังก์ชันที่คืน dict {material: cost} (เช่น load_material_costs)
+    """
+
+    def __init__(self, loader, ttl=300.0, snapshot_path=None, retry_interval=30.0):
+        self.loader = loader
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._next_attempt = 0.0
+        self.snapshot_path = snapshot_path
+        self._table = {}
+        self._loaded_at = None
+        self._source = None
+        self.version = 0
+        self._refresh_lock = threading.Lock()
+        self._listeners = []
+
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self.last_error = None
+        self.last_refresh_seconds = None
+
+    def add_listener(self, callback):
+        """callback(table, version) ถูกเรียกทุกครั้งที่ตารางราคาเปลี่ยน"""
+        self._listeners.append(callback)
+
+    def _swap(self, table, source):
+        changed = table != self._table or self.version == 0
+        self._table = table
+        self._loaded_at = time.time()
+        self._source = source
+        if changed:
+            self.version += 1
+            for callback in self._listeners:
+                try:
+                    callback(table, self.version)
+                except Exception as e:
+                    logger.exception("อัปเดตข้อมูลที่อิงตารางราคาไม่สำเร็จ: %s", e)
+
+    def load_snapshot(self):
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        table = snapshot.get("costs") or {}
+        if not table:
+            return False
+        self._swap(table, "snapshot")
+        # ให้ snapshot ถือว่าเก่าตามเวลาที่บันทึกจริง เพื่อให้ถูก refresh จาก Sheets ตามปกติ
+        self._loaded_at = snapshot.get("saved_at", 0)
+        logger.info("Loaded MATERIAL_COSTS snapshot: %d materials", len(table))
+        return True
+
+    def _save_snapshot(self, table):
+        if not self.snapshot_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"saved_at": time.time(), "costs": table}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def refresh(self, wait=True):
+        """
+        โหลดตารางราคาใหม่จาก loader
+        wait=False: ถ้ามี refresh อื่นกำลังทำงานอยู่ให้ข้ามไปเลย
+        คืน True เมื่อโหลดสำเร็จ; เมื่อไม่สำเร็จยังคงใช้ตารางเดิม (last-known-good)
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return False
+        try:
+            started = time.perf_counter()
+            # ถ้าล้มเหลว จะไม่ลองใหม่ใน get() จนกว่าจะพ้น retry_interval
+            self._next_attempt = time.monotonic() + self.retry_interval
+            try:
+                table = self.loader()
+            except Exception as e:
+                self.refresh_failures += 1
+                self.last_error = str(e)
+                logger.warning("โหลด MATERIAL_COSTS ไม่สำเร็จ ใช้ราคาชุดเดิม: %s", e)
+                return False
+            self.last_refresh_seconds = time.perf_counter() - started
+            if not table:
+                # Sheets คืนค่าว่าง (เช่น แก้ชีตอยู่) ไม่ควรทับราคาที่ใช้ได้
+                self.refresh_failures += 1
+                self.last_error = "empty price table"
+                return False
+            self.refresh_count += 1
+            self.last_error = None
+            self._next_attempt = 0.0
+            self._swap(dict(table), "sheets")
+            try:
+                self._save_snapshot(table)
+            except OSError as e:
+                logger.warning("บันทึก snapshot ของ MATERIAL_COSTS ไม่สำเร็จ: %s", e)
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_in_background(self):
+        if self._refresh_lock.locked() or time.monotonic() < self._next_attempt:
+            return
+        threading.Thread(target=self.refresh, kwargs={"wait": False},
+                         name="price-table-refresh", daemon=True).start()
+
+    def start(self):
+        """โหลด snapshot จากดิสก์ (ถ้ามี) แล้ว refresh จาก Sheets ในเบื้องหลัง"""
+        self.load_snapshot()
+        self.refresh_in_background()
+
+    def age(self):
+        if self._loaded_at is None:
+            return None
+        return time.time() - self._loaded_at
+
+    def get(self):
+        age = self.age()
+        if age is None or age > self.ttl:
+            self.refresh_in_background()
+        return self._table
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "materials": len(self._table),
+            "source": self._source,
+            "age_seconds": self.age(),
+            "ttl_seconds": self.ttl,
+            "refreshes": self.refresh_count,
+            "refresh_failures": self.refresh_failures,
+            "last_refresh_seconds": self.last_refresh_seconds,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,249 @@
+import csv
+import io
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+from material_catalog import FALLBACK_DENSITY
+from webhook_parser import loads
+
+# numpy (ไม่บังคับ) ถูก import เมื่อคำนวณ batch ครั้งแรก เพื่อไม่เพิ่มเวลาเริ่มระบบ
+_numpy = None
+
+# ราคาต่อ kg ที่ใช้เมื่อไม่พบวัสดุในตารางราคา (เช่น ตารางเปลี่ยนระหว่างทำแบบสอบถาม)
+DEFAULT_COST_PER_KG = 150
+
+# ตัวคูณแปลงหน่วยความยาวเป็น cm
+UNIT_FACTORS = {"mm": 0.1, "cm": 1.0, "m": 100.0, "in": 2.54}
+
+# จำนวนสั่งผลิตของตารางราคาตามจำนวน (quantity break)
+QUANTITY_TIERS = (100, 500, 1000, 5000)
+
+Quote = namedtuple("Quote", ["volume", "weight_kg", "total_cost"])
+TierPrice = namedtuple("TierPrice", ["quantity", "total_cost", "unit_cost"])
+
+_SEPARATORS = re.compile(r"[x×✕✖*]")
+_PART = re.compile(r"^(\d+(?:\.\d+)?)\s*(mm|cm|m|in)?$")
+_TRAILING_UNIT = re.compile(r"\s*(mm|cm|m|in)\s*$")
+
+
+class DimensionError(ValueError):
+    pass
+
+
+def parse_dimensions(text, default_unit="cm"):
+    """
+    แปลงขนาดชิ้นงาน "กว้างxยาวxสูง" เป็น tuple (กว้าง, ยาว, สูง) หน่วย cm
+    รองรับตัวคั่น x, ×, *, ช่องว่าง, ตัวอักษร full-width และหน่วย mm/cm/m/in
+    ทั้งแบบระบุท้ายสุด ("100x50x20 mm") และระบุทุกค่า ("10cm x 50mm x 2cm")
+    """
+    # ³ ต้องตัดก่อน NFKC เพราะจะถูกแปลงเป็นเลข 3
+    normalized = unicodedata.normalize("NFKC", (text or "").replace("³", "")).casefold().strip()
+    if default_unit is not None and not isinstance(default_unit, str):
+        # เช่น {"unit": 5} ใน JSON ของ /quote/batch
+        raise DimensionError(f"หน่วยต้องเป็นข้อความ: {default_unit!r}")
+    unit = (default_unit or "cm").strip().casefold()
+    if unit not in UNIT_FACTORS:
+        raise DimensionError(f"ไม่รู้จักหน่วย {default_unit!r} (ใช้ได้: {', '.join(UNIT_FACTORS)})")
+    match = _TRAILING_UNIT.search(normalized)
+    if match and not _SEPARATORS.search(normalized[match.start():]):
+        unit = match.group(1)
+        normalized = normalized[:match.start()]
+    if _SEPARATORS.search(normalized):
+        parts = [part.strip() for part in _SEPARATORS.split(normalized)]
+    else:
+        parts = normalized.split()
+    if len(parts) != 3:
+        raise DimensionError(f"ต้องมีขนาด 3 ค่า (กว้างxยาวxสูง): {text!r}")
+    dimensions = []
+    for part in parts:
+        match = _PART.match(part)
+        if not match:
+            raise DimensionError(f"ขนาดไม่ถูกต้อง: {part!r}")
+        # ปัดเศษทศนิยมที่เกิดจากการแปลงหน่วย (เช่น 105 mm * 0.1 = 10.500000000000002)
+        value = round(float(match.group(1)) * UNIT_FACTORS[match.group(2) or unit], 9)
+        if value <= 0:
+            raise DimensionError(f"ขนาดต้องมากกว่า 0: {part!r}")
+        dimensions.append(value)
+    return tuple(dimensions)
+
+
+def format_dimensions(dimensions):
+    """
+    ขนาด (cm) ในรูปแบบมาตรฐาน เช่น (10.0, 5.0, 2.0) -> 10x5x2
+    ใช้ทศนิยมแบบ fixed-point (ไม่ใช้ 1e-05) เพื่อให้ parse_dimensions อ่านค่าเดิมกลับได้เสมอ
+    """
+    return "x".join(_format_value(value) for value in dimensions)
+
+
+def _format_value(value):
+    # parse_dimensions ปัดที่ทศนิยม 9 ตำแหน่ง ทศนิยม 9 ตำแหน่งจึงพอสำหรับค่าเดิม
+    return f"{value:.9f}".rstrip("0").rstrip(".")
+
+
+def material_terms(catalog, material):
+    """คืน (ชื่อวัสดุ, ราคาต่อ kg, ความหนาแน่น g/cm³) จาก MaterialCatalog หรือ None ถ้าไม่พบ"""
+    entry = catalog.lookup(material)
+    if entry is None:
+        return None
+    return entry.name, entry.cost, entry.density
+
+
+def quote(dimensions, quantity, cost_per_kg=DEFAULT_COST_PER_KG, density=FALLBACK_DENSITY):
+    """คำนวณปริมาตร (cm³), น้ำหนักต่อชิ้น (kg) และต้นทุนรวม ของชิ้นงานหนึ่งรายการ"""
+    width, length, height = dimensions
+    volume = width * length * height
+    weight_kg = (volume * density) / 1000
+    total_cost = weight_kg * quantity * cost_per_kg
+    return Quote(volume, weight_kg, total_cost)
+
+
+def tier_prices(weight_kg, cost_per_kg, tiers=QUANTITY_TIERS):
+    """ต้นทุนรวมและต้นทุนต่อชิ้นของแต่ละจำนวนใน tiers (สูตรเดียวกับ quote())"""
+    prices = []
+    for quantity in tiers:
+        total_cost = weight_kg * quantity * cost_per_kg
+        prices.append(TierPrice(quantity, total_cost, total_cost / quantity))
+    return prices
+
+
+class PartCache:
+    """
+    LRU cache ขนาดจำกัดของผลคำนวณที่ไม่ขึ้นกับจำนวน (ปริมาตร, น้ำหนัก, ตารางราคาตามจำนวน ฯลฯ)
+    key ควรประกอบด้วย (ชื่อวัสดุ, ขนาดที่ normalise แล้ว, version ของตารางราคา)
+    ทำให้ผลที่คำนวณจากราคาชุดเก่าไม่ถูกใช้อีก และ clear() เมื่อตารางราคาเปลี่ยนเพื่อคืนหน่วยความจำ
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """คืนค่าของ key จาก cache หรือเรียก compute() แล้วเก็บไว้"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+def _load_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:  # คำนวณแบบ batch ด้วย Python ธรรมดาเมื่อไม่ได้ติดตั้ง numpy
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def quote_arrays(dimensions, quantities, costs, densities):
+    """
+    คำนวณหลายรายการพร้อมกัน (สูตรและลำดับการคำนวณเดียวกับ quote() ผลลัพธ์จึงตรงกันทุกหลัก)
+    dimensions: ลำดับของ (กว้าง, ยาว, สูง); คืน (volumes, weights, totals) เป็น list
+    """
+    if not dimensions:
+        return [], [], []
+    np = _load_numpy()
+    if np is None:
+        quotes = [quote(d, q, c, r) for d, q, c, r in zip(dimensions, quantities, costs, densities)]
+        return [q.volume for q in quotes], [q.weight_kg for q in quotes], [q.total_cost for q in quotes]
+    dims = np.asarray(dimensions, dtype=np.float64)
+    volumes = dims[:, 0] * dims[:, 1] * dims[:, 2]
+    weights = (volumes * np.asarray(densities, dtype=np.float64)) / 1000
+    totals = weights * np.asarray(quantities, dtype=np.float64) * np.asarray(costs, dtype=np.float64)
+    return volumes.tolist(), weights.tolist(), totals.tolist()
+
+
+def read_batch_rows(body, content_type):
+    """
+    อ่านรายการจาก request ของ /quote/batch
+    - JSON: list ของ object หรือ {"items": [...]} โดยแต่ละรายการมี material, size, quantity (unit ไม่บังคับ)
+    - CSV: แถวแรกเป็นหัวคอลัมน์ material,size,quantity[,unit]
+    """
+    if "csv" in (content_type or ""):
+        text = body.decode("utf-8-sig")
+        reader = csv.DictReader(io.StringIO(text))
+        try:
+            return [{(key or "").strip().lower(): (value or "").strip() for key, value in row.items()
+                     if isinstance(value, str)} for row in reader]
+        except csv.Error as e:
+            raise ValueError(f"CSV ไม่ถูกต้อง: {e}")
+    data = loads(body)
+    if isinstance(data, dict):
+        data = data.get("items")
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValueError("ต้องเป็น list ของรายการ หรือ {\"items\": [...]}")
+    return data
+
+
+def quote_batch(rows, catalog):
+    """
+    คำนวณใบเสนอราคาหลายรายการด้วยตารางราคาเดียวกัน
+    รายการที่ข้อมูลผิด (ขนาด/จำนวน/วัสดุ) จะมี field "error" แทนผลลัพธ์ โดยไม่กระทบรายการอื่น
+    """
+    results = []
+    valid = []
+    dimensions, quantities, costs, densities = [], [], [], []
+    for index, row in enumerate(rows):
+        result = {"row": index + 1, "material": row.get("material"), "size": row.get("size"),
+                  "quantity": row.get("quantity")}
+        results.append(result)
+        terms = material_terms(catalog, str(row.get("material") or ""))
+        if terms is None:
+            result["error"] = "ไม่พบวัสดุ"
+            continue
+        try:
+            dims = parse_dimensions(str(row.get("size") or ""), default_unit=row.get("unit") or "cm")
+        except DimensionError as e:
+            result["error"] = str(e)
+            continue
+        try:
+            quantity = int(str(row.get("quantity")).strip())
+            if quantity <= 0:
+                raise ValueError
+        except ValueError:
+            result["error"] = "จำนวนต้องเป็นจำนวนเต็มบวก"
+            continue
+        name, cost, density = terms
+        result.update(material=name, quantity=quantity, dimensions_cm=list(dims), cost_per_kg=cost)
+        valid.append(result)
+        dimensions.append(dims)
+        quantities.append(quantity)
+        costs.append(cost)
+        densities.append(density)
+    volumes, weights, totals = quote_arrays(dimensions, quantities, costs, densities)
+    for result, volume, weight_kg, total_cost in zip(valid, volumes, weights, totals):
+        result.update(volume=volume, weight_kg=weight_kg, total_cost=total_cost)
+    return results
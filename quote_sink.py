@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: ใช้ได้เฉพาะโปรเซสเดียว
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class QuoteSink:
+    """
+    ตัวเขียนข้อมูลใบเสนอราคาแบบ write-behind
+    submit() เขียน record ลง spool file (JSONL แบบต่อท้ายอย่างเดียว, fsync) แล้วคืนค่าทันที
+    thread เบื้องหลังจะอ่าน record ที่ยังไม่ถูกส่ง แล้วเรียก writer แต่ละตัวเป็น batch
+    เมื่อครบ batch_size หรือทุก flush_interval วินาที
+
+    writers คือ dict ของ {ชื่อ: ฟังก์ชันที่รับ list ของ record} เช่น Sheets และ BigQuery
+    แต่ละ writer เก็บตำแหน่ง (byte offset) ที่ส่งสำเร็จแล้วของตัวเองในไฟล์ .offset
+    writer ที่ล้มเหลวจะถูก retry ภายหลังโดยไม่กระทบ writer อื่น และข้อมูลยังอยู่ครบหลัง restart
+    เมื่อทุก writer ส่งครบแล้ว spool file จะถูกล้างเพื่อไม่ให้โตไม่สิ้นสุด
+    บรรทัดที่อ่านเป็น JSON ไม่ได้ (เช่น เขียนไม่ครบตอนโปรเซสล้ม) ถูกย้ายไปไว้ในไฟล์ .bad แล้วข้ามไป
+
+    หลาย worker process (เช่น gunicorn) ใช้ spool เดียวกันได้: การ flush และการล้างไฟล์
+    ถูกป้องกันด้วย file lock (fcntl) ข้ามโปรเซส
+    """
+
+    def __init__(self, spool_path, writers, batch_size=50, flush_interval=5.0, retry_interval=30.0):
+        self.spool_path = spool_path
+        self.writers = dict(writers)
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pending = 0
+        self._retry_at = {name: 0.0 for name in self.writers}
+        # offset ของบรรทัดเสียที่ย้ายไป .bad แล้ว (writer ทุกตัวอ่านเจอบรรทัดเดียวกัน แต่ย้ายครั้งเดียว)
+        self._quarantined = set()
+        self.bad_lines = 0
+
+        self.submitted = 0
+        self.flushed = {name: 0 for name in self.writers}
+        self.failures = {name: 0 for name in self.writers}
+        self.last_error = {name: None for name in self.writers}
+
+        directory = os.path.dirname(os.path.abspath(spool_path))
+        os.makedirs(directory, exist_ok=True)
+        self._offsets = {name: self._read_offset(name) for name in self.writers}
+        # ถ้าโปรเซสหยุดระหว่างล้าง spool อาจเหลือ offset ที่เกินขนาดไฟล์ ให้เริ่มใหม่จาก 0
+        size = self._spool_size()
+        for name, offset in self._offsets.items():
+            if offset > size:
+                self._offsets[name] = 0
+
+    # ------------------ spool file ------------------
+
+    @contextmanager
+    def _file_lock(self, suffix, exclusive=True):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.spool_path}.{suffix}", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _offset_path(self, name):
+        return f"{self.spool_path}.{name}.offset"
+
+    def _read_offset(self, name):
+        try:
+            with open(self._offset_path(name)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self, name, offset):
+        path = self._offset_path(name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._offsets[name] = offset
+
+    def _spool_size(self):
+        try:
+            return os.path.getsize(self.spool_path)
+        except OSError:
+            return 0
+
+    def _read_batch(self, offset):
+        """อ่าน record ที่สมบูรณ์ (จบด้วย newline) ตั้งแต่ offset คืน (records, offset ใหม่)"""
+        records = []
+        try:
+            with open(self.spool_path, "rb") as f:
+                f.seek(offset)
+                while len(records) < self.batch_size:
+                    line = f.readline()
+                    if not line or not line.endswith(b"\n"):
+                        break
+                    start = offset
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError as e:
+                        self._quarantine(start, line, e)
+        except FileNotFoundError:
+            pass
+        return records, offset
+
+    def _quarantine(self, offset, line, error):
+        if offset in self._quarantined:
+            return
+        self._quarantined.add(offset)
+        self.bad_lines += 1
+        logger.error("ข้าม record ที่เสียใน spool (byte %d): %s", offset, error)
+        with open(f"{self.spool_path}.bad", "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ------------------ public API ------------------
+
+    def submit(self, record):
+        """บันทึก record ลง spool อย่างถาวร แล้วให้ thread เบื้องหลังส่งต่อ"""
+        record = dict(record)
+        record.setdefault("row_id", uuid.uuid4().hex)
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock, self._file_lock("append.lock", exclusive=False):
+            with open(self.spool_path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.submitted += 1
+            self._pending += 1
+            pending = self._pending
+        if self._thread is None:
+            self.start()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        return record["row_id"]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="quote-sink", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """หยุด thread เบื้องหลังหลังจากพยายาม flush รอบสุดท้าย"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # ข้อผิดพลาดของรอบนี้ (เช่น ดิสก์มีปัญหา) ต้องไม่ทำให้ thread หยุดส่งข้อมูลถาวร
+                logger.exception("flush spool ไม่สำเร็จ: %s", e)
+        try:
+            self.flush(force=True)
+        except Exception as e:
+            logger.exception("flush spool รอบสุดท้ายไม่สำเร็จ: %s", e)
+
+    def flush(self, force=False):
+        """
+        ส่ง record ที่ค้างอยู่ให้ทุก writer จนกว่าจะหมดหรือ writer ล้มเหลว
+        writer ที่เพิ่งล้มเหลวจะถูกข้ามจนถึงเวลา retry (ยกเว้น force=True)
+        """
+        with self._flush_lock, self._file_lock("flush.lock"):
+            now = time.monotonic()
+            size = self._spool_size()
+            for name in self.writers:
+                # โปรเซสอื่นอาจ flush ไปแล้ว จึงอ่าน offset ล่าสุดจากดิสก์ทุกครั้ง
+                offset = self._read_offset(name)
+                self._offsets[name] = offset if offset <= size else 0
+            for name, writer in self.writers.items():
+                if not force and now < self._retry_at[name]:
+                    continue
+                while True:
+                    records, new_offset = self._read_batch(self._offsets[name])
+                    if not records:
+                        if new_offset > self._offsets[name]:
+                            # เหลือแต่บรรทัดว่าง/บรรทัดเสีย: ขยับ offset ข้ามไป
+                            self._write_offset(name, new_offset)
+                        break
+                    try:
+                        writer(records)
+                    except Exception as e:
+                        self.failures[name] += 1
+                        self.last_error[name] = str(e)
+                        self._retry_at[name] = time.monotonic() + self.retry_interval
+                        logger.warning("ส่งข้อมูลไป %s ไม่สำเร็จ จะลองใหม่ภายหลัง: %s", name, e)
+                        break
+                    self._write_offset(name, new_offset)
+                    self.flushed[name] += len(records)
+                    self.last_error[name] = None
+            self._compact()
+
+    def _compact(self):
+        """ล้าง spool file เมื่อทุก writer ส่งครบแล้ว"""
+        with self._lock, self._file_lock("append.lock"):
+            size = self._spool_size()
+            if size == 0 or any(offset < size for offset in self._offsets.values()):
+                self._pending = self._count_pending(size)
+                return
+            with open(self.spool_path, "wb") as f:
+                f.flush()
+                os.fsync(f.fileno())
+            for name in self.writers:
+                self._write_offset(name, 0)
+            self._quarantined.clear()
+            self._pending = 0
+
+    def _count_pending(self, size):
+        if not self._offsets:
+            return 0
+        oldest = min(self._offsets.values())
+        if oldest >= size:
+            return 0
+        with open(self.spool_path, "rb") as f:
+            f.seek(oldest)
+            return sum(1 for line in f if line.endswith(b"\n"))
+
+    def stats(self):
+        with self._lock:
+            size = self._spool_size()
+            return {
+                "spool_bytes": size,
+                "pending": self._pending,
+                "submitted": self.submitted,
+                "flushed": dict(self.flushed),
+                "failures": dict(self.failures),
+                "bad_lines": self.bad_lines,
+                "last_error": dict(self.last_error),
+                "behind_bytes": {name: max(0, size - offset) for name, offset in self._offsets.items()},
+            }
@@ -0,0 +1,353 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from metrics import OUTBOUND_DROPPED, OUTBOUND_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# priority ของข้อความขาออก (ค่าน้อย = สำคัญกว่า)
+PRIORITY_QUOTE = 0   # ผลคำนวณราคา/ยืนยันใบเสนอราคา: ไม่ถูกทิ้ง
+PRIORITY_NORMAL = 1  # ข้อความของแบบสอบถามและอื่น ๆ
+PRIORITY_LOW = 2     # เมนู, FAQ, ข้อความต้อนรับ: ถูกเลื่อนและทิ้งก่อน
+PRIORITY_NAMES = {PRIORITY_QUOTE: "quote", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+
+class TokenBucket:
+    """
+    token bucket: เติม rate token ต่อวินาที เก็บได้สูงสุด burst token (rate <= 0 = ไม่จำกัด)
+    ไม่ thread-safe ด้วยตัวเอง (OutboundScheduler เรียกภายใต้ lock ของตัวเอง)
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost, now):
+        """วินาทีที่ต้องรอจนมี token พอสำหรับ cost (0 = ส่งได้ทันที)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost, now):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= min(cost, self.burst)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ("user_id", "run", "priority", "cost", "loop", "context", "enqueued", "throttled")
+
+    def __init__(self, user_id, run, priority, cost, loop):
+        self.user_id = user_id
+        self.run = run
+        self.priority = priority
+        self.cost = cost
+        self.loop = loop
+        # request id ของ log ติดไปกับการส่งที่ถูกเลื่อนออกไป
+        self.context = contextvars.copy_context()
+        self.enqueued = time.monotonic()
+        self.throttled = set()
+
+
+class OutboundScheduler:
+    """
+    คิวกลางของการส่งข้อความไปยัง LINE ที่
+    - จำกัดอัตราด้วย token bucket ต่อ channel (ทั้งโปรเซส) และต่อ user: user ที่ส่งรัว ๆ ถูกเลื่อน
+      โดยไม่กระทบ user อื่น และ channel ไม่เกินโควต้าของ LINE
+    - สลับส่งระหว่าง user แบบ round-robin และเลือกงานที่ priority สำคัญที่สุดก่อน
+      (งานของ user เดียวกันส่งตามลำดับทีละงานเสมอ)
+    - ทิ้งงานที่รอนานเกิน max_delay และเมื่อคิวเต็ม (ทิ้งงานที่สำคัญน้อยที่สุดของ user ที่ค้างมากที่สุดก่อน)
+      เฉพาะ priority ที่อยู่ใน max_delay เท่านั้นที่ถูกทิ้ง (ค่าเริ่มต้นคือ PRIORITY_LOW)
+      ข้อความของแบบสอบถาม (PRIORITY_NORMAL) ไม่ถูกทิ้ง เพราะ session ไปขั้นถัดไปแล้ว ถ้าทิ้ง user จะค้างที่ขั้นนั้น
+
+    งานหนึ่งงานคือการ flush Outbox หนึ่งครั้ง cost = จำนวนคำขอไปยัง LINE
+    submit(..., loop=loop) ใช้กับ coroutine function (เช่นจาก ASGI app) ซึ่งจะถูกรันบน event loop นั้น
+    งานแบบปกติรันใน worker thread ของตัวเองจำนวน workers
+    (ไม่ใช้ ThreadPoolExecutor เพราะ pool ถูกปิดก่อน atexit ทำให้ stop() ตอนโปรเซสปิดส่งงานที่ค้างไม่ได้)
+    งานที่ raise exception นับเป็น failed ไม่นับเป็น sent
+    """
+
+    def __init__(self, channel_rate=100, channel_burst=200, user_rate=1, user_burst=10, max_queue=5000,
+                 max_delay=None, workers=10):
+        self.channel = TokenBucket(channel_rate, channel_burst)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        # priority -> วินาทีที่รอได้ก่อนถูกทิ้ง (priority ที่ไม่อยู่ใน dict ไม่ถูกทิ้ง)
+        self.max_delay = {PRIORITY_LOW: 10.0} if max_delay is None else max_delay
+        self.workers = workers
+        self._queues = {}
+        self._ring = deque()
+        self._busy = set()
+        self._buckets = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._work = deque()
+        self._work_ready = threading.Condition()
+        self._workers = []
+        self._thread = None
+        self._stopping = False
+        self._next_prune = 0.0
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = {"user": 0, "channel": 0}
+        self.dropped = {}
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._workers = [threading.Thread(target=self._work_loop, name=f"line-send-{index}", daemon=True)
+                                 for index in range(max(1, self.workers))]
+                for worker in self._workers:
+                    worker.start()
+                self._thread = threading.Thread(target=self._run, name="outbound-scheduler", daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id, run, priority=PRIORITY_NORMAL, cost=1, loop=None):
+        """เข้าคิวงานส่งข้อความของ user คืน False ถ้างานถูกทิ้งทันทีเพราะคิวเต็ม"""
+        if self._thread is None:
+            self.start()
+        job = _Job(user_id, run, priority, max(1, cost), loop)
+        with self._cond:
+            if self._size >= self.max_queue and not self._make_room(job.priority):
+                self._drop(job, "queue_full")
+                return False
+            queue = self._queues.get(user_id)
+            if queue is None:
+                queue = self._queues[user_id] = deque()
+                self._ring.append(user_id)
+            queue.append(job)
+            self._size += 1
+            self.submitted += 1
+            self._cond.notify()
+        return True
+
+    # ------------------ การเลือกงาน (เรียกภายใต้ self._cond) ------------------
+
+    def _drop(self, job, reason):
+        name = PRIORITY_NAMES.get(job.priority, str(job.priority))
+        entry = self.dropped.setdefault(name, {})
+        entry[reason] = entry.get(reason, 0) + 1
+        OUTBOUND_DROPPED.inc(priority=name, reason=reason)
+        logger.info("ทิ้งข้อความถึง %s (priority=%s, %s) หลังรอ %.1f วินาที",
+                    job.user_id, name, reason, time.monotonic() - job.enqueued)
+
+    def _remove(self, user_id, job):
+        queue = self._queues[user_id]
+        queue.remove(job)
+        self._size -= 1
+        if not queue:
+            del self._queues[user_id]
+            self._ring.remove(user_id)
+
+    def _expired(self, job, now):
+        limit = self.max_delay.get(job.priority)
+        return limit is not None and now - job.enqueued > limit
+
+    def _make_room(self, priority):
+        """ทิ้งงานที่หมดเวลา แล้วถ้ายังเต็มจึงทิ้งงานที่สำคัญน้อยกว่าหรือเท่ากับ priority นี้หนึ่งงาน"""
+        now = time.monotonic()
+        for user_id, queue in list(self._queues.items()):
+            for job in [job for job in queue if self._expired(job, now)]:
+                self._remove(user_id, job)
+                self._drop(job, "expired")
+        if self._size < self.max_queue:
+            return True
+        # งานที่สำคัญน้อยที่สุด ของ user ที่มีงานค้างมากที่สุด (เช่น user ที่ส่งรัว ๆ) และเก่าที่สุด
+        victim = None
+        victim_key = None
+        for queue in self._queues.values():
+            for job in queue:
+                if job.priority not in self.max_delay:
+                    continue
+                key = (job.priority, len(queue), -job.enqueued)
+                if victim is None or key > victim_key:
+                    victim, victim_key = job, key
+        if victim is None or victim.priority < priority:
+            # คิวเต็มด้วยงานที่สำคัญกว่า: งานที่ไม่อยู่ใน max_delay ยังรับเสมอ งานอื่นถูกทิ้ง
+            return priority not in self.max_delay
+        self._remove(victim.user_id, victim)
+        self._drop(victim, "queue_full")
+        return True
+
+    def _bucket(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _prune_buckets(self, now):
+        # bucket ที่เต็มแล้วของ user ที่ไม่มีงานค้าง ไม่ต่างจาก bucket ใหม่ ลบทิ้งเพื่อคืนหน่วยความจำ
+        if now < self._next_prune:
+            return
+        self._next_prune = now + 60
+        for user_id in [user_id for user_id, bucket in self._buckets.items()
+                        if user_id not in self._queues and bucket.full(now)]:
+            del self._buckets[user_id]
+
+    def _select(self, now):
+        """คืน (งานที่ส่งได้ตอนนี้, None) หรือ (None, วินาทีที่ควรรอ)"""
+        best = None
+        wait = math.inf
+        for user_id in list(self._ring):
+            if user_id in self._busy:
+                continue
+            queue = self._queues[user_id]
+            while queue and self._expired(queue[0], now):
+                job = queue[0]
+                self._remove(user_id, job)
+                self._drop(job, "expired")
+            if not queue:
+                continue
+            job = queue[0]
+            if best is not None and job.priority >= best.priority:
+                continue
+            user_wait = self._bucket(user_id).wait_time(job.cost, now)
+            if user_wait:
+                if "user" not in job.throttled:
+                    job.throttled.add("user")
+                    self.throttled["user"] += 1
+                    OUTBOUND_THROTTLED.inc(scope="user")
+                wait = min(wait, user_wait)
+                continue
+            best = job
+        if best is None:
+            return None, wait
+        channel_wait = self.channel.wait_time(best.cost, now)
+        if channel_wait:
+            if "channel" not in best.throttled:
+                best.throttled.add("channel")
+                self.throttled["channel"] += 1
+                OUTBOUND_THROTTLED.inc(scope="channel")
+            return None, min(wait, channel_wait)
+        self.channel.take(best.cost, now)
+        self._bucket(best.user_id).take(best.cost, now)
+        self._remove(best.user_id, best)
+        if best.user_id in self._queues:
+            # user ที่เพิ่งได้ส่งไปต่อท้าย round-robin
+            self._ring.remove(best.user_id)
+            self._ring.append(best.user_id)
+        return best, None
+
+    # ------------------ การส่ง ------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.monotonic()
+                    self._prune_buckets(now)
+                    job, wait = self._select(now)
+                    if job is not None:
+                        break
+                    self._cond.wait(None if wait == math.inf else wait)
+                self._busy.add(job.user_id)
+            self._dispatch(job)
+
+    def _dispatch(self, job):
+        if job.loop is None:
+            with self._work_ready:
+                self._work.append(job)
+                self._work_ready.notify()
+            return
+        try:
+            job.loop.call_soon_threadsafe(self._start_task, job, context=job.context)
+        except RuntimeError as e:
+            # event loop ปิดไปแล้ว
+            self._finish(job, e)
+
+    def _work_loop(self):
+        while True:
+            with self._work_ready:
+                while not self._work:
+                    self._work_ready.wait()
+                job = self._work.popleft()
+            if job is None:
+                return
+            try:
+                job.context.run(job.run)
+            except Exception as e:
+                self._finish(job, e)
+            else:
+                self._finish(job)
+
+    def _start_task(self, job):
+        task = job.loop.create_task(job.run())
+        task.add_done_callback(lambda future: self._done(job, future))
+
+    def _done(self, job, future):
+        if future.cancelled():
+            self._finish(job, "cancelled")
+        else:
+            self._finish(job, future.exception())
+
+    def _finish(self, job, error=None):
+        if error is not None:
+            logger.error("ส่งข้อความถึง %s ไม่สำเร็จ (%d คำขอ): %s", job.user_id, job.cost, error)
+        with self._cond:
+            self._busy.discard(job.user_id)
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        """รอจนส่งงานที่ค้างทั้งหมดเสร็จ คืน False ถ้าครบ timeout ก่อน"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._size and not self._busy, timeout)
+
+    def stop(self, timeout=10):
+        """ส่งงานที่ค้างให้เสร็จ (ไม่เกิน timeout วินาที) แล้วหยุด thread"""
+        if self._thread is None:
+            return
+        self.drain(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._work_ready:
+            self._work.extend([None] * len(self._workers))
+            self._work_ready.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._thread = None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self._size,
+                "users_queued": len(self._queues),
+                "in_flight": len(self._busy),
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "failed": self.failed,
+                "throttled": dict(self.throttled),
+                "dropped": {name: dict(reasons) for name, reasons in self.dropped.items()},
+                "user_buckets": len(self._buckets),
+                "channel_tokens": round(self.channel.tokens, 2),
+            }
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from metrics import UPSTREAM_REJECTIONS, UPSTREAM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """upstream ถูกตัดวงจรอยู่ (ล้มเหลวติดต่อกันเกินเกณฑ์) คำขอถูกปฏิเสธทันทีโดยไม่ส่งออกไป"""
+
+
+class BulkheadFullError(Exception):
+    """คำขอไปยัง upstream นี้พร้อมกันครบจำนวนที่อนุญาตแล้ว"""
+
+
+class InjectedFault(ConnectionError):
+    """ข้อผิดพลาดจำลองจาก FaultInjector (เป็น ConnectionError จึงถูกจัดการเหมือนเครือข่ายขัดข้องจริง)"""
+
+
+class CircuitBreaker:
+    """
+    circuit breaker ของ upstream หนึ่งตัว
+    - closed: ส่งคำขอตามปกติ นับความล้มเหลวติดต่อกัน
+    - open: ล้มเหลวติดต่อกันครบ failure_threshold ครั้ง ปฏิเสธทุกคำขอเป็นเวลา reset_timeout วินาที
+    - half_open: หลังครบเวลา ปล่อยคำขอทดลองหนึ่งคำขอ สำเร็จ = closed, ล้มเหลว = open อีกรอบ
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                return True
+            return False
+
+
+class FaultInjector:
+    """
+    จำลองความช้า/ความล้มเหลวของ upstream สำหรับทดสอบกับ service จำลองในเครื่อง
+    ตั้งค่าด้วย configure("sheets:error=0.5,latency=2;line:latency=0.3")
+    หรือ set("sheets", error_rate=1.0) — ไม่มีผลใด ๆ เมื่อไม่ได้ตั้งค่า
+    """
+
+    def __init__(self):
+        self._faults = {}
+
+    def set(self, upstream, latency=0.0, error_rate=0.0):
+        self._faults[upstream] = (float(latency), float(error_rate))
+
+    def clear(self, upstream=None):
+        if upstream is None:
+            self._faults.clear()
+        else:
+            self._faults.pop(upstream, None)
+
+    def configure(self, spec):
+        for entry in (spec or "").split(";"):
+            if not entry.strip():
+                continue
+            upstream, _, options = entry.partition(":")
+            values = dict(option.split("=", 1) for option in options.split(",") if "=" in option)
+            self.set(upstream.strip(), latency=values.get("latency", 0), error_rate=values.get("error", 0))
+
+    def _fault(self, upstream):
+        fault = self._faults.get(upstream)
+        if fault is None:
+            return 0.0, False
+        latency, error_rate = fault
+        return latency, random.random() < error_rate
+
+    def before_call(self, upstream):
+        latency, fail = self._fault(upstream)
+        if latency:
+            time.sleep(latency)
+        if fail:
+            raise InjectedFault(f"injected fault: {upstream}")
+
+    async def before_call_async(self, upstream):
+        latency, fail = self._fault(upstream)
+        if latency:
+            await asyncio.sleep(latency)
+        if fail:
+            raise InjectedFault(f"injected fault: {upstream}")
+
+    def stats(self):
+        return {name: {"latency": latency, "error_rate": rate} for name, (latency, rate) in self._faults.items()}
+
+
+FAULTS = FaultInjector()
+
+
+def _always(error):
+    return True
+
+
+class Upstream:
+    """
+    จุดเรียก dependency ภายนอกหนึ่งตัว (LINE, Sheets, BigQuery) ที่รวม
+    - bulkhead: จำกัดจำนวนคำขอพร้อมกัน dependency ที่ค้างจึงกิน thread ได้ไม่เกิน max_concurrent
+    - circuit breaker: ล้มเหลวติดต่อกันแล้วปฏิเสธทันที (CircuitOpenError) แทนการรอ timeout ซ้ำ ๆ
+    - retry: ไม่เกิน attempts ครั้ง รอแบบ exponential backoff พร้อม full jitter
+      เฉพาะข้อผิดพลาดที่ retry_on(error) คืน True
+    - fault injection: FAULTS.before_call(name) ก่อนส่งคำขอจริง
+
+    is_failure_result(result) ใช้กับ client ที่คืน response แทนการ raise (เช่น HTTP 5xx ของ LINE)
+    timeout ของคำขอแต่ละครั้งกำหนดที่ client ของแต่ละ upstream
+    """
+
+    def __init__(self, name, max_concurrent=10, acquire_timeout=1.0, failure_threshold=5, reset_timeout=30.0,
+                 attempts=1, backoff=0.2, max_backoff=5.0, retry_on=None, is_failure_result=None):
+        self.name = name
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_concurrent = max_concurrent
+        self.acquire_timeout = acquire_timeout
+        self._bulkhead = threading.BoundedSemaphore(max_concurrent)
+        self.attempts = max(1, int(attempts))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on or _always
+        self.is_failure_result = is_failure_result
+        self._stats_lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = {"circuit_open": 0, "bulkhead_full": 0}
+
+    def _reject(self, reason):
+        with self._stats_lock:
+            self.rejected[reason] += 1
+        UPSTREAM_REJECTIONS.inc(upstream=self.name, reason=reason)
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def _record(self, error=None, result=None):
+        failed = error is not None or (self.is_failure_result is not None and self.is_failure_result(result))
+        with self._stats_lock:
+            self.calls += 1
+            if failed:
+                self.failures += 1
+        if not failed:
+            self.breaker.record_success()
+        elif self.breaker.record_failure():
+            logger.warning("ตัดวงจร %s ชั่วคราว %g วินาที หลังล้มเหลวติดต่อกัน %d ครั้ง",
+                           self.name, self.breaker.reset_timeout, self.breaker.failures)
+
+    def _should_retry(self, error, attempt, attempts):
+        if attempt + 1 >= attempts or not self.retry_on(error):
+            return False
+        with self._stats_lock:
+            self.retries += 1
+        UPSTREAM_RETRIES.inc(upstream=self.name, operation="call")
+        return True
+
+    def call(self, func, *args, **kwargs):
+        """เรียก func(*args, **kwargs) ผ่าน bulkhead/circuit breaker/retry"""
+        return self._call(func, args, kwargs, self.attempts)
+
+    def call_once(self, func, *args, **kwargs):
+        """เหมือน call() แต่ไม่ retry (สำหรับคำขอที่ไม่ idempotent เช่น Sheets append)"""
+        return self._call(func, args, kwargs, 1)
+
+    def _call(self, func, args, kwargs, attempts):
+        if not self._bulkhead.acquire(timeout=self.acquire_timeout):
+            self._reject("bulkhead_full")
+            raise BulkheadFullError(f"{self.name}: มีคำขอค้างอยู่ครบ {self.max_concurrent} แล้ว")
+        try:
+            attempt = 0
+            while True:
+                if not self.breaker.allow():
+                    self._reject("circuit_open")
+                    raise CircuitOpenError(f"{self.name}: circuit open")
+                try:
+                    FAULTS.before_call(self.name)
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    self._record(error=e)
+                    if not self._should_retry(e, attempt, attempts):
+                        raise
+                else:
+                    self._record(result=result)
+                    return result
+                time.sleep(self._delay(attempt))
+                attempt += 1
+        finally:
+            self._bulkhead.release()
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        เวอร์ชัน async ของ call() สำหรับ coroutine function (เช่น AsyncLineClient.send)
+        ไม่มี bulkhead เพราะจำนวนคำขอพร้อมกันถูกจำกัดโดย connection pool ของ client อยู่แล้ว
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._reject("circuit_open")
+                raise CircuitOpenError(f"{self.name}: circuit open")
+            try:
+                await FAULTS.before_call_async(self.name)
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self._record(error=e)
+                if not self._should_retry(e, attempt, self.attempts):
+                    raise
+            else:
+                self._record(result=result)
+                return result
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "state": self.breaker.state,
+                "consecutive_failures": self.breaker.failures,
+                "opened": self.breaker.opened,
+                "calls": self.calls,
+                "failures": self.failures,
+                "retries": self.retries,
+                "rejected": dict(self.rejected),
+                "max_concurrent": self.max_concurrent,
+            }
+
+
+class GuardedClient:
+    """ห่อ LINE client (sync) ให้ send() ผ่าน Upstream ใช้แทน client เดิมใน Outbox.flush()"""
+
+    def __init__(self, client, upstream):
+        self.client = client
+        self.upstream = upstream
+
+    def send(self, *args, **kwargs):
+        return self.upstream.call(self.client.send, *args, **kwargs)
+
+
+class AsyncGuardedClient:
+    """เหมือน GuardedClient สำหรับ AsyncLineClient ใช้กับ Outbox.flush_async()"""
+
+    def __init__(self, client, upstream):
+        self.client = client
+        self.upstream = upstream
+
+    async def send(self, *args, **kwargs):
+        return await self.upstream.call_async(self.client.send, *args, **kwargs)
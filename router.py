@@ -0,0 +1,182 @@
+import re
+import threading
+import time
+
+from metrics import HANDLER_ERRORS, HANDLER_SECONDS
+
+
+def normalize_command(text):
+    """ทำให้คำสั่งอยู่ในรูปเดียวกัน: ตัดช่องว่างหัวท้าย, รวมช่องว่างซ้อน, ไม่คำนึง case (เช่น "faq  1" = "FAQ 1")"""
+    return " ".join((text or "").split()).casefold()
+
+
+class Router:
+    """
+    router แบบตารางสำหรับ event จาก LINE webhook
+    - คำสั่งข้อความ: exact (dict lookup), prefix (lookup ตามความยาวของ prefix ที่ลงทะเบียน)
+      และ regex (รวมเป็น pattern เดียว) ถูก compile ครั้งเดียวก่อนใช้งาน
+    - event ที่ไม่ใช่ข้อความ (postback, follow, message ชนิด image/sticker ฯลฯ) dispatch ตามชนิด
+    - default() คือ handler เมื่อข้อความไม่ตรงกับคำสั่งใด (เช่น คำตอบของแบบสอบถาม)
+
+    ลำดับการจับคู่: exact -> prefix ที่ยาวที่สุด -> regex ตามลำดับที่ลงทะเบียน -> default
+    handler ของข้อความรับ (user_id, message_text); handler ของ event รับ (user_id, event)
+    ทุก route ถูกจับเวลาและนับจำนวนครั้ง/ข้อผิดพลาดไว้ใน stats()
+    """
+
+    def __init__(self, normalize=normalize_command):
+        self.normalize = normalize
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_lengths = []
+        self._regexes = []
+        self._combined = None
+        self._events = {}
+        self._default = None
+        self._compiled = False
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    # ------------------ การลงทะเบียน ------------------
+
+    def exact(self, *commands):
+        def decorator(handler):
+            for command in commands:
+                self._exact[self.normalize(command)] = (f"exact:{command}", handler)
+            self._compiled = False
+            return handler
+        return decorator
+
+    def prefix(self, *prefixes):
+        def decorator(handler):
+            for prefix in prefixes:
+                self._prefixes[self.normalize(prefix)] = (f"prefix:{prefix}", handler)
+            self._compiled = False
+            return handler
+        return decorator
+
+    def regex(self, pattern):
+        """pattern ถูกจับคู่ตั้งแต่ต้นข้อความแบบไม่คำนึง case"""
+        def decorator(handler):
+            self._regexes.append((f"regex:{pattern}", re.compile(pattern, re.IGNORECASE), handler))
+            self._compiled = False
+            return handler
+        return decorator
+
+    def event(self, *event_types):
+        """
+        ลงทะเบียน handler ตามชนิด event เช่น "follow", "postback"
+        หรือชนิดของ message เช่น "message:image", "message:sticker"
+        """
+        def decorator(handler):
+            for event_type in event_types:
+                self._events[event_type] = (f"event:{event_type}", handler)
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self._default = ("default", handler)
+        return handler
+
+    def compile(self):
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefixes}, reverse=True)
+        if self._regexes:
+            # รวมทุก regex เป็น alternation เดียว ใช้ชื่อกลุ่มบอกว่า route ไหนตรง
+            combined = "|".join(f"(?P<r{index}>{regex.pattern})" for index, (_, regex, _) in enumerate(self._regexes))
+            self._combined = re.compile(combined, re.IGNORECASE)
+        else:
+            self._combined = None
+        self._compiled = True
+
+    # ------------------ การค้นหา ------------------
+
+    def resolve(self, message_text):
+        """คืน (ชื่อ route, handler) ของข้อความ หรือ None ถ้าไม่ตรงและไม่มี default"""
+        if not self._compiled:
+            self.compile()
+        key = self.normalize(message_text)
+        route = self._exact.get(key)
+        if route is not None:
+            return route
+        for length in self._prefix_lengths:
+            if len(key) >= length:
+                route = self._prefixes.get(key[:length])
+                if route is not None:
+                    return route
+        if self._combined is not None:
+            match = self._combined.match(message_text.strip())
+            if match is not None:
+                index = int(match.lastgroup[1:])
+                name, _, handler = self._regexes[index]
+                return name, handler
+        return self._default
+
+    def dispatch_text(self, user_id, message_text):
+        route = self.resolve(message_text)
+        if route is None:
+            return False
+        name, handler = route
+        self._timed(name, handler, user_id, message_text)
+        return True
+
+    def dispatch(self, event):
+        """
+        dispatch event จาก LINE webhook
+        คืน True ถ้ามี handler รับ event นี้, False ถ้าไม่มี (event ถูกข้ามไป)
+        """
+        user_id = event.get("source", {}).get("userId")
+        if not user_id:
+            return False
+        event_type = event.get("type")
+        if event_type == "message":
+            message = event.get("message", {})
+            message_type = message.get("type", "text")
+            if message_type == "text":
+                return self.dispatch_text(user_id, message.get("text", "").strip())
+            route = self._events.get(f"message:{message_type}") or self._events.get("message")
+        elif event_type == "postback":
+            # postback ที่ data ตรงกับคำสั่งข้อความจะถูกส่งไปที่ route เดียวกัน
+            data = event.get("postback", {}).get("data", "")
+            route = self._events.get("postback")
+            if route is None:
+                route = self.resolve(data) if data else None
+                if route is None or route is self._default:
+                    return False
+                name, handler = route
+                self._timed(name, handler, user_id, data)
+                return True
+        else:
+            route = self._events.get(event_type)
+        if route is None:
+            return False
+        name, handler = route
+        self._timed(name, handler, user_id, event)
+        return True
+
+    def _timed(self, name, handler, *args):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return handler(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            spent = time.perf_counter() - started
+            HANDLER_SECONDS.observe(spent, handler=name)
+            if failed:
+                HANDLER_ERRORS.inc(handler=name)
+            with self._stats_lock:
+                entry = self._stats.setdefault(name, {"count": 0, "errors": 0, "seconds_total": 0.0, "seconds_max": 0.0})
+                entry["count"] += 1
+                entry["seconds_total"] += spent
+                if failed:
+                    entry["errors"] += 1
+                if spent > entry["seconds_max"]:
+                    entry["seconds_max"] = spent
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                name: dict(entry, seconds_avg=entry["seconds_total"] / entry["count"])
+                for name, entry in self._stats.items()
+            }
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# ลำดับฟิลด์ของ session แบบสอบถาม ใช้แพ็ก session เป็น tuple/list แทน dict เพื่อประหยัดหน่วยความจำ
+SESSION_FIELDS = ("step", "material", "size", "quantity", "volume", "weight_kg", "total_cost")
+
+
+def pack_session(session):
+    """แปลง dict ของ session เป็น list ตามลำดับ SESSION_FIELDS (ฟิลด์อื่นเก็บไว้ท้ายสุดเป็น dict)"""
+    record = [session.get(field) for field in SESSION_FIELDS]
+    extra = {key: value for key, value in session.items() if key not in SESSION_FIELDS}
+    record.append(extra or None)
+    return record
+
+
+def unpack_session(record):
+    session = {field: value for field, value in zip(SESSION_FIELDS, record) if value is not None}
+    extra = record[len(SESSION_FIELDS)] if len(record) > len(SESSION_FIELDS) else None
+    if extra:
+        session.update(extra)
+    return session
+
+
+class SessionStore:
+    """
+    interface ของที่เก็บ session แบบสอบถาม
+    get() คืน dict ใหม่ทุกครั้ง ผู้เรียกแก้ไขแล้วต้อง set() กลับเพื่อบันทึก
+    """
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def set(self, user_id, session):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def size(self):
+        return None
+
+    def stats(self):
+        return {"backend": type(self).__name__, "sessions": self.size()}
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    เก็บ session ในหน่วยความจำของโปรเซส แบบ LRU + TTL
+    - session ที่ไม่มีความเคลื่อนไหวเกิน ttl วินาทีจะหมดอายุ
+    - เมื่อเกิน max_sessions จะลบ session ที่ใช้ล่าสุดนานที่สุดออก
+    ใช้ได้เมื่อรันโปรเซสเดียว (หลาย instance ต้องใช้ RedisSessionStore)
+    """
+
+    def __init__(self, ttl=1800, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _purge_expired(self, now):
+        # ข้อมูลเรียงตามเวลาใช้งานล่าสุด จึงหยุดได้ทันทีเมื่อเจอตัวที่ยังไม่หมดอายุ
+        while self._data:
+            user_id, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[user_id]
+            self.expired += 1
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+            expires_at, record = entry
+            if expires_at <= now:
+                del self._data[user_id]
+                self.expired += 1
+                return None
+            # ต่ออายุทุกครั้งที่ใช้งาน ทำให้ลำดับใน OrderedDict ตรงกับลำดับเวลาหมดอายุเสมอ
+            self._data[user_id] = (now + self.ttl, record)
+            self._data.move_to_end(user_id)
+            return unpack_session(record)
+
+    def set(self, user_id, session):
+        now = time.monotonic()
+        with self._lock:
+            self._data[user_id] = (now + self.ttl, tuple(pack_session(session)))
+            self._data.move_to_end(user_id)
+            self._purge_expired(now)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def size(self):
+        with self._lock:
+            self._purge_expired(time.monotonic())
+            return len(self._data)
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "sessions": self.size(),
+            "max_sessions": self.max_sessions,
+            "ttl_seconds": self.ttl,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class RedisSessionStore(SessionStore):
+    """
+    เก็บ session ใน Redis (หรือบริการที่ใช้ protocol เดียวกัน เช่น Memorystore, Valkey)
+    ทำให้ทุก worker/instance เห็น session เดียวกันโดยไม่ต้องใช้ sticky routing
+    client คือ object ที่มีเมธอด get/set(ex=)/delete แบบ redis-py
+    (ทดสอบในเครื่องได้ด้วย fakeredis หรือ redis-server ในเครื่อง)
+    """
+
+    def __init__(self, client, ttl=1800, prefix="line-webhook-bot:session:"):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def get(self, user_id):
+        raw = self.client.get(self._key(user_id))
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        return unpack_session(json.loads(raw))
+
+    def set(self, user_id, session):
+        payload = json.dumps(pack_session(session), ensure_ascii=False, separators=(",", ":"))
+        self.client.set(self._key(user_id), payload, ex=self.ttl)
+
+    def delete(self, user_id):
+        self.client.delete(self._key(user_id))
+
+    def stats(self):
+        return {"backend": "redis", "ttl_seconds": self.ttl}
+
+
+def create_session_store(url=None, ttl=1800, max_sessions=10000):
+    """
+    สร้าง session store จาก URL: ว่าง/"memory" = ในหน่วยความจำ, "redis://..." = Redis
+    (ต้องติดตั้ง package redis เพิ่มเมื่อใช้ Redis)
+    """
+    if not url or url == "memory":
+        return InMemorySessionStore(ttl=ttl, max_sessions=max_sessions)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(url), ttl=ttl)
+    raise ValueError(f"Unsupported session store URL: {url}")
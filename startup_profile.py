@@ -0,0 +1,130 @@
+"""
+บันทึกเวลาเริ่มระบบ: เวลา import ของแต่ละ module และเวลาที่แต่ละส่วนพร้อมใช้งาน
+
+ต้องถูก import ก่อน module อื่น (บรรทัดแรกของ main.py / chatbot_line.py) จึงจะจับเวลา import ได้ครบ
+จับเวลาเฉพาะช่วงเริ่มระบบจนถึง finish() หลังจากนั้น import ตามปกติโดยไม่มี overhead
+
+รายงานดูได้ที่ GET /ready หรือรันแยกเพื่อเปรียบเทียบระหว่าง commit:
+    python startup_profile.py main          # หรือ chatbot_line
+"""
+import builtins
+import sys
+import threading
+import time
+
+_STARTED = time.perf_counter()
+
+
+def _resolve_name(name, globals, level):
+    """ชื่อเต็มของ relative import (เช่น from .app import Flask ใน package flask -> flask.app)"""
+    package = (globals or {}).get("__package__") or ""
+    base = package.rsplit(".", level - 1)[0]
+    return f"{base}.{name}" if name else base
+
+
+class ImportProfiler:
+    """
+    ห่อ builtins.__import__ เพื่อจับเวลา import ที่โหลด module ใหม่
+    cumulative = เวลารวม module ที่ import ต่อจากมัน, self = ไม่รวม module ลูก
+    (หลักการเดียวกับ python -X importtime แต่อ่านผลได้จากในโปรเซส)
+    """
+
+    def __init__(self):
+        self.records = {}
+        self._original = None
+        self._hook = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self):
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._hook = self._import
+
+    def uninstall(self):
+        if self._original is not None and builtins.__import__ is self._hook:
+            builtins.__import__ = self._original
+        self._original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original or builtins.__import__
+        if level == 0 and not fromlist and name in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        loaded = len(sys.modules)
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            spent = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += spent
+            if len(sys.modules) > loaded:
+                key = name if level == 0 else _resolve_name(name, globals, level)
+                with self._lock:
+                    entry = self.records.setdefault(key, [0.0, 0.0])
+                    entry[0] += spent
+                    entry[1] += spent - children
+
+    def report(self, top=15):
+        with self._lock:
+            records = dict(self.records)
+        packages = {}
+        for name, (_, self_seconds) in records.items():
+            package = name.split(".", 1)[0]
+            packages[package] = packages.get(package, 0.0) + self_seconds
+        slowest = sorted(records.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        return {
+            "total_seconds": round(sum(entry[1] for entry in records.values()), 4),
+            "modules": [{"module": name, "cumulative_seconds": round(cumulative, 4), "self_seconds": round(own, 4)}
+                        for name, (cumulative, own) in slowest],
+            "packages": {name: round(seconds, 4)
+                         for name, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]},
+        }
+
+
+PROFILER = ImportProfiler()
+if __name__ != "__main__":
+    PROFILER.install()
+
+# เวลา (วินาทีนับจาก import module นี้) ที่แต่ละขั้นตอนของการเริ่มระบบเสร็จ
+_phases = {}
+
+
+def mark(phase):
+    """บันทึกเวลาที่ขั้นตอน phase เสร็จ (บันทึกเฉพาะครั้งแรก)"""
+    _phases.setdefault(phase, round(time.perf_counter() - _STARTED, 4))
+
+
+def finish():
+    """จบช่วงจับเวลา import (เรียกหลังสร้างแอปเสร็จ)"""
+    mark("imports")
+    PROFILER.uninstall()
+
+
+def report(top=15):
+    return {"phases": dict(_phases), "imports": PROFILER.report(top)}
+
+
+if __name__ == "__main__":
+    import importlib
+    import json
+    import os
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # stdout มีเฉพาะรายงาน JSON (log ของแอปเขียนลง stdout เช่นกัน)
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    # ใช้ instance เดียวกับที่ main.py import (ไฟล์นี้ถูกรันในชื่อ __main__)
+    profile = importlib.import_module("startup_profile")
+    target = sys.argv[1] if len(sys.argv) > 1 else "main"
+    started = time.perf_counter()
+    importlib.import_module(target)
+    profile.finish()
+    result = profile.report(top=int(os.getenv("STARTUP_PROFILE_TOP", "25")))
+    result["target"] = target
+    result["import_seconds"] = round(time.perf_counter() - started, 4)
+    print(json.dumps(result, indent=2))
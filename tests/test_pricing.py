@@ -0,0 +1,41 @@
+import random
+
+import pytest
+
+from pricing import DimensionError, format_dimensions, parse_dimensions
+
+
+@pytest.mark.parametrize("dimensions", [
+    (10.0, 5.0, 2.0),
+    (10.5, 4.5, 3.0),
+    (0.00001, 1.0, 1.0),
+    (0.000000001, 2.0, 3.0),
+    (1e20, 2.5, 3.0),
+    (12345678.123456789, 0.1, 0.3),
+])
+def test_format_dimensions_round_trips(dimensions):
+    text = format_dimensions(dimensions)
+    assert "e" not in text
+    assert parse_dimensions(text) == dimensions
+
+
+def test_format_dimensions_round_trips_parsed_input():
+    rng = random.Random(16)
+    for _ in range(2000):
+        unit = rng.choice(["mm", "cm", "m", "in"])
+        text = "x".join(f"{rng.uniform(0.001, 5000):.{rng.randint(0, 6)}f}" for _ in range(3)) + f" {unit}"
+        try:
+            dimensions = parse_dimensions(text)
+        except DimensionError:
+            continue
+        assert parse_dimensions(format_dimensions(dimensions)) == dimensions
+
+
+def test_format_dimensions_is_canonical():
+    assert format_dimensions(parse_dimensions("100 × 50 × 20 mm")) == "10x5x2"
+    assert format_dimensions(parse_dimensions("10.5x4.5x3")) == "10.5x4.5x3"
+
+
+def test_non_string_unit_is_dimension_error():
+    with pytest.raises(DimensionError):
+        parse_dimensions("1x2x3", default_unit=5)
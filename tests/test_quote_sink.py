@@ -0,0 +1,86 @@
+import json
+import time
+
+from quote_sink import QuoteSink
+
+
+def make_sink(tmp_path, writers, **kwargs):
+    return QuoteSink(str(tmp_path / "quotes.jsonl"), writers, flush_interval=0.05, **kwargs)
+
+
+def test_corrupt_line_is_quarantined_and_skipped(tmp_path):
+    received = {"sheets": [], "bigquery": []}
+    sink = make_sink(tmp_path, {name: received[name].extend for name in received})
+    sink.submit({"user_id": "U1"})
+    # บรรทัดที่เขียนไม่ครบตอนโปรเซสล้ม แล้วมี record ใหม่ต่อท้าย
+    with open(sink.spool_path, "ab") as f:
+        f.write(b'{"user_id": "U-torn", "mat')
+    sink.submit({"user_id": "U2"})
+    sink.submit({"user_id": "U3"})
+    sink.flush(force=True)
+
+    for name in received:
+        assert [r["user_id"] for r in received[name]] == ["U1", "U3"]
+    with open(f"{sink.spool_path}.bad", "rb") as f:
+        bad = f.read().splitlines()
+    # บรรทัดเสียถูกย้ายครั้งเดียว แม้ writer ทั้งสองตัวจะอ่านเจอ
+    assert len(bad) == 1 and bad[0].startswith(b'{"user_id": "U-torn"')
+    assert sink.stats()["bad_lines"] == 1
+    # ทุก writer ส่งครบแล้ว spool ถูกล้าง
+    assert sink.stats()["spool_bytes"] == 0
+
+
+def test_only_corrupt_lines_left_advances_offset(tmp_path):
+    received = []
+    sink = make_sink(tmp_path, {"sheets": received.extend})
+    with open(sink.spool_path, "ab") as f:
+        f.write(b"not json\n")
+    sink.flush(force=True)
+    assert received == []
+    assert sink.stats()["spool_bytes"] == 0
+
+
+def test_flush_error_does_not_stop_background_thread(tmp_path, monkeypatch):
+    received = []
+    sink = make_sink(tmp_path, {"sheets": received.extend})
+    original = sink.flush
+    calls = {"count": 0}
+
+    def flaky_flush(force=False):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise OSError("disk error")
+        return original(force)
+
+    monkeypatch.setattr(sink, "flush", flaky_flush)
+    sink.start()
+    try:
+        sink.submit({"user_id": "U1"})
+        deadline = time.monotonic() + 5
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sink._thread.is_alive()
+        assert [r["user_id"] for r in received] == ["U1"]
+    finally:
+        sink.stop()
+
+
+def test_records_survive_restart(tmp_path):
+    failing = {"ok": False}
+    received = []
+
+    def writer(records):
+        if not failing["ok"]:
+            raise RuntimeError("unavailable")
+        received.extend(records)
+
+    sink = make_sink(tmp_path, {"sheets": writer})
+    row_id = sink.submit({"user_id": "U1"})
+    sink.flush(force=True)
+    assert received == []
+
+    failing["ok"] = True
+    restarted = make_sink(tmp_path, {"sheets": writer})
+    restarted.flush(force=True)
+    assert [r["row_id"] for r in received] == [row_id]
+    assert json.loads(json.dumps(received[0]))["user_id"] == "U1"
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+import rate_limit
+from rate_limit import PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_QUOTE, OutboundScheduler, TokenBucket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def scheduler(clock):
+    """scheduler ที่ไม่เริ่ม thread: ทดสอบการเลือกงานด้วย _select() ตามเวลาของ FakeClock"""
+    def make(**kwargs):
+        kwargs.setdefault("channel_rate", 0)
+        kwargs.setdefault("user_rate", 0)
+        s = OutboundScheduler(**kwargs)
+        s.start = lambda: None
+        return s
+    return make
+
+
+def job(name):
+    def run():
+        return name
+    run.name = name
+    return run
+
+
+def select_all(s, clock):
+    order = []
+    while True:
+        selected, _ = s._select(clock.monotonic())
+        if selected is None:
+            return order
+        order.append(selected.run.name)
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=2, burst=4)
+    now = clock.monotonic()
+    assert bucket.wait_time(4, now) == 0
+    bucket.take(4, now)
+    assert bucket.wait_time(1, now) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now + 0.5) == 0
+    assert TokenBucket(rate=0, burst=1).wait_time(100, now) == 0
+
+
+def test_priority_order_and_per_user_fifo(scheduler, clock):
+    s = scheduler()
+    s.submit("A", job("a1-low"), priority=PRIORITY_LOW)
+    s.submit("A", job("a2-quote"), priority=PRIORITY_QUOTE)
+    s.submit("B", job("b-low"), priority=PRIORITY_LOW)
+    s.submit("C", job("c-quote"), priority=PRIORITY_QUOTE)
+    s.submit("D", job("d-normal"), priority=PRIORITY_NORMAL)
+    # งานที่สำคัญกว่าของ user อื่นไปก่อน แต่งานของ A ยังเรียงตามลำดับที่ส่งเข้ามา
+    assert select_all(s, clock) == ["c-quote", "d-normal", "a1-low", "a2-quote", "b-low"]
+
+
+def test_busy_user_waits_for_previous_job(scheduler, clock):
+    s = scheduler()
+    s.submit("A", job("a1"))
+    s.submit("A", job("a2"))
+    first, _ = s._select(clock.monotonic())
+    s._busy.add(first.user_id)
+    assert s._select(clock.monotonic()) == (None, float("inf"))
+    s._finish(first)
+    assert select_all(s, clock) == ["a2"]
+    assert s.stats()["sent"] == 1
+
+
+def test_user_rate_limit_throttles_only_that_user(scheduler, clock):
+    s = scheduler(user_rate=1, user_burst=1)
+    s.submit("A", job("a1"))
+    s.submit("A", job("a2"))
+    s.submit("B", job("b1"))
+    assert select_all(s, clock) == ["a1", "b1"]
+    selected, wait = s._select(clock.monotonic())
+    assert selected is None and wait == pytest.approx(1.0)
+    assert s.stats()["throttled"]["user"] == 1
+    clock.advance(1.0)
+    assert select_all(s, clock) == ["a2"]
+
+
+def test_channel_rate_limit(scheduler, clock):
+    s = scheduler(channel_rate=10, channel_burst=2)
+    for name in ("a", "b", "c"):
+        s.submit(name, job(name))
+    assert select_all(s, clock) == ["a", "b"]
+    assert s._select(clock.monotonic())[1] == pytest.approx(0.1)
+    assert s.stats()["throttled"]["channel"] == 1
+
+
+def test_only_low_priority_expires(scheduler, clock):
+    s = scheduler()
+    s.submit("A", job("low"), priority=PRIORITY_LOW)
+    s.submit("B", job("normal"), priority=PRIORITY_NORMAL)
+    s.submit("C", job("quote"), priority=PRIORITY_QUOTE)
+    clock.advance(3600)
+    assert select_all(s, clock) == ["quote", "normal"]
+    assert s.stats()["dropped"] == {"low": {"expired": 1}}
+
+
+def test_full_queue_never_drops_quote_or_normal(scheduler, clock):
+    s = scheduler(max_queue=2)
+    assert s.submit("A", job("n1"), priority=PRIORITY_NORMAL)
+    assert s.submit("B", job("q1"), priority=PRIORITY_QUOTE)
+    assert s.submit("C", job("n2"), priority=PRIORITY_NORMAL)
+    assert s.submit("D", job("q2"), priority=PRIORITY_QUOTE)
+    assert not s.submit("E", job("low"), priority=PRIORITY_LOW)
+    assert s.stats()["dropped"] == {"low": {"queue_full": 1}}
+    assert sorted(select_all(s, clock)) == ["n1", "n2", "q1", "q2"]
+
+
+def test_full_queue_evicts_oldest_low_job_of_longest_queue(scheduler, clock):
+    s = scheduler(max_queue=4)
+    s.submit("B", job("b-low-oldest"), priority=PRIORITY_LOW)
+    for n in range(3):
+        clock.advance(1)
+        s.submit("A", job(f"a-low-{n}"), priority=PRIORITY_LOW)
+    clock.advance(1)
+    assert s.submit("C", job("c-quote"), priority=PRIORITY_QUOTE)
+    assert s.stats()["dropped"] == {"low": {"queue_full": 1}}
+    assert select_all(s, clock) == ["c-quote", "b-low-oldest", "a-low-1", "a-low-2"]
+
+
+def test_drain_and_stop_deliver_queued_jobs():
+    s = OutboundScheduler(channel_rate=0, user_rate=0, workers=2)
+    delivered = []
+    lock = threading.Lock()
+
+    def send(user_id, n):
+        def run():
+            time.sleep(0.005)
+            with lock:
+                delivered.append((user_id, n))
+        return run
+
+    for n in range(10):
+        for user_id in ("A", "B", "C"):
+            s.submit(user_id, send(user_id, n))
+    s.submit("D", lambda: 1 / 0)
+    assert s.drain(timeout=10)
+    for user_id in ("A", "B", "C"):
+        assert [n for u, n in delivered if u == user_id] == list(range(10))
+
+    s.submit("A", send("A", 10))
+    s.stop(timeout=10)
+    assert ("A", 10) in delivered
+    stats = s.stats()
+    assert (stats["sent"], stats["failed"], stats["queued"]) == (31, 1, 0)
+
+
+def test_async_jobs_run_on_loop():
+    s = OutboundScheduler(channel_rate=0, user_rate=0)
+    results = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+
+        async def send():
+            results.append(threading.current_thread() is threading.main_thread())
+
+        s.submit("A", send, loop=loop)
+        await loop.run_in_executor(None, s.drain, 5)
+
+    asyncio.run(main())
+    s.stop()
+    assert results == [True]
+    assert s.stats()["sent"] == 1
+
+
+def test_stop_at_exit_delivers_queued_jobs():
+    script = textwrap.dedent("""
+        import atexit
+        from rate_limit import OutboundScheduler
+
+        s = OutboundScheduler(user_rate=20, user_burst=1)
+        for n in range(3):
+            s.submit("U1", lambda n=n: print("sent", n, flush=True))
+        atexit.register(lambda: print("stats", s.stats()["sent"], s.stats()["failed"], flush=True))
+        atexit.register(s.stop)
+    """)
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True,
+                            timeout=30, env=dict(os.environ, PYTHONPATH=ROOT))
+    assert output.returncode == 0, output.stderr
+    lines = output.stdout.splitlines()
+    assert lines[-1] == "stats 3 0"
+    assert sorted(lines[:-1]) == ["sent 0", "sent 1", "sent 2"]
@@ -0,0 +1,207 @@
+import asyncio
+import threading
+
+import pytest
+
+import resilience
+from resilience import (FAULTS, BulkheadFullError, CircuitBreaker, CircuitOpenError, FaultInjector, InjectedFault,
+                        Upstream)
+
+
+class FakeTime:
+    """แทน module time ใน resilience: เวลาเดินเมื่อ sleep() หรือ advance() เท่านั้น"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(resilience, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def faults():
+    FAULTS.clear()
+    yield FAULTS
+    FAULTS.clear()
+
+
+class Flaky:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError(f"failure {self.calls}")
+        return "ok"
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    assert not breaker.record_failure()
+    assert not breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.advance(9.9)
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_closes_on_success(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.advance(10)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # ระหว่างคำขอทดลอง คำขออื่นยังถูกปฏิเสธ
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0 and breaker.allow()
+
+
+def test_breaker_half_open_reopens_on_failure(clock):
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.advance(10)
+    assert breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened == 2
+    assert not breaker.allow()
+    clock.advance(10)
+    assert breaker.allow()
+
+
+def test_upstream_rejects_while_open(clock, faults):
+    upstream = Upstream("test-open", failure_threshold=2, reset_timeout=30)
+    func = Flaky(failures=10)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            upstream.call(func)
+    with pytest.raises(CircuitOpenError):
+        upstream.call(func)
+    assert func.calls == 2
+    assert upstream.stats()["rejected"]["circuit_open"] == 1
+    clock.advance(30)
+    func.failures = 0
+    assert upstream.call(func) == "ok"
+    assert upstream.stats()["state"] == CircuitBreaker.CLOSED
+
+
+def test_retries_stop_at_attempt_limit(clock, faults):
+    upstream = Upstream("test-retry", attempts=3, failure_threshold=100, backoff=0.5)
+    func = Flaky(failures=10)
+    with pytest.raises(ConnectionError):
+        upstream.call(func)
+    assert func.calls == 3
+    assert upstream.stats()["retries"] == 2
+    # รอ backoff ผ่าน time.sleep ที่ถูกแทนไว้ ไม่ได้รอจริง
+    assert len(clock.sleeps) == 2
+    assert all(0 <= delay <= 0.5 * 2 ** n for n, delay in enumerate(clock.sleeps))
+
+
+def test_retry_succeeds_and_respects_retry_on(clock, faults):
+    upstream = Upstream("test-retry-ok", attempts=3, failure_threshold=100)
+    assert upstream.call(Flaky(failures=2)) == "ok"
+
+    no_retry = Upstream("test-no-retry", attempts=3, failure_threshold=100, retry_on=lambda error: False)
+    func = Flaky(failures=10)
+    with pytest.raises(ConnectionError):
+        no_retry.call(func)
+    assert func.calls == 1
+
+    func = Flaky(failures=10)
+    with pytest.raises(ConnectionError):
+        upstream.call_once(func)
+    assert func.calls == 1
+
+
+def test_failure_result_counts_as_failure(clock, faults):
+    upstream = Upstream("test-result", failure_threshold=1, is_failure_result=lambda result: result == "5xx")
+    assert upstream.call(lambda: "5xx") == "5xx"
+    assert upstream.stats()["state"] == CircuitBreaker.OPEN
+
+
+def test_bulkhead_rejects_over_limit(faults):
+    upstream = Upstream("test-bulkhead", max_concurrent=1, acquire_timeout=0)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        entered.set()
+        release.wait(5)
+        return "done"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(upstream.call(slow)))
+    thread.start()
+    try:
+        assert entered.wait(5)
+        with pytest.raises(BulkheadFullError):
+            upstream.call(lambda: "second")
+    finally:
+        release.set()
+        thread.join()
+    assert results == ["done"]
+    assert upstream.stats()["rejected"]["bulkhead_full"] == 1
+    assert upstream.call(lambda: "after") == "after"
+
+
+def test_fault_injection_spec_is_parsed():
+    injector = FaultInjector()
+    injector.configure("sheets:error=1;line:latency=0.3; ;bigquery:latency=2,error=0.5")
+    assert injector.stats() == {
+        "sheets": {"latency": 0.0, "error_rate": 1.0},
+        "line": {"latency": 0.3, "error_rate": 0.0},
+        "bigquery": {"latency": 2.0, "error_rate": 0.5},
+    }
+    injector.clear("line")
+    assert "line" not in injector.stats()
+    injector.clear()
+    assert injector.stats() == {}
+
+
+def test_fault_injection_is_applied(clock, faults):
+    faults.configure("sheets:error=1;line:latency=2")
+    sheets = Upstream("sheets", failure_threshold=100)
+    called = []
+    with pytest.raises(InjectedFault):
+        sheets.call(lambda: called.append(1))
+    assert called == []
+    assert sheets.stats()["failures"] == 1
+
+    line = Upstream("line")
+    assert line.call(lambda: "sent") == "sent"
+    assert clock.sleeps == [2.0]
+
+
+def test_fault_injection_async(faults):
+    faults.configure("sheets:error=1")
+    upstream = Upstream("sheets", failure_threshold=100)
+
+    async def send():
+        return "sent"
+
+    with pytest.raises(InjectedFault):
+        asyncio.run(upstream.call_async(send))
+    faults.clear()
+    assert asyncio.run(upstream.call_async(send)) == "sent"
@@ -0,0 +1,133 @@
+import pytest
+
+import session_store
+from session_store import InMemorySessionStore, RedisSessionStore, pack_session, unpack_session
+
+SESSION = {"step": 4, "material": "ABS", "size": "10.5x4.5x3", "quantity": 100,
+           "volume": 141.75, "weight_kg": 0.1488375, "total_cost": 3720.9375}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(session_store, "time", fake)
+    return fake
+
+
+class DictRedis:
+    """Redis จำลองแบบ dict: get/set(ex=)/delete เท่าที่ RedisSessionStore ใช้ (ค่าเป็น bytes เหมือน redis-py)"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self.clock.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        expires_at = self.clock.monotonic() + ex if ex is not None else None
+        self.data[key] = (value.encode("utf-8") if isinstance(value, str) else value, expires_at)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def test_pack_round_trip():
+    assert unpack_session(pack_session(SESSION)) == SESSION
+    with_extra = dict(SESSION, note="ลูกค้าเก่า")
+    assert unpack_session(pack_session(with_extra)) == with_extra
+    assert unpack_session(pack_session({"step": 1})) == {"step": 1}
+
+
+def test_memory_store_returns_copies(clock):
+    store = InMemorySessionStore(ttl=60)
+    store.set("U1", SESSION)
+    session = store.get("U1")
+    assert session == SESSION
+    session["step"] = 5
+    assert store.get("U1")["step"] == 4
+
+
+def test_memory_store_sliding_ttl(clock):
+    store = InMemorySessionStore(ttl=60)
+    store.set("U1", {"step": 1})
+    store.set("U2", {"step": 1})
+    clock.advance(50)
+    # get() ต่ออายุของ U1 ออกไปอีก ttl วินาที
+    assert store.get("U1") == {"step": 1}
+    clock.advance(20)
+    assert store.get("U1") == {"step": 1}
+    assert store.get("U2") is None
+    clock.advance(61)
+    assert store.get("U1") is None
+    assert store.size() == 0
+    assert store.stats()["expired"] == 2
+
+
+def test_memory_store_lru_cap(clock):
+    store = InMemorySessionStore(ttl=60, max_sessions=2)
+    store.set("U1", {"step": 1})
+    store.set("U2", {"step": 2})
+    store.get("U1")  # U1 ถูกใช้ล่าสุด U2 จึงเก่าที่สุด
+    store.set("U3", {"step": 3})
+    assert store.get("U2") is None
+    assert store.get("U1") == {"step": 1}
+    assert store.get("U3") == {"step": 3}
+    assert store.stats()["evicted"] == 1
+    assert store.size() == 2
+
+
+def test_memory_store_delete(clock):
+    store = InMemorySessionStore()
+    store.set("U1", SESSION)
+    store.delete("U1")
+    store.delete("U-missing")
+    assert store.get("U1") is None
+
+
+def test_redis_store_round_trip(clock):
+    client = DictRedis(clock)
+    store = RedisSessionStore(client, ttl=60)
+    store.set("U1", dict(SESSION, material="ไนลอน"))
+    assert store.get("U1") == dict(SESSION, material="ไนลอน")
+    value, _ = client.data["line-webhook-bot:session:U1"]
+    assert value.startswith(b"[4,")
+    store.delete("U1")
+    assert store.get("U1") is None
+
+
+def test_redis_store_sets_ttl_on_every_write(clock):
+    client = DictRedis(clock)
+    store = RedisSessionStore(client, ttl=60)
+    store.set("U1", {"step": 1})
+    clock.advance(50)
+    store.set("U1", {"step": 2})
+    clock.advance(50)
+    assert store.get("U1") == {"step": 2}
+    clock.advance(11)
+    assert store.get("U1") is None
+
+
+def test_create_session_store():
+    assert isinstance(session_store.create_session_store(None), InMemorySessionStore)
+    assert isinstance(session_store.create_session_store("memory"), InMemorySessionStore)
+    with pytest.raises(ValueError):
+        session_store.create_session_store("memcached://localhost")
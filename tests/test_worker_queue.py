@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from worker_queue import EventQueue, InlineQueue, create_event_queue
+
+
+class RecordingQueue:
+    """คิวแบบกำหนดเองสำหรับทดสอบ: เก็บอาร์กิวเมนต์ที่ factory ได้รับ"""
+
+    def __init__(self, handler, workers, maxsize):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+
+    def submit(self, key, item):
+        self.handler(item)
+
+    def stop(self, timeout=None):
+        pass
+
+    def stats(self):
+        return {"mode": "recording"}
+
+
+def handler(item):
+    pass
+
+
+def test_builtin_modes():
+    assert isinstance(create_event_queue(handler, mode="inline"), InlineQueue)
+    assert isinstance(create_event_queue(handler, mode="thread", workers=2), EventQueue)
+
+
+@pytest.mark.parametrize("mode", [RecordingQueue, f"{__name__}:RecordingQueue"])
+def test_custom_queue_receives_handler(mode):
+    event_queue = create_event_queue(handler, mode=mode, workers=3, maxsize=30)
+    assert isinstance(event_queue, RecordingQueue)
+    assert event_queue.handler is handler
+    assert (event_queue.workers, event_queue.maxsize) == (3, 30)
+
+
+def not_a_queue(handler, workers, maxsize):
+    return object()
+
+
+@pytest.mark.parametrize("mode", ["unknown", f"{__name__}:not_a_queue", f"{__name__}:missing"])
+def test_invalid_mode(mode):
+    with pytest.raises((ValueError, AttributeError)):
+        create_event_queue(handler, mode=mode)
+
+
+def test_event_queue_keeps_per_key_order():
+    seen = {}
+    lock = threading.Lock()
+
+    def record(item):
+        key, value = item
+        # หน่วงเวลาไม่เท่ากันเพื่อให้ลำดับผิดได้ถ้า key เดียวกันถูกประมวลผลพร้อมกัน
+        time.sleep(0.001 * (value % 3))
+        with lock:
+            seen.setdefault(key, []).append(value)
+
+    event_queue = EventQueue(record, workers=4, maxsize=1000, put_timeout=1)
+    keys = [f"U{n}" for n in range(8)]
+    for value in range(25):
+        for key in keys:
+            event_queue.submit(key, (key, value))
+    event_queue.join()
+    event_queue.stop()
+    assert seen == {key: list(range(25)) for key in keys}
+    assert event_queue.stats()["processed"] == 200
+
+
+def test_stop_drains_queued_items():
+    processed = []
+    event_queue = EventQueue(lambda item: (time.sleep(0.01), processed.append(item)), workers=1)
+    for value in range(10):
+        event_queue.submit("U1", value)
+    event_queue.stop(timeout=5)
+    assert processed == list(range(10))
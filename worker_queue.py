@@ -0,0 +1,204 @@
+import importlib
+import logging
+import queue
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class InlineQueue:
+    """
+    คิวแบบไม่มี worker: เรียก handler ทันทีใน thread ของ request
+    (พฤติกรรมเดิมของ webhook) ใช้เมื่อไม่ได้เปิดโหมดประมวลผลเบื้องหลัง
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, key, item):
+        try:
+            self.handler(item)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception("ประมวลผล event ของ %s ไม่สำเร็จ: %s", key, e)
+
+    def stop(self, timeout=None):
+        pass
+
+    def stats(self):
+        return {"mode": "inline", "processed": self.processed, "failed": self.failed, "depth": 0}
+
+
+class EventQueue:
+    """
+    คิวงานภายในโปรเซสพร้อม worker pool ขนาดคงที่
+    แต่ละ worker มีคิวของตัวเอง และ event ของ user เดียวกันจะถูกส่งไปที่ worker เดิมเสมอ
+    (เลือกจาก hash ของ user_id) ทำให้ขั้นตอนแบบสอบถามของแต่ละคนถูกประมวลผลตามลำดับ
+    ในขณะที่ user ต่างคนกันประมวลผลพร้อมกันได้
+
+    handler(item) ถูกเรียกใน thread ของ worker; ข้อผิดพลาดจะถูกนับและพิมพ์ออก
+    ไม่ทำให้ worker หยุดทำงาน
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000, put_timeout=0.05):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        # maxsize คือขนาดรวมของทุกคิว แบ่งเท่า ๆ กันให้แต่ละ worker
+        self.per_worker_size = max(1, int(maxsize) // self.workers)
+        self.put_timeout = put_timeout
+        self._queues = [queue.Queue(maxsize=self.per_worker_size) for _ in range(self.workers)]
+        self._threads = []
+        self._started = False
+        self._lock = threading.Lock()
+
+        # ตัวนับสำหรับปรับขนาด pool
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.process_seconds_total = 0.0
+        self.process_seconds_max = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for index, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"event-worker-{index}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._started = True
+
+    def _shard(self, key):
+        return zlib.crc32(str(key).encode("utf-8")) % self.workers
+
+    def submit(self, key, item):
+        """
+        ใส่ item ลงคิวของ worker ที่รับผิดชอบ key นี้
+        ถ้าคิวเต็มเกิน put_timeout วินาที จะยก queue.Full ให้ผู้เรียกจัดการ (เช่น ตอบ 503)
+        """
+        if not self._started:
+            self.start()
+        q = self._queues[self._shard(key)]
+        try:
+            q.put((time.monotonic(), key, item), timeout=self.put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            raise
+        with self._stats_lock:
+            self.submitted += 1
+            depth = self.depth()
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q):
+        while True:
+            entry = q.get()
+            if entry is None:
+                q.task_done()
+                return
+            enqueued_at, key, item = entry
+            started = time.monotonic()
+            ok = True
+            try:
+                self.handler(item)
+            except Exception as e:
+                ok = False
+                logger.exception("ประมวลผล event ของ %s ไม่สำเร็จ: %s", key, e)
+            finished = time.monotonic()
+            wait = started - enqueued_at
+            spent = finished - started
+            with self._stats_lock:
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self.wait_seconds_total += wait
+                self.process_seconds_total += spent
+                if wait > self.wait_seconds_max:
+                    self.wait_seconds_max = wait
+                if spent > self.process_seconds_max:
+                    self.process_seconds_max = spent
+            q.task_done()
+
+    def join(self):
+        """รอจนทุก item ที่อยู่ในคิวถูกประมวลผลเสร็จ"""
+        for q in self._queues:
+            q.join()
+
+    def stop(self, timeout=5.0):
+        """ประมวลผล item ที่ค้างในคิวให้เสร็จ (ไม่เกิน timeout วินาที) แล้วหยุด worker"""
+        if not self._started:
+            return
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            try:
+                q.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        remaining = self.depth()
+        if remaining:
+            logger.warning("หยุดคิว event ก่อนประมวลผลครบ: ค้าง %d รายการหลังรอ %.1f วินาที", remaining, timeout)
+        with self._lock:
+            self._threads = []
+            self._started = False
+
+    def stats(self):
+        with self._stats_lock:
+            done = self.processed + self.failed
+            return {
+                "mode": "thread",
+                "workers": self.workers,
+                "capacity": self.per_worker_size * self.workers,
+                "depth": self.depth(),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "wait_seconds_avg": self.wait_seconds_total / done if done else 0.0,
+                "wait_seconds_max": self.wait_seconds_max,
+                "process_seconds_avg": self.process_seconds_total / done if done else 0.0,
+                "process_seconds_max": self.process_seconds_max,
+            }
+
+
+def create_event_queue(handler, mode="inline", workers=4, maxsize=1000):
+    """
+    สร้างคิวตาม mode: "inline" (ประมวลผลใน request เหมือนเดิม) หรือ "thread" (worker pool)
+    คิวแบบอื่นต่อเพิ่มได้โดยไม่ต้องแก้ main.py: ส่ง factory (callable) หรือ path แบบ "module:callable"
+    (เช่น EVENT_QUEUE_MODE=my_queues:create) ซึ่งจะถูกเรียกด้วย factory(handler, workers=..., maxsize=...)
+    และต้องคืน object ที่มีเมธอด submit(key, item)/stop(timeout)/stats()
+    """
+    if mode == "thread":
+        return EventQueue(handler, workers=workers, maxsize=maxsize)
+    if mode == "inline":
+        return InlineQueue(handler)
+    factory = mode
+    if isinstance(mode, str):
+        module_name, _, attribute = mode.partition(":")
+        if not module_name or not attribute:
+            raise ValueError(f"Unknown event queue mode: {mode}")
+        factory = getattr(importlib.import_module(module_name), attribute)
+    if not callable(factory):
+        raise ValueError(f"Unknown event queue mode: {mode}")
+    event_queue = factory(handler, workers=workers, maxsize=maxsize)
+    missing = [name for name in ("submit", "stop", "stats") if not hasattr(event_queue, name)]
+    if missing:
+        raise ValueError(f"event queue จาก {mode} ไม่มีเมธอด {', '.join(missing)}")
+    return event_queue